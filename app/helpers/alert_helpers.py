@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from app.helpers.sensor_helpers import SENSOR_METRICS, SENSORS_COLLECTION, add_ingest_stage, reading_id
+
+"""
+Threshold alerts, evaluated inline with ingest.
+
+A sensor's thresholds come from, per metric, the first of its
+`config/thresholds`, its `config/settings` and `sensor_global_config/thresholds`
+that sets one. A threshold is an upper limit: a reading above it breaches.
+
+Thresholds are cached in memory. A batch loads the ones it is missing in a
+single get_all, config writes invalidate the cache, and entries expire after
+THRESHOLD_CACHE_TTL so other instances' writes are picked up too.
+
+To keep a noisy sensor from flooding `sensor_alerts`, each (sensor, metric)
+goes through a small state machine:
+
+- it alarms after ALERT_DEBOUNCE_READINGS consecutive breaching readings,
+- it clears only once a reading falls ALERT_HYSTERESIS below the threshold,
+- and it does not alarm again within ALERT_COOLDOWN_SECONDS of its last alert.
+
+Raised and cleared alerts become writes in the ingest batch. Alert ids derive
+from the sensor, metric and reading, so a replayed batch rewrites the same
+alerts. The state is per process.
+"""
+
+ALERTS_COLLECTION = "sensor_alerts"
+GLOBAL_THRESHOLDS_PATH = ("sensor_global_config", "thresholds")
+THRESHOLD_CACHE_TTL = float(os.getenv("SENSOR_THRESHOLD_TTL", "300"))
+ALERT_DEBOUNCE_READINGS = int(os.getenv("SENSOR_ALERT_DEBOUNCE", "3"))
+ALERT_COOLDOWN_SECONDS = float(os.getenv("SENSOR_ALERT_COOLDOWN", "600"))
+# Margin below the threshold a metric has to fall to before its alarm clears.
+ALERT_HYSTERESIS = {"temperature": 1.0, "humidity": 3.0, "soil_moisture": 2.0}
+
+# Field names of each threshold document, in SENSOR_METRICS order.
+_THRESHOLD_FIELDS = {
+    "thresholds": tuple(f"{metric}_threshold" for metric in SENSOR_METRICS),
+    "settings": tuple(f"threshold_{metric}" for metric in SENSOR_METRICS),
+}
+
+
+def _thresholds_from(data, kind):
+    return tuple((data or {}).get(field) for field in _THRESHOLD_FIELDS[kind])
+
+
+def _first_set(*candidates):
+    return tuple(next((value for value in values if value is not None), None) for values in zip(*candidates))
+
+
+class ThresholdCache:
+    """
+    Per-sensor effective thresholds, as tuples in SENSOR_METRICS order.
+    """
+
+    def __init__(self, ttl=THRESHOLD_CACHE_TTL):
+        self.ttl = ttl
+        self._sensors = {}  # sensor_id -> (expires, own thresholds)
+        self._global = None  # (expires, thresholds)
+        self._lock = threading.Lock()
+
+    def invalidate(self, sensor_id=None):
+        """
+        Drops one sensor's thresholds, or with no sensor_id the global ones.
+        """
+        with self._lock:
+            if sensor_id is None:
+                self._global = None
+            else:
+                self._sensors.pop(sensor_id, None)
+
+    def get_many(self, client, sensor_ids):
+        """
+        Returns {sensor_id: thresholds}, loading what is missing in one round trip.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = {sensor_id: entry[1] for sensor_id in sensor_ids if (entry := self._sensors.get(sensor_id)) and entry[0] > now}
+            global_thresholds = self._global[1] if self._global and self._global[0] > now else None
+        missing = [sensor_id for sensor_id in sensor_ids if sensor_id not in cached]
+
+        if missing or global_thresholds is None:
+            sensors = client.collection(SENSORS_COLLECTION)
+            refs = [sensors.document(sensor_id).collection("config").document(kind) for sensor_id in missing for kind in _THRESHOLD_FIELDS]
+            global_ref = client.collection(GLOBAL_THRESHOLDS_PATH[0]).document(GLOBAL_THRESHOLDS_PATH[1])
+            documents = {}
+            for snapshot in client.get_all(refs + [global_ref]):
+                documents[snapshot.reference.path] = snapshot.to_dict() if snapshot.exists else None
+            loaded = {
+                sensor_id: _first_set(*(
+                    _thresholds_from(documents.get(sensors.document(sensor_id).collection("config").document(kind).path), kind)
+                    for kind in _THRESHOLD_FIELDS
+                ))
+                for sensor_id in missing
+            }
+            global_thresholds = _thresholds_from(documents.get(global_ref.path), "thresholds")
+            expires = time.monotonic() + self.ttl
+            with self._lock:
+                self._global = (expires, global_thresholds)
+                for sensor_id, thresholds in loaded.items():
+                    self._sensors[sensor_id] = (expires, thresholds)
+            cached.update(loaded)
+        return {sensor_id: _first_set(own, global_thresholds) for sensor_id, own in cached.items()}
+
+
+class AlertEvaluator:
+    """
+    Debounced, hysteretic threshold checks over incoming readings.
+    """
+
+    def __init__(self, thresholds=None, debounce=ALERT_DEBOUNCE_READINGS, cooldown=ALERT_COOLDOWN_SECONDS, hysteresis=ALERT_HYSTERESIS):
+        self.thresholds = thresholds or ThresholdCache()
+        self.debounce = debounce
+        self.cooldown = cooldown
+        self.margins = tuple(hysteresis.get(metric, 0.0) for metric in SENSOR_METRICS)
+        # (sensor_id, metric index) -> [breach streak, open alert id or None, epoch of last alert]
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def evaluate(self, sensor_thresholds, readings):
+        """
+        Runs readings through the state machine. Returns ("raised", alert)
+        and ("cleared", alert_id, reading) events.
+        """
+        events = []
+        state = self._state
+        with self._lock:
+            for reading in readings:
+                limits = sensor_thresholds.get(reading["sensor_id"])
+                if limits is None:
+                    continue
+                for index, metric in enumerate(SENSOR_METRICS):
+                    limit = limits[index]
+                    if limit is None:
+                        continue
+                    value = reading[metric]
+                    key = (reading["sensor_id"], index)
+                    entry = state.get(key)
+                    if entry is None:
+                        if value <= limit:
+                            continue  # the common case: nothing to track
+                        entry = state[key] = [0, None, float("-inf")]
+                    at = reading["recorded_at"].timestamp()
+                    if value > limit:
+                        entry[0] += 1
+                        if entry[1] is None and entry[0] >= self.debounce and at - entry[2] >= self.cooldown:
+                            alert_id = f"{reading['sensor_id']}-{metric}-{reading_id(reading['recorded_at'])}"
+                            entry[1], entry[2] = alert_id, at
+                            events.append(("raised", {"alert_id": alert_id, "metric": metric, "value": value, "threshold": limit, "reading": reading}))
+                    else:
+                        entry[0] = 0
+                        if entry[1] is not None and value <= limit - self.margins[index]:
+                            events.append(("cleared", entry[1], reading))
+                            entry[1] = None
+                        if entry[1] is None and at - entry[2] >= self.cooldown:
+                            del state[key]  # quiet and out of cooldown: nothing left to remember
+        return events
+
+    def reset(self):
+        with self._lock:
+            self._state.clear()
+
+
+def alert_write(client, alert_id, user_id, sensor_id, data):
+    """
+    Returns the write for a new alert in `sensor_alerts`.
+    """
+    document = {
+        "user_id": user_id,
+        "sensor_id": sensor_id,
+        "acknowledged": False,
+        "active": True,
+        "created_at": datetime.now(timezone.utc),
+        **data,
+    }
+    return ("set", client.collection(ALERTS_COLLECTION).document(alert_id), document)
+
+
+evaluator = AlertEvaluator()
+
+
+def invalidate_thresholds(sensor_id=None):
+    """
+    Called after thresholds are written: the next batch reloads them.
+    """
+    evaluator.thresholds.invalidate(sensor_id)
+
+
+def alert_writes(client, user_id, readings):
+    """
+    Ingest stage: evaluates thresholds and returns the alert writes.
+    """
+    sensor_thresholds = evaluator.thresholds.get_many(client, list({reading["sensor_id"] for reading in readings}))
+    writes = []
+    for event in evaluator.evaluate(sensor_thresholds, readings):
+        if event[0] == "raised":
+            alert = event[1]
+            reading = alert["reading"]
+            writes.append(alert_write(client, alert["alert_id"], user_id, reading["sensor_id"], {
+                "type": "threshold",
+                "metric": alert["metric"],
+                "value": alert["value"],
+                "threshold": alert["threshold"],
+                "timestamp": reading["recorded_at"].isoformat(),
+                "recorded_at": reading["recorded_at"],
+            }))
+        else:
+            _, alert_id, reading = event
+            writes.append(("merge", client.collection(ALERTS_COLLECTION).document(alert_id), {"active": False, "cleared_at": reading["recorded_at"]}))
+    return writes
+
+
+add_ingest_stage(alert_writes)
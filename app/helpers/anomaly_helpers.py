@@ -0,0 +1,237 @@
+import math
+import os
+import threading
+import numpy as np
+from app.helpers.alert_helpers import ALERT_COOLDOWN_SECONDS, alert_write
+from app.helpers.inventory_helpers import commit_in_batches
+from app.helpers.rollup_helpers import RAW_TIER, read_range
+from app.helpers.sensor_helpers import SENSORS_COLLECTION, add_ingest_stage, parse_timestamp, reading_id
+
+"""
+Anomaly detection on sensor readings.
+
+Per sensor and metric we keep an exponentially weighted moving mean and
+variance (weight ANOMALY_ALPHA), updated incrementally at ingest:
+
+    d = x - mean;  mean += alpha * d;  var = (1 - alpha) * (var + alpha * d * d)
+
+A reading is anomalous when it lies more than ANOMALY_Z_THRESHOLD deviations
+from the mean before it. This catches a sudden drop in soil moisture or a
+temperature spike that stays within the fixed thresholds. Anomalies become
+`sensor_alerts` of type "anomaly". Alerts are suppressed during the first
+ANOMALY_WARMUP readings and within ALERT_COOLDOWN_SECONDS of the previous
+anomaly alert.
+
+The state lives in memory. `backfill` runs the same filter over stored
+readings with NumPy, a block of readings at a time. It finds past anomalies
+and, for a range reaching the newest reading, seeds the live state, so a
+restarted process need not warm up again.
+"""
+
+ANOMALY_METRICS = ("temperature", "soil_moisture")
+ANOMALY_ALPHA = float(os.getenv("SENSOR_ANOMALY_ALPHA", "0.05"))
+ANOMALY_Z_THRESHOLD = float(os.getenv("SENSOR_ANOMALY_Z", "4"))
+ANOMALY_WARMUP = int(os.getenv("SENSOR_ANOMALY_WARMUP", "30"))
+# Smallest deviation used for z-scores, so a very steady sensor is not flagged for noise.
+ANOMALY_MIN_STD = {"temperature": 0.3, "soil_moisture": 0.5}
+_BLOCK = 256
+
+
+class EwmaState:
+    __slots__ = ("count", "mean", "var", "last_alert")
+
+    def __init__(self, count=0, mean=0.0, var=0.0, last_alert=float("-inf")):
+        self.count, self.mean, self.var, self.last_alert = count, mean, var, last_alert
+
+
+class AnomalyDetector:
+    """
+    Incremental EWMA z-scores per (sensor, metric).
+    """
+
+    def __init__(self, alpha=ANOMALY_ALPHA, z_threshold=ANOMALY_Z_THRESHOLD, warmup=ANOMALY_WARMUP, cooldown=ALERT_COOLDOWN_SECONDS):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.warmup = warmup
+        self.cooldown = cooldown
+        self._state = {}  # (sensor_id, metric) -> EwmaState
+        self._lock = threading.Lock()
+
+    def update(self, readings):
+        """
+        Folds readings in and returns the anomalies worth an alert, as dicts
+        with the reading, metric, expected value, deviation and z-score.
+        """
+        alpha = self.alpha
+        anomalies = []
+        with self._lock:
+            for reading in readings:
+                for metric in ANOMALY_METRICS:
+                    key = (reading["sensor_id"], metric)
+                    state = self._state.get(key)
+                    value = reading[metric]
+                    if state is None:
+                        self._state[key] = EwmaState(1, value, 0.0)
+                        continue
+                    diff = value - state.mean
+                    std = max(math.sqrt(state.var), ANOMALY_MIN_STD.get(metric, 0.0))
+                    z = diff / std
+                    if abs(z) > self.z_threshold and state.count >= self.warmup:
+                        at = reading["recorded_at"].timestamp()
+                        if at - state.last_alert >= self.cooldown:
+                            state.last_alert = at
+                            anomalies.append({"reading": reading, "metric": metric, "expected": state.mean, "std": std, "z": z})
+                    increment = alpha * diff
+                    state.mean += increment
+                    state.var = (1 - alpha) * (state.var + diff * increment)
+                    state.count += 1
+        return anomalies
+
+    def seed(self, sensor_id, metric, state):
+        with self._lock:
+            self._state[(sensor_id, metric)] = state
+
+    def state(self, sensor_id, metric):
+        return self._state.get((sensor_id, metric))
+
+
+def _recurrence(inputs, decay, initial):
+    """
+    Solves y[t] = decay * y[t-1] + inputs[t] with y[-1] = initial, a block of
+    _BLOCK steps per matrix product. Returns y.
+    """
+    steps = np.arange(_BLOCK)
+    lags = steps[:, None] - steps[None, :]
+    weights = np.where(lags >= 0, decay ** np.maximum(lags, 0), 0.0)
+    carry = decay ** (steps + 1)
+    out = np.empty_like(inputs)
+    for start in range(0, len(inputs), _BLOCK):
+        block = inputs[start:start + _BLOCK]
+        size = len(block)
+        out[start:start + size] = weights[:size, :size] @ block + carry[:size] * initial
+        initial = out[start + size - 1]
+    return out
+
+
+def ewma_series(values, alpha=ANOMALY_ALPHA, state=None):
+    """
+    Batch form of AnomalyDetector.update for one metric: returns the mean and
+    variance before each value, and the state after the last.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if state is None or state.count == 0:
+        state = EwmaState(1, float(values[0]), 0.0)
+        values_in, lead = values[1:], 1
+    else:
+        values_in, lead = values, 0
+    decay = 1 - alpha
+    # The mean is a plain linear recurrence in the values.
+    means_after = _recurrence(alpha * values_in, decay, state.mean)
+    means_before = np.concatenate(([state.mean], means_after[:-1]))
+    diffs = values_in - means_before
+    # So is the variance, once the deviations from the previous mean are known.
+    vars_after = _recurrence(decay * alpha * diffs * diffs, decay, state.var)
+    vars_before = np.concatenate(([state.var], vars_after[:-1]))
+    if lead:
+        means_before = np.concatenate(([np.nan], means_before))
+        vars_before = np.concatenate(([np.nan], vars_before))
+    final = EwmaState(
+        state.count + len(values_in),
+        float(means_after[-1]) if len(values_in) else state.mean,
+        float(vars_after[-1]) if len(values_in) else state.var,
+        state.last_alert,
+    )
+    return means_before, vars_before, final
+
+
+detector = AnomalyDetector()
+
+
+def anomaly_alert(client, user_id, anomaly):
+    reading = anomaly["reading"]
+    metric = anomaly["metric"]
+    return alert_write(client, f"{reading['sensor_id']}-{metric}-anomaly-{reading_id(reading['recorded_at'])}", user_id, reading["sensor_id"], {
+        "type": "anomaly",
+        "metric": metric,
+        "value": reading[metric],
+        "expected": anomaly["expected"],
+        "deviation": anomaly["std"],
+        "z_score": anomaly["z"],
+        "timestamp": reading["recorded_at"].isoformat(),
+        "recorded_at": reading["recorded_at"],
+    })
+
+
+def anomaly_writes(client, user_id, readings):
+    """
+    Ingest stage: updates the EWMA state and returns the anomaly alerts.
+    """
+    return [anomaly_alert(client, user_id, anomaly) for anomaly in detector.update(readings)]
+
+
+add_ingest_stage(anomaly_writes)
+
+
+def _reaches_newest(client, sensor_id, end):
+    # True when no reading is stored at or after `end`.
+    readings = client.collection(SENSORS_COLLECTION).document(sensor_id).collection("readings")
+    return not list(readings.where("__name__", ">=", readings.document(reading_id(end))).limit(1).stream())
+
+
+def backfill(client, sensor_id, start, end, write_alerts=False, seed=False):
+    """
+    Runs the detector over a sensor's stored readings in [start, end), in time
+    order. Returns the anomalies found and optionally writes their alerts.
+
+    With `seed`, the live state takes the state at the end of the range, but
+    only where that is not stale: when the range reaches the sensor's newest
+    reading, or for metrics without live state yet.
+    """
+    documents = []
+    for document in read_range(client, sensor_id, start, end, RAW_TIER):
+        try:
+            at = parse_timestamp(document.get("recorded_at") or document.get("timestamp"))
+        except ValueError:
+            continue
+        documents.append((at, document))
+    documents.sort(key=lambda entry: entry[0])
+    if not documents:
+        return []
+
+    times = np.array([at.timestamp() for at, _ in documents])
+    reaches_newest = seed and _reaches_newest(client, sensor_id, end)
+    found = []
+    for metric in ANOMALY_METRICS:
+        values = np.array([document.get(metric, np.nan) for _, document in documents], dtype=np.float64)
+        valid = ~np.isnan(values)
+        if not valid.any():
+            continue
+        means, variances, final = ewma_series(values[valid], detector.alpha)
+        stds = np.maximum(np.sqrt(np.nan_to_num(variances)), ANOMALY_MIN_STD.get(metric, 0.0))
+        z = (values[valid] - means) / stds
+        candidates = np.flatnonzero((np.abs(np.nan_to_num(z)) > detector.z_threshold) & (np.arange(len(z)) >= detector.warmup))
+        positions = np.flatnonzero(valid)
+        last_alert = float("-inf")
+        for index in candidates:  # anomalies are rare: the cooldown is applied in Python
+            at = times[positions[index]]
+            if at - last_alert < detector.cooldown:
+                continue
+            last_alert = at
+            recorded_at, document = documents[positions[index]]
+            found.append({
+                "reading": {"sensor_id": sensor_id, "recorded_at": recorded_at, metric: float(values[positions[index]])},
+                "user_id": document.get("user_id"),
+                "metric": metric,
+                "expected": float(means[index]),
+                "std": float(stds[index]),
+                "z": float(z[index]),
+            })
+        final.last_alert = last_alert
+        if seed and (reaches_newest or detector.state(sensor_id, metric) is None):
+            detector.seed(sensor_id, metric, final)
+
+    if write_alerts and found:
+        errors = [error for error in commit_in_batches(client, [anomaly_alert(client, anomaly["user_id"], anomaly) for anomaly in found]) if error]
+        if errors:
+            raise errors[0]
+    return found
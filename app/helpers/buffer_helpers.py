@@ -0,0 +1,205 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+import numpy as np
+from app.helpers.rollup_helpers import RAW_TIER, read_range
+from app.helpers.sensor_helpers import SENSOR_METRICS, add_ingest_stage, parse_timestamp
+
+"""
+Recent readings per sensor, in memory.
+
+Dashboards mostly chart the last few minutes of a sensor. Ingest adds every
+reading to a fixed-size, time-ordered buffer per sensor: an epoch-seconds float64
+column plus one float32 column per metric, 20 bytes a reading. Recent-window
+queries are answered from the buffer when it covers the window and from
+Firestore (which then seeds the buffer) when it does not.
+
+Memory is bounded by SENSOR_BUFFER_CAPACITY readings per sensor and
+SENSOR_BUFFER_MAX_SENSORS buffers, least recently used first out. A buffer
+only sees the readings ingested by this process; where several instances
+take ingest traffic, route a sensor's gateway to one of them or expect
+Firestore fallbacks.
+"""
+
+BUFFER_CAPACITY = int(os.getenv("SENSOR_BUFFER_CAPACITY", "1024"))
+BUFFER_MAX_SENSORS = int(os.getenv("SENSOR_BUFFER_MAX_SENSORS", "4096"))
+
+
+class SensorRingBuffer:
+    """
+    Fixed-capacity columns of a sensor's newest readings, kept in time order.
+    """
+
+    def __init__(self, capacity=BUFFER_CAPACITY, covers_since=None):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.columns = {metric: np.zeros(capacity, dtype=np.float32) for metric in SENSOR_METRICS}
+        self.size = 0  # slots [0, size) hold readings, oldest first
+        # Epoch second from which the buffer holds every reading (None: nothing yet).
+        self.covers_since = covers_since
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + sum(column.nbytes for column in self.columns.values())
+
+    def extend(self, times, values):
+        """
+        Adds readings: `times` in epoch seconds and {metric: values}.
+        Readings already held (same time) are skipped, e.g. one both seeded
+        from Firestore and ingested. Once full, the oldest readings by time
+        are dropped, whatever order they arrived in, so a replayed backlog
+        does not push out the newest readings; `covers_since` then moves past
+        the newest one dropped.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if not len(times):
+            return
+        with self.lock:
+            held_size = self.size
+            held = self.times[:held_size]
+            keep = ~np.isin(times, held) if held_size else np.ones(len(times), dtype=bool)
+            if not keep.any():
+                return
+            if self.covers_since is None:
+                self.covers_since = float(times[keep].min())
+            merged = np.concatenate([held, times[keep]])
+            order = np.argsort(merged, kind="stable")
+            dropped, order = order[:-self.capacity], order[-self.capacity:]
+            if len(dropped):
+                # Everything up to the newest dropped reading is no longer whole.
+                newest_dropped = float(merged[dropped].max())
+                self.covers_since = max(self.covers_since, float(np.nextafter(newest_dropped, np.inf)))
+            self.size = len(order)
+            self.times[:self.size] = merged[order]
+            for metric, column in self.columns.items():
+                incoming = np.asarray(values[metric], dtype=np.float32)[keep]
+                column[:self.size] = np.concatenate([column[:held_size], incoming])[order]
+
+    def window(self, since, until=None):
+        """
+        Returns the readings with since <= time < until, oldest first, or None
+        if the buffer does not hold all of them.
+        """
+        with self.lock:
+            if self.covers_since is None or self.covers_since > since:
+                return None
+            times = self.times[:self.size]
+            start = int(np.searchsorted(times, since, side="left"))
+            stop = self.size if until is None else int(np.searchsorted(times, until, side="left"))
+            return times[start:stop].copy(), {metric: column[start:stop].copy() for metric, column in self.columns.items()}
+
+
+class SensorBuffers:
+    """
+    Ring buffers of the most recently used sensors.
+    """
+
+    def __init__(self, capacity=BUFFER_CAPACITY, max_sensors=BUFFER_MAX_SENSORS):
+        self.capacity = capacity
+        self.max_sensors = max_sensors
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def get(self, sensor_id, create=False):
+        with self._lock:
+            buffer = self._buffers.get(sensor_id)
+            if buffer is not None:
+                self._buffers.move_to_end(sensor_id)
+            elif create:
+                buffer = self._add(sensor_id, SensorRingBuffer(self.capacity))
+            return buffer
+
+    def seed(self, sensor_id, covers_since, times, values):
+        """
+        Creates a sensor's buffer from readings loaded elsewhere, holding
+        every reading since `covers_since`, unless ingest created one meanwhile.
+        """
+        buffer = SensorRingBuffer(self.capacity, covers_since)
+        buffer.extend(times, values)
+        with self._lock:
+            if sensor_id not in self._buffers:
+                self._add(sensor_id, buffer)
+
+    def _add(self, sensor_id, buffer):
+        self._buffers[sensor_id] = buffer
+        while len(self._buffers) > self.max_sensors:
+            self._buffers.popitem(last=False)
+        return buffer
+
+    def nbytes(self):
+        with self._lock:
+            return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+buffers = SensorBuffers()
+
+
+def buffer_readings(client, user_id, readings):
+    """
+    Ingest stage: appends the batch to the sensors' ring buffers.
+    """
+    by_sensor = {}
+    for reading in readings:
+        by_sensor.setdefault(reading["sensor_id"], []).append(reading)
+    for sensor_id, sensor_readings in by_sensor.items():
+        buffers.get(sensor_id, create=True).extend(
+            [reading["recorded_at"].timestamp() for reading in sensor_readings],
+            {metric: [reading[metric] for reading in sensor_readings] for metric in SENSOR_METRICS},
+        )
+    return None
+
+
+add_ingest_stage(buffer_readings)
+
+
+def _column(values):
+    # Rounded back from float32; sensors do not resolve beyond this anyway.
+    # Missing (NaN) or non-finite values become None: JSON has no NaN.
+    values = values.astype(np.float64)
+    column = np.round(values, 4).astype(object)
+    column[~np.isfinite(values)] = None
+    return column.tolist()
+
+
+def _as_points(times, values):
+    columns = [_column(values[metric]) for metric in SENSOR_METRICS]
+    return [
+        {"timestamp": datetime.fromtimestamp(at, timezone.utc).isoformat(), **dict(zip(SENSOR_METRICS, row))}
+        for at, *row in zip(times.tolist(), *columns)
+    ]
+
+
+def recent_readings(client, sensor_id, since, now=None):
+    """
+    Returns (source, readings) for a sensor since `since`: from its ring
+    buffer when that covers the window ("memory"), else read from Firestore
+    ("firestore"), which also seeds an empty buffer.
+    """
+    now = now or datetime.now(timezone.utc)
+    buffer = buffers.get(sensor_id)
+    if buffer is not None:
+        window = buffer.window(since.timestamp())
+        if window is not None:
+            return "memory", _as_points(*window)
+
+    documents = list(read_range(client, sensor_id, since, now, RAW_TIER))
+    times, values = [], {metric: [] for metric in SENSOR_METRICS}
+    for document in documents:
+        try:
+            times.append(parse_timestamp(document.get("recorded_at") or document.get("timestamp")).timestamp())
+        except ValueError:
+            continue
+        for metric in SENSOR_METRICS:
+            values[metric].append(document.get(metric, float("nan")))
+    if buffer is None and len(times) <= BUFFER_CAPACITY:
+        buffers.seed(sensor_id, since.timestamp(), times, values)
+    order = np.argsort(np.asarray(times, dtype=np.float64), kind="stable")
+    return "firestore", _as_points(
+        np.asarray(times, dtype=np.float64)[order],
+        {metric: np.asarray(column, dtype=np.float64)[order] for metric, column in values.items()},
+    )
@@ -0,0 +1,138 @@
+import os
+import random
+from collections import defaultdict
+from datetime import datetime, timezone
+from google.cloud import firestore
+from app.helpers.inventory_helpers import commit_in_batches, paged_documents
+from app.helpers.sensor_helpers import SENSOR_METRICS, SENSORS_COLLECTION, add_ingest_stage, parse_timestamp
+
+"""
+Fleet diagnostics from running aggregates.
+
+Ingest keeps two sets of counters current, so diagnostics never read readings:
+
+- each sensor document (`sensors_data/{sensor_id}`) holds its reading count,
+  per-metric sums and `last_seen`, the epoch second of its newest reading;
+- `sensor_fleet_stats/{shard}` holds the fleet-wide count and sums, spread over
+  FLEET_STATS_SHARDS documents so concurrent batches do not contend.
+
+A diagnostics request reads the shards and runs two count() aggregations (all
+sensors, and those seen within ACTIVE_WINDOW_SECONDS): a constant number of
+round trips, whatever the size of the fleet and its history.
+
+The counters are increments, so a reading ingested twice is counted twice, and
+a batch whose counter writes failed is missing from them. `rebuild_diagnostics`
+recomputes them from the raw readings.
+"""
+
+FLEET_STATS_COLLECTION = "sensor_fleet_stats"
+FLEET_STATS_SHARDS = 8
+ACTIVE_WINDOW_SECONDS = int(os.getenv("SENSOR_ACTIVE_WINDOW_SECONDS", "900"))
+
+
+def _totals(readings):
+    totals = defaultdict(lambda: {"readings": 0, "last_seen": 0.0, **dict.fromkeys(SENSOR_METRICS, 0.0)})
+    for reading in readings:
+        sensor = totals[reading["sensor_id"]]
+        sensor["readings"] += 1
+        sensor["last_seen"] = max(sensor["last_seen"], reading["recorded_at"].timestamp())
+        for metric in SENSOR_METRICS:
+            sensor[metric] += reading[metric]
+    return totals
+
+
+def diagnostics_writes(client, user_id, readings):
+    """
+    Ingest stage: one merge per sensor in the batch, plus one fleet shard.
+    """
+    sensors = client.collection(SENSORS_COLLECTION)
+    fleet = {"readings": 0, **dict.fromkeys(SENSOR_METRICS, 0.0)}
+    writes = []
+    for sensor_id, sensor in _totals(readings).items():
+        writes.append(("merge", sensors.document(sensor_id), {
+            "user_id": user_id,
+            "readings": firestore.Increment(sensor["readings"]),
+            "last_seen": firestore.Maximum(sensor["last_seen"]),
+            "totals": {metric: firestore.Increment(sensor[metric]) for metric in SENSOR_METRICS},
+        }))
+        for field in fleet:
+            fleet[field] += sensor[field]
+    shard = client.collection(FLEET_STATS_COLLECTION).document(str(random.randrange(FLEET_STATS_SHARDS)))
+    writes.append(("merge", shard, {field: firestore.Increment(amount) for field, amount in fleet.items()}))
+    return writes
+
+
+add_ingest_stage(diagnostics_writes)
+
+
+def _count(query):
+    return query.count(alias="count").get()[0][0].value
+
+
+def read_diagnostics(client, now=None):
+    """
+    Returns fleet averages, the number of sensors and how many of them
+    reported within ACTIVE_WINDOW_SECONDS of `now`.
+    """
+    now = now or datetime.now(timezone.utc)
+    fleet = {"readings": 0, **dict.fromkeys(SENSOR_METRICS, 0.0)}
+    shards = [client.collection(FLEET_STATS_COLLECTION).document(str(shard)) for shard in range(FLEET_STATS_SHARDS)]
+    for snapshot in client.get_all(shards):
+        if snapshot.exists:
+            data = snapshot.to_dict()
+            for field in fleet:
+                fleet[field] += data.get(field, 0)
+
+    sensors = client.collection(SENSORS_COLLECTION)
+    count = fleet["readings"]
+    diagnostics = {f"average_{metric}": fleet[metric] / count if count else None for metric in SENSOR_METRICS}
+    diagnostics.update({
+        "active_sensors": _count(sensors.where("last_seen", ">=", now.timestamp() - ACTIVE_WINDOW_SECONDS)),
+        "total_sensors": _count(sensors),
+        "total_readings": count,
+    })
+    return diagnostics
+
+
+def rebuild_diagnostics(client):
+    """
+    Recomputes the per-sensor and fleet aggregates from the raw readings,
+    replacing the counters. Used to seed them and to repair drift.
+    """
+    sensors = client.collection(SENSORS_COLLECTION)
+    fleet = {"readings": 0, **dict.fromkeys(SENSOR_METRICS, 0.0)}
+    writes = []
+    # list_documents also returns sensors whose document was never written.
+    for sensor_ref in sensors.list_documents():
+        sensor = {"readings": 0, "last_seen": 0.0, **dict.fromkeys(SENSOR_METRICS, 0.0)}
+        for doc in paged_documents(sensor_ref.collection("readings")):
+            reading = doc.to_dict()
+            sensor["readings"] += 1
+            for metric in SENSOR_METRICS:
+                sensor[metric] += reading.get(metric) or 0
+            try:
+                seen = parse_timestamp(reading.get("recorded_at") or reading.get("timestamp")).timestamp()
+            except ValueError:
+                continue
+            sensor["last_seen"] = max(sensor["last_seen"], seen)
+        if not sensor["readings"]:
+            continue
+        writes.append(("merge", sensor_ref, {
+            "readings": sensor["readings"],
+            "last_seen": sensor["last_seen"],
+            "totals": {metric: sensor[metric] for metric in SENSOR_METRICS},
+        }))
+        for field in fleet:
+            fleet[field] += sensor[field]
+
+    errors = [error for error in commit_in_batches(client, writes) if error]
+    if errors:
+        raise errors[0]
+
+    shards = client.collection(FLEET_STATS_COLLECTION)
+    batch = client.batch()
+    batch.set(shards.document("0"), fleet)
+    for shard in range(1, FLEET_STATS_SHARDS):
+        batch.delete(shards.document(str(shard)))
+    batch.commit()
+    return {"sensors": len(writes), "readings": fleet["readings"]}
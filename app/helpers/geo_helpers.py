@@ -0,0 +1,419 @@
+import csv
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import numpy as np
+from firebase_admin import db
+
+"""
+Geospatial helpers for radius searches.
+
+Listings are located by pincode, so the spatial index holds one point per
+distinct pincode rather than one per listing. A radius query first collects the
+geohash buckets overlapping the bounding box of the circle and then runs a
+vectorized haversine check over the points in those buckets only.
+
+Pincodes are geocoded offline from a table bundled under `app/data`. The CSV is
+the editable source; it is compiled into a fixed-width open-addressing hash table
+(`pincodes.bin`) that is memory-mapped, so a lookup is one hash and a probe or two
+into the mapped file, with no network call and no per-process parse cost.
+Pincodes missing from the table are looked up in the Realtime Database
+`locations/{pincode}` node on a background thread when listings carrying them
+are indexed, never while a request waits; `import_locations` folds that node
+into the table offline.
+"""
+
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_PRECISION = 4  # ~39 km x 19.5 km cells
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+PINCODE_CSV_PATH = os.path.join(DATA_DIR, "pincodes.csv")
+PINCODE_TABLE_PATH = os.path.join(DATA_DIR, "pincodes.bin")
+
+_TABLE_MAGIC = b"PIN1"
+_TABLE_HEADER = struct.Struct("<4sII")  # magic, capacity, count
+_TABLE_RECORD = struct.Struct("<Iff")  # pincode (0 = empty slot), lat, lon
+
+# How long a pincode found in neither the table nor `locations` stays unknown.
+LOCATION_MISS_TTL = float(os.getenv("PINCODE_LOCATION_MISS_TTL", "3600"))
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    """
+    Encodes a coordinate as a geohash string.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def geohash_cell_size(precision=GEOHASH_PRECISION):
+    """
+    Returns the (lat, lon) size in degrees of a geohash cell.
+    """
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lon_bits)
+
+
+def haversine_km(lat, lon, lats, lons):
+    """
+    Great-circle distance in km from one point to arrays of points.
+    """
+    lat1 = np.radians(lat)
+    lon1 = np.radians(lon)
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lon2 = np.radians(np.asarray(lons, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GeohashIndex:
+    """
+    Geohash-bucketed point index answering "within r km of (lat, lon)".
+    """
+
+    def __init__(self, precision=GEOHASH_PRECISION):
+        self._lock = threading.RLock()
+        self.precision = precision
+        self.points = {}
+        self.buckets = {}
+
+    def __contains__(self, key):
+        return key in self.points
+
+    def add(self, key, lat, lon):
+        with self._lock:
+            self.remove(key)
+            cell = geohash_encode(lat, lon, self.precision)
+            self.points[key] = (lat, lon, cell)
+            self.buckets.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            point = self.points.pop(key, None)
+            if point is None:
+                return
+            bucket = self.buckets.get(point[2])
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[point[2]]
+
+    def _covering_cells(self, lat, lon, radius_km):
+        lat_delta = radius_km / 110.574
+        cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+        lon_delta = min(radius_km / (111.320 * cos_lat), 180.0)
+        min_lat, max_lat = max(lat - lat_delta, -90.0), min(lat + lat_delta, 90.0)
+        min_lon, max_lon = lon - lon_delta, lon + lon_delta
+
+        cell_lat, cell_lon = geohash_cell_size(self.precision)
+        lat_steps = int((max_lat - min_lat) / cell_lat) + 2
+        lon_steps = int((max_lon - min_lon) / cell_lon) + 2
+        # For very large circles walking the grid costs more than visiting every bucket.
+        if lat_steps * lon_steps > len(self.buckets):
+            return list(self.buckets)
+
+        cells = set()
+        for i in range(lat_steps):
+            cur_lat = min(min_lat + i * cell_lat, max_lat)
+            for j in range(lon_steps):
+                cur_lon = min(min_lon + j * cell_lon, max_lon)
+                wrapped_lon = (cur_lon + 180.0) % 360.0 - 180.0
+                cells.add(geohash_encode(cur_lat, wrapped_lon, self.precision))
+        return cells
+
+    def within(self, lat, lon, radius_km):
+        """
+        Returns the keys of all points within `radius_km` of (lat, lon).
+        """
+        with self._lock:
+            candidates = []
+            for cell in self._covering_cells(lat, lon, radius_km):
+                candidates.extend(self.buckets.get(cell, ()))
+            if not candidates:
+                return []
+            lats = [self.points[key][0] for key in candidates]
+            lons = [self.points[key][1] for key in candidates]
+        distances = haversine_km(lat, lon, lats, lons)
+        return [key for key, dist in zip(candidates, distances) if dist <= radius_km]
+
+
+def _pincode_slot(pincode, capacity):
+    # Knuth multiplicative hash: the top log2(capacity) bits of a 32-bit product.
+    return ((pincode * 2654435761) & 0xFFFFFFFF) >> (33 - capacity.bit_length())
+
+
+def build_pincode_table(csv_path=PINCODE_CSV_PATH, table_path=PINCODE_TABLE_PATH):
+    """
+    Compiles a `pincode,latitude,longitude` CSV into the binary lookup table.
+
+    Any pincode directory with those columns works, e.g. the India Post
+    "All India Pincode Directory" export; duplicate pincodes keep the first row.
+    """
+    rows = {}
+    with open(csv_path, newline="", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            try:
+                pincode = int(row["pincode"])
+                lat = float(row["latitude"])
+                lon = float(row["longitude"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if pincode > 0:
+                rows.setdefault(pincode, (lat, lon))
+
+    capacity = 1
+    while capacity < max(len(rows) * 2, 16):
+        capacity <<= 1
+    mask = capacity - 1
+    buffer = bytearray(_TABLE_HEADER.size + capacity * _TABLE_RECORD.size)
+    _TABLE_HEADER.pack_into(buffer, 0, _TABLE_MAGIC, capacity, len(rows))
+    occupied = [False] * capacity
+    for pincode, (lat, lon) in rows.items():
+        slot = _pincode_slot(pincode, capacity)
+        while occupied[slot]:
+            slot = (slot + 1) & mask
+        occupied[slot] = True
+        _TABLE_RECORD.pack_into(buffer, _TABLE_HEADER.size + slot * _TABLE_RECORD.size, pincode, lat, lon)
+
+    tmp_path = table_path + ".tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(buffer)
+    os.replace(tmp_path, table_path)
+    return len(rows)
+
+
+class PincodeTable:
+    """
+    Read-only, memory-mapped pincode -> (lat, lon) table.
+    """
+
+    def __init__(self, table_path=PINCODE_TABLE_PATH):
+        with open(table_path, "rb") as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.capacity, self.count = _TABLE_HEADER.unpack_from(self._map, 0)
+        if magic != _TABLE_MAGIC:
+            raise ValueError(f"{table_path} is not a pincode table")
+        self._mask = self.capacity - 1
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, pincode):
+        """
+        Returns the (lat, lon) of a pincode, or None if it is not in the table.
+        """
+        try:
+            key = int(str(pincode).strip())
+        except (TypeError, ValueError):
+            return None
+        if key <= 0:
+            return None
+        slot = _pincode_slot(key, self.capacity)
+        for _ in range(self.capacity):
+            stored, lat, lon = _TABLE_RECORD.unpack_from(self._map, _TABLE_HEADER.size + slot * _TABLE_RECORD.size)
+            if stored == key:
+                # Stored as float32; round off the representation noise.
+                return round(lat, 5), round(lon, 5)
+            if stored == 0:
+                return None
+            slot = (slot + 1) & self._mask
+        return None
+
+
+_pincode_table = None
+_pincode_table_lock = threading.Lock()
+
+
+def load_pincode_table(table_path=PINCODE_TABLE_PATH, csv_path=PINCODE_CSV_PATH):
+    """
+    Returns the process-wide pincode table, compiling it from the CSV first if
+    the binary is missing. Re-run `build_pincode_table` after editing the CSV.
+    """
+    global _pincode_table
+    if _pincode_table is not None:
+        return _pincode_table
+    with _pincode_table_lock:
+        if _pincode_table is None:
+            if not os.path.exists(table_path):
+                build_pincode_table(csv_path, table_path)
+            _pincode_table = PincodeTable(table_path)
+    return _pincode_table
+
+
+_locations = {}  # pincode -> ((lat, lon) or None, expiry of a miss)
+_locations_lock = threading.Lock()
+_pending_locations = set()  # pincodes waiting for the background lookup
+_location_worker = None
+
+
+def lookup_location(pincode):
+    """
+    Returns the (lat, lon) stored under `locations/{pincode}`, or None.
+    Hits are cached for good, misses for LOCATION_MISS_TTL. This reads the
+    database: only call it off the request path.
+    """
+    key = str(pincode).strip()
+    now = time.monotonic()
+    with _locations_lock:
+        entry = _locations.get(key)
+    if entry is not None and (entry[0] is not None or entry[1] > now):
+        return entry[0]
+    try:
+        location = db.reference("locations").child(key).get()
+        coords = (float(location["lat"]), float(location["lon"])) if isinstance(location, dict) else None
+    except (KeyError, TypeError, ValueError):
+        coords = None
+    except Exception as e:
+        # Not cached: the database may answer next time.
+        print(f"Could not look up location of {key}: {e}")
+        return None
+    with _locations_lock:
+        _locations[key] = (coords, now + LOCATION_MISS_TTL)
+    return coords
+
+
+def _locate_pending():
+    global _location_worker
+    while True:
+        with _locations_lock:
+            if not _pending_locations:
+                _location_worker = None
+                return
+            pincode = _pending_locations.pop()
+        coords = lookup_location(pincode)
+        if coords:
+            pincode_index.add(pincode, *coords)
+
+
+def locate_pincodes(pincodes):
+    """
+    Places pincodes missing from the spatial index: from the table at once,
+    else from `locations` on a background thread. For listing write and index
+    paths; requests only ever see the table and what was located before.
+    """
+    global _location_worker
+    unknown = []
+    for pincode in pincodes:
+        if not pincode or pincode in pincode_index:
+            continue
+        coords = load_pincode_table().lookup(pincode)
+        if coords:
+            pincode_index.add(pincode, *coords)
+        else:
+            unknown.append(str(pincode).strip())
+    if not unknown:
+        return
+    now = time.monotonic()
+    with _locations_lock:
+        for key in unknown:
+            entry = _locations.get(key)
+            if entry is None or (entry[0] is None and entry[1] <= now):
+                _pending_locations.add(key)
+        if _pending_locations and _location_worker is None:
+            _location_worker = threading.Thread(target=_locate_pending, name="pincode-locations", daemon=True)
+            _location_worker.start()
+
+
+def resolve_pincode(pincode):
+    """
+    Returns the (lat, lon) of a pincode, or None if it is unknown. Never
+    calls the network: a pincode missing from the table and not located
+    before is queued for lookup and unknown for now.
+    """
+    if not pincode:
+        return None
+    coords = load_pincode_table().lookup(pincode)
+    if coords:
+        return coords
+    with _locations_lock:
+        entry = _locations.get(str(pincode).strip())
+    if entry is not None and entry[0] is not None:
+        return entry[0]
+    locate_pincodes([pincode])
+    return None
+
+
+def import_locations(csv_path=PINCODE_CSV_PATH, table_path=PINCODE_TABLE_PATH):
+    """
+    Offline step: adds the pincodes of the `locations` node missing from the
+    CSV (one read of the whole node) and rebuilds the table, so deployments
+    geocode them without a lookup. Returns the number of pincodes added.
+    """
+    with open(csv_path, newline="", encoding="utf-8") as handle:
+        known = {row["pincode"].strip() for row in csv.DictReader(handle)}
+    added = []
+    for pincode, location in (db.reference("locations").get() or {}).items():
+        try:
+            lat, lon = float(location["lat"]), float(location["lon"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if str(pincode).strip() not in known:
+            added.append((str(pincode).strip(), lat, lon, ""))
+    if added:
+        with open(csv_path, "a", newline="", encoding="utf-8") as handle:
+            csv.writer(handle).writerows(added)
+    build_pincode_table(csv_path, table_path)
+    return len(added)
+
+
+pincode_index = GeohashIndex()
+
+
+def place_pincodes(pincodes):
+    """
+    Makes sure every given pincode the table or earlier lookups know has a
+    point in the spatial index.
+    """
+    for pincode in pincodes:
+        if pincode in pincode_index:
+            continue
+        coords = resolve_pincode(pincode)
+        if coords:
+            pincode_index.add(pincode, *coords)
+
+
+def pincodes_within(pincode, radius_km, known_pincodes):
+    """
+    Returns the known pincodes lying within `radius_km` of `pincode`.
+
+    Returns None when the centre pincode cannot be located.
+    """
+    center = resolve_pincode(pincode)
+    if center is None:
+        return None
+    place_pincodes(known_pincodes)
+    return set(pincode_index.within(center[0], center[1], radius_km))
@@ -0,0 +1,299 @@
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from app.helpers.inventory_helpers import commit_in_batches
+from app.helpers.sensor_helpers import SENSORS_COLLECTION, add_ingest_stage
+from app.helpers.stream_helpers import publish_update
+
+"""
+Sensor online/offline status from heartbeats.
+
+Every ingested reading is a heartbeat of its sensor. A sensor is online while
+its newest reading is less than SILENCE_SECONDS old, and flips offline once it
+has been silent that long. Nothing scans the fleet for silent sensors: a
+min-heap holds one deadline per online sensor and a scheduler thread sleeps
+until the earliest one.
+
+- A heartbeat of an online sensor only moves its `last_seen`: O(1).
+- When a deadline comes up, the sensor is either rescheduled to
+  last_seen + SILENCE_SECONDS, if it was heard from meanwhile, or flipped
+  offline: O(log n) per pop, about one pop per sensor per silence window.
+
+Transitions are written to `sensors_data/{id}/status/current_status` and
+published to the live stream. At app start-up the scheduler starts and
+sensors recorded as online are loaded in the background (retried until the
+query succeeds), so those that went quiet while no process was watching
+still flip.
+
+Each instance only hears the sensors it ingests. Before recording a sensor
+offline, it re-reads the sensor's `last_seen` (kept by the diagnostics stage)
+and its status document: a sensor another instance heard from is rescheduled,
+and the offline write only applies if the status document has not changed
+since it was read, so it never overwrites a newer "online".
+"""
+
+SILENCE_SECONDS = float(os.getenv("SENSOR_SILENCE_SECONDS", "300"))
+RESTORE_RETRY_SECONDS = float(os.getenv("SENSOR_RESTORE_RETRY_SECONDS", "60"))
+
+
+class HeartbeatTracker:
+    """
+    Last-seen times and online flags, with a deadline heap for the online sensors.
+    """
+
+    def __init__(self, silence=SILENCE_SECONDS, clock=time.time):
+        self.silence = silence
+        self.clock = clock
+        self._sensors = {}  # sensor_id -> [last_seen, online, farm_id]
+        self._heap = []  # (deadline, sensor_id): exactly one entry per online sensor
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._listeners = []
+        self._thread = None
+
+    def __len__(self):
+        return len(self._sensors)
+
+    def add_listener(self, listener):
+        """
+        Registers `listener(transitions)`, called with each batch of sensors
+        that went offline, as (sensor_id, status) pairs.
+        """
+        self._listeners.append(listener)
+
+    def _schedule(self, sensor_id, deadline):
+        if not self._heap or deadline < self._heap[0][0]:
+            self._changed.notify()  # the scheduler sleeps until a later deadline
+        heapq.heappush(self._heap, (deadline, sensor_id))
+
+    def beat(self, sensor_id, farm_id, at):
+        """
+        Records a reading of `sensor_id` taken at `at` (epoch seconds).
+        Returns the sensor's status if this brought it online, else None.
+        """
+        with self._lock:
+            now = self.clock()
+            at = min(at, now)  # gateway clocks run ahead at times
+            entry = self._sensors.get(sensor_id)
+            if entry is None:
+                entry = self._sensors[sensor_id] = [at, False, farm_id]
+            # Past its deadline, another instance may have recorded it offline.
+            lapsed = entry[0] + self.silence <= now
+            if at > entry[0]:
+                entry[0] = at
+            entry[2] = farm_id or entry[2]
+            if entry[0] + self.silence <= now:
+                return None  # a replay too old to count
+            if entry[1]:
+                # Online and scheduled already: only a lapsed sensor is recorded again.
+                return self._status(sensor_id, entry) if lapsed else None
+            entry[1] = True
+            self._schedule(sensor_id, entry[0] + self.silence)
+            return self._status(sensor_id, entry)
+
+    def restore(self, sensor_id, farm_id, last_seen):
+        """
+        Tracks a sensor recorded as online by an earlier process.
+        """
+        with self._lock:
+            if sensor_id not in self._sensors:
+                self._sensors[sensor_id] = [last_seen, True, farm_id]
+                self._schedule(sensor_id, last_seen + self.silence)
+
+    def revive(self, sensor_id, last_seen):
+        """
+        Puts a sensor flipped offline back online, if `last_seen` (e.g. from
+        another instance) shows it was heard from within the silence window.
+        """
+        with self._lock:
+            entry = self._sensors.get(sensor_id)
+            if entry is None:
+                return
+            entry[0] = max(entry[0], min(last_seen, self.clock()))
+            if not entry[1] and entry[0] + self.silence > self.clock():
+                entry[1] = True
+                self._schedule(sensor_id, entry[0] + self.silence)
+
+    def expire(self, now=None):
+        """
+        Flips the sensors whose deadline has passed without a newer heartbeat
+        offline and returns their (sensor_id, status) pairs.
+        """
+        transitions = []
+        with self._lock:
+            now = self.clock() if now is None else now
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                _, sensor_id = heapq.heappop(heap)
+                entry = self._sensors[sensor_id]
+                deadline = entry[0] + self.silence
+                if deadline > now:
+                    heapq.heappush(heap, (deadline, sensor_id))
+                else:
+                    entry[1] = False
+                    transitions.append((sensor_id, self._status(sensor_id, entry)))
+        return transitions
+
+    def status(self, sensor_id):
+        with self._lock:
+            entry = self._sensors.get(sensor_id)
+            return self._status(sensor_id, entry) if entry else None
+
+    def _status(self, sensor_id, entry):
+        last_seen, online, farm_id = entry
+        return {
+            "status": "online" if online else "offline",
+            "last_seen": datetime.fromtimestamp(last_seen, timezone.utc),
+            "silence_seconds": self.silence,
+            "user_id": farm_id,
+        }
+
+    def start(self):
+        """
+        Starts the scheduler thread, once.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sensor-heartbeats", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._heap or self._heap[0][0] > self.clock():
+                    self._changed.wait(None if not self._heap else self._heap[0][0] - self.clock())
+            transitions = self.expire()
+            if transitions:
+                for listener in self._listeners:
+                    try:
+                        listener(transitions)
+                    except Exception as e:
+                        print(f"Heartbeat listener failed: {e}")
+
+
+tracker = HeartbeatTracker()
+_client = None
+_client_lock = threading.Lock()
+
+
+def status_ref(client, sensor_id):
+    return client.collection(SENSORS_COLLECTION).document(sensor_id).collection("status").document("current_status")
+
+
+def status_write(client, sensor_id, status, option=None):
+    """
+    Returns the status document write; with a write `option` it is an update
+    that only applies under that precondition.
+    """
+    data = {**status, "changed_at": datetime.now(timezone.utc)}
+    if option is not None:
+        return ("update", status_ref(client, sensor_id), data, option)
+    return ("set", status_ref(client, sensor_id), data)
+
+
+def _publish(sensor_id, status):
+    publish_update(sensor_id, status["user_id"], "status", {"status": status["status"], "last_seen": status["last_seen"].isoformat()})
+
+
+def _record_offline(transitions):
+    sensors = _client.collection(SENSORS_COLLECTION)
+    refs = [sensors.document(sensor_id) for sensor_id, _ in transitions] + [status_ref(_client, sensor_id) for sensor_id, _ in transitions]
+    snapshots = {snapshot.reference.path: snapshot for snapshot in _client.get_all(refs)}
+    now = time.time()
+    changes = []
+    for sensor_id, status in transitions:
+        sensor = snapshots.get(sensors.document(sensor_id).path)
+        last_seen = (sensor.to_dict() or {}).get("last_seen") if sensor is not None and sensor.exists else None
+        current = snapshots.get(status_ref(_client, sensor_id).path)
+        recorded = (current.to_dict() or {}).get("status") if current is not None and current.exists else None
+        if last_seen and last_seen + tracker.silence > now:
+            # Heard from by another instance: keep it online, and put back an
+            # "offline" some instance wrote while that reading was in flight.
+            tracker.revive(sensor_id, last_seen)
+            if recorded == "offline":
+                changes.append((sensor_id, tracker.status(sensor_id), _client.write_option(last_update_time=current.update_time)))
+            continue
+        if (tracker.status(sensor_id) or {}).get("status") == "online":
+            continue  # heard from here since it expired
+        if last_seen:
+            status = {**status, "last_seen": max(status["last_seen"], datetime.fromtimestamp(last_seen, timezone.utc))}
+        if recorded is None:
+            changes.append((sensor_id, status, None))
+        elif recorded != "offline":
+            changes.append((sensor_id, status, _client.write_option(last_update_time=current.update_time)))
+        else:
+            _publish(sensor_id, status)  # recorded offline already, e.g. by another instance
+
+    # One write per batch: a failed precondition (the status document changed
+    # since it was read) only skips its own sensor.
+    errors = commit_in_batches(_client, [status_write(_client, sensor_id, status, option) for sensor_id, status, option in changes], batch_size=1)
+    for (sensor_id, status, _), error in zip(changes, errors):
+        if error is None:
+            _publish(sensor_id, status)
+        else:
+            print(f"Could not record {sensor_id} {status['status']}: {error}")
+
+
+tracker.add_listener(_record_offline)
+
+
+def _restore(client):
+    """
+    Tracks the sensors recorded as online, retrying until the query succeeds;
+    those of them that went quiet flip on the first tick.
+
+    Needs a collection-group single-field index on status (status), which
+    Firestore does not enable by default.
+    """
+    while True:
+        try:
+            for snapshot in client.collection_group("status").where("status", "==", "online").stream():
+                status = snapshot.to_dict()
+                # Any other subcollection named "status" is in the group too.
+                if snapshot.id != "current_status" or snapshot.reference.parent.parent.parent.id != SENSORS_COLLECTION:
+                    continue
+                if status.get("last_seen"):
+                    tracker.restore(snapshot.reference.parent.parent.id, status.get("user_id"), status["last_seen"].timestamp())
+            return
+        except Exception as e:
+            print(f"Could not restore online sensors, retrying in {RESTORE_RETRY_SECONDS}s: {e}")
+            time.sleep(RESTORE_RETRY_SECONDS)
+
+
+def ensure_heartbeat_tracker(client):
+    """
+    Starts the scheduler and restores the sensors recorded as online in the
+    background, once. Called at app start-up, and by ingest.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return
+        _client = client
+    tracker.start()
+    threading.Thread(target=_restore, args=(client,), name="sensor-heartbeat-restore", daemon=True).start()
+
+
+def heartbeat_writes(client, user_id, readings):
+    """
+    Ingest stage: a heartbeat per sensor in the batch; returns the status
+    writes of sensors that came online.
+    """
+    ensure_heartbeat_tracker(client)
+    newest = {}
+    for reading in readings:
+        at = reading["recorded_at"].timestamp()
+        if at > newest.get(reading["sensor_id"], float("-inf")):
+            newest[reading["sensor_id"]] = at
+    writes = []
+    for sensor_id, at in newest.items():
+        status = tracker.beat(sensor_id, user_id, at)
+        if status is not None:
+            writes.append(status_write(client, sensor_id, status))
+            _publish(sensor_id, status)
+    return writes
+
+
+add_ingest_stage(heartbeat_writes)
@@ -0,0 +1,215 @@
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from app.helpers.inventory_helpers import commit_in_batches, paged_documents, stream_collections
+
+"""
+Append-only inventory change log.
+
+Every inventory mutation appends one change document, committed in the same
+batch as the item write, to a partition per UTC day:
+
+    {storage}_history/{YYYY-MM-DD}/changes/{change_id}
+
+Change ids start with the zero-padded microsecond timestamp, so a partition
+lists in time order and a time range is a document-id range. A range query only
+opens the partitions of the days it spans.
+
+Compaction folds partitions older than the retention window into one snapshot
+per item (`{storage}_history_snapshots/{item_id}`), deletes their change
+documents and marks the partition compacted. Snapshots remember the last change
+folded into them, so an interrupted compaction can simply run again.
+"""
+
+HISTORY_RETENTION_DAYS = int(os.getenv("INVENTORY_HISTORY_RETENTION_DAYS", "30"))
+DEFAULT_HISTORY_WINDOW = timedelta(days=7)
+PARTITION_FORMAT = "%Y-%m-%d"
+
+
+def history_collection(storage):
+    return f"{storage}_history"
+
+
+def snapshot_collection(storage):
+    return f"{storage}_history_snapshots"
+
+
+def as_utc(at):
+    """
+    Returns `at` as an aware UTC datetime; naive datetimes are taken as UTC.
+    """
+    return at.replace(tzinfo=timezone.utc) if at.tzinfo is None else at.astimezone(timezone.utc)
+
+
+def _timestamp_id(at):
+    return f"{int(as_utc(at).timestamp() * 1_000_000):016d}"
+
+
+def partition_keys(start, end):
+    """
+    Returns the day partitions overlapping [start, end).
+    """
+    day = as_utc(start).replace(hour=0, minute=0, second=0, microsecond=0)
+    end = as_utc(end)
+    keys = []
+    while day < end:
+        keys.append(day.strftime(PARTITION_FORMAT))
+        day += timedelta(days=1)
+    return keys
+
+
+def _partition_start(key):
+    return datetime.strptime(key, PARTITION_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def _diff(old_item, new_item):
+    old_item = old_item or {}
+    new_item = new_item or {}
+    fields = [field for field in {**old_item, **new_item} if old_item.get(field) != new_item.get(field)]
+    changes = {field: new_item[field] for field in fields if field in new_item}
+    previous = {field: old_item[field] for field in fields if field in old_item}
+    return changes, previous
+
+
+def history_write(client, storage, item_id, old_item, new_item, at=None):
+    """
+    Returns the change-log append for replacing `old_item` by `new_item`
+    (either may be None for a create or a delete), or None if nothing changed.
+    """
+    if old_item is None and new_item is None:
+        return None  # e.g. deleting an item that does not exist
+    changes, previous = _diff(old_item, new_item)
+    if old_item is None:
+        operation = "create"
+    elif new_item is None:
+        operation = "delete"
+    elif changes or previous:
+        operation = "update"
+    else:
+        return None
+    at = as_utc(at or datetime.now(timezone.utc))
+    change_id = f"{_timestamp_id(at)}-{uuid.uuid4().hex[:8]}"
+    change_ref = (
+        client.collection(history_collection(storage))
+        .document(at.strftime(PARTITION_FORMAT))
+        .collection("changes")
+        .document(change_id)
+    )
+    entry = {
+        "item_id": item_id,
+        "storage": storage,
+        "operation": operation,
+        "at": at,
+        "changes": changes,  # new values of the fields that changed
+        "previous": previous,  # their values before the change
+    }
+    return ("set", change_ref, entry)
+
+
+def history_queries(client, storage, start, end, item_id=None):
+    """
+    Returns one query per day partition overlapping [start, end).
+    """
+    start, end = as_utc(start), as_utc(end)
+    partitions = client.collection(history_collection(storage))
+    queries = {}
+    for key in partition_keys(start, end):
+        changes = partitions.document(key).collection("changes")
+        query = changes
+        if item_id:
+            query = query.where("item_id", "==", item_id)
+        # Only the first and last partition are cut; ids sort by time.
+        day_start = _partition_start(key)
+        if start > day_start:
+            query = query.where("__name__", ">=", changes.document(_timestamp_id(start)))
+        if end < day_start + timedelta(days=1):
+            query = query.where("__name__", "<", changes.document(_timestamp_id(end)))
+        queries[f"{storage}/{key}"] = query
+    return queries
+
+
+def read_history(client, storages, start, end, item_id=None, page_size=None):
+    """
+    Streams the change entries of the given storages in [start, end), reading
+    the partitions concurrently (in arrival order, not time order).
+    """
+    queries = {}
+    for storage in storages:
+        queries.update(history_queries(client, storage, start, end, item_id))
+    for _, doc in stream_collections(queries, page_size):
+        entry = doc.to_dict()
+        entry["change_id"] = doc.id
+        yield entry
+
+
+def read_snapshot(client, storage, item_id):
+    """
+    Returns the compacted snapshot of an item, or None.
+    """
+    snapshot = client.collection(snapshot_collection(storage)).document(item_id).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+def compaction_horizon(now=None):
+    """
+    Start of the oldest day partition that compaction keeps.
+    """
+    now = as_utc(now or datetime.now(timezone.utc))
+    return (now - timedelta(days=HISTORY_RETENTION_DAYS)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def compact_history(client, storage, before=None):
+    """
+    Folds every uncompacted day partition older than `before` (default: the
+    retention horizon) into per-item snapshots and deletes its change documents.
+    """
+    horizon = as_utc(before) if before else compaction_horizon()
+    cutoff = horizon.strftime(PARTITION_FORMAT)
+    partitions = client.collection(history_collection(storage))
+    snapshots = client.collection(snapshot_collection(storage))
+
+    # Partitions exist only as parents of their `changes`, or once compacted
+    candidates = sorted((ref for ref in partitions.list_documents() if ref.id < cutoff), key=lambda ref: ref.id)
+    compacted = {
+        snapshot.id for snapshot in (client.get_all(candidates) if candidates else [])
+        if snapshot.exists and (snapshot.to_dict() or {}).get("compacted_at")
+    }
+
+    summary = {"partitions": [], "changes": 0, "items": 0}
+    for partition in candidates:
+        if partition.id in compacted:
+            continue
+        changes = list(paged_documents(partition.collection("changes")))
+        item_ids = {doc.get("item_id") for doc in changes}
+        refs = [snapshots.document(item_id) for item_id in item_ids if item_id]
+        states = {snapshot.id: snapshot.to_dict() for snapshot in client.get_all(refs) if snapshot.exists} if refs else {}
+
+        for doc in changes:
+            entry = doc.to_dict()
+            state = states.setdefault(entry["item_id"], {"item": None, "deleted": False, "last_change": ""})
+            if doc.id <= state["last_change"]:
+                continue  # already folded by an interrupted run
+            if entry["operation"] == "delete":
+                state["item"], state["deleted"] = None, True
+            else:
+                item = dict(state["item"] or {})
+                item.update(entry.get("changes") or {})
+                for field in entry.get("previous") or {}:
+                    if field not in (entry.get("changes") or {}):
+                        item.pop(field, None)
+                state["item"], state["deleted"] = item, False
+            state["last_change"] = doc.id
+            state["as_of"] = entry["at"]
+
+        # Snapshots first, then the change documents, then the marker: a crash
+        # in between leaves work that the next run skips or redoes safely.
+        errors = commit_in_batches(client, [("set", snapshots.document(item_id), state) for item_id, state in states.items()])
+        errors += commit_in_batches(client, [("delete", doc.reference, None) for doc in changes])
+        if any(errors):
+            raise next(error for error in errors if error)
+        partition.set({"compacted_at": datetime.now(timezone.utc), "changes": len(changes)})
+
+        summary["partitions"].append(partition.id)
+        summary["changes"] += len(changes)
+        summary["items"] += len(states)
+    return summary
@@ -0,0 +1,143 @@
+import io
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from google.cloud import storage
+
+"""
+Upload pipeline for listing images.
+
+The upload is read in fixed-size chunks into a temporary file, never held in
+memory as a whole, and sent to Cloud Storage as a chunked resumable upload.
+Meanwhile a worker process decodes the photo once from that file and renders
+the WebP variants that listing pages actually show. Decoding and resizing are
+CPU bound, so they run in a process pool and do not hold up the API threads.
+"""
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+GCS_CHUNK_SIZE = 8 * 256 * 1024  # resumable upload chunk; must be a multiple of 256 KiB
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+CACHE_CONTROL = "public, max-age=31536000, immutable"  # every upload gets a fresh path
+
+# name -> (longest side in px, WebP quality)
+IMAGE_VARIANTS = {
+    "thumbnail": (320, 75),
+    "medium": (1024, 80),
+}
+
+_storage_client = None
+_image_pool = None
+_lock = threading.Lock()
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def _bucket():
+    global _storage_client
+    with _lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+    return _storage_client.bucket(os.getenv("BUCKET_NAME"))
+
+
+def _pool():
+    global _image_pool
+    with _lock:
+        if _image_pool is None:
+            # Spawned, not forked: the API process runs gRPC threads that do not survive a fork.
+            _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _image_pool
+
+
+def render_variants(path, variants=IMAGE_VARIANTS):
+    """
+    Decodes the image at `path` and returns {name: WebP bytes} for each variant.
+
+    Runs in the image process pool. Raises ValueError if the file does not
+    decode as an image, including decompression bombs.
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    largest = max(size for size, _ in variants.values())
+    rendered = {}
+    try:
+        with Image.open(path) as image:
+            # JPEG can decode straight at a reduced scale, far cheaper than a full decode.
+            image.draft("RGB", (largest, largest))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+
+        # Largest first, so each smaller variant is resized from the previous one.
+        for name, (size, quality) in sorted(variants.items(), key=lambda entry: -entry[1][0]):
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, "WEBP", quality=quality, method=4)
+            rendered[name] = buffer.getvalue()
+    except Image.DecompressionBombError as e:
+        raise ValueError(f"Image has too many pixels: {e}")
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        # Truncated or corrupt files fail while decoding, not only on open.
+        raise ValueError(f"Not a readable image: {e}")
+    return rendered
+
+
+def upload_listing_image(upload, prefix):
+    """
+    Streams an uploaded image to Cloud Storage under `prefix` and adds its WebP
+    variants. Returns {"original": url, <variant>: url, ...}.
+
+    Raises ImageTooLarge past MAX_IMAGE_BYTES and ValueError for files that
+    do not decode as an image; nothing is left in the bucket when it raises.
+    """
+    extension = os.path.splitext(upload.filename or "")[1].lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,5}", extension):
+        extension = ".jpg"
+    spool = tempfile.NamedTemporaryFile(suffix=extension, delete=False)
+    try:
+        with spool:
+            received = 0
+            while True:
+                chunk = upload.file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if received > MAX_IMAGE_BYTES:
+                    raise ImageTooLarge(f"Image exceeds {MAX_IMAGE_BYTES // (1024 * 1024)} MB")
+                spool.write(chunk)
+
+        # Variants render in a worker process while the original uploads.
+        variants = _pool().submit(render_variants, spool.name)
+
+        bucket = _bucket()
+        base = f"{prefix}/{uuid.uuid4().hex}"
+        original = bucket.blob(f"{base}/original{extension}", chunk_size=GCS_CHUNK_SIZE)
+        original.cache_control = CACHE_CONTROL
+        original.upload_from_filename(spool.name, content_type=upload.content_type or "application/octet-stream")
+        uploaded = [original]
+        try:
+            rendered = variants.result()
+            urls = {"original": original.public_url}
+            for name, data in rendered.items():
+                blob = bucket.blob(f"{base}/{name}.webp")
+                blob.cache_control = CACHE_CONTROL
+                blob.upload_from_string(data, content_type="image/webp")
+                uploaded.append(blob)
+                urls[name] = blob.public_url
+        except BaseException:
+            # Whatever failed (a bad image, the worker, a variant upload), no half-set is left behind.
+            for blob in uploaded:
+                try:
+                    blob.delete()
+                except Exception as e:
+                    print(f"Could not delete {blob.name}: {e}")
+            raise
+    finally:
+        os.unlink(spool.name)
+    return urls
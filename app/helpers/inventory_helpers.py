@@ -0,0 +1,428 @@
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.cloud import firestore
+from app.helpers.search_helpers import field_value
+
+"""
+Firestore access helpers for the inventory collections.
+
+Inventory is split across one collection per storage type. Endpoints that need
+all of them read the collections in parallel on a shared pool and merge the
+documents as they arrive, so a listing costs as long as the slowest collection
+instead of the sum of all of them. Exports page through the collections with
+cursor queries inside the response generator, so memory stays flat however
+large a collection grows and a slow client holds no shared reader. Bulk writes
+are grouped into WriteBatch commits that run side by side.
+
+Lookups go through InventoryQueryPlan, which pushes equality and `in` filters
+down to Firestore and applies only what Firestore cannot answer locally.
+
+Analytics never scan the collections: document counts come from count()
+aggregation queries, and per-category totals from sharded counter documents
+that every write path increments in the same batch as the item itself.
+"""
+
+STORAGE_COLLECTIONS = ("self_stored", "externally_stored")
+
+INVENTORY_READ_WORKERS = int(os.getenv("INVENTORY_READ_WORKERS", "8"))
+INVENTORY_WRITE_WORKERS = int(os.getenv("INVENTORY_WRITE_WORKERS", "4"))
+FIRESTORE_BATCH_LIMIT = 500  # operations per WriteBatch commit
+EXPORT_PAGE_SIZE = int(os.getenv("INVENTORY_EXPORT_PAGE_SIZE", "500"))
+STREAM_BUFFER_SIZE = 1000  # documents held between the readers and the consumer
+
+STATS_COLLECTION = "inventory_stats"
+STATS_SHARDS = 8
+STATS_FIELDS = ("items", "quantity", "value")
+ANALYTICS_CACHE_TTL = float(os.getenv("INVENTORY_ANALYTICS_TTL", "60"))
+
+_read_pool = ThreadPoolExecutor(max_workers=INVENTORY_READ_WORKERS, thread_name_prefix="inventory-read")
+_write_pool = ThreadPoolExecutor(max_workers=INVENTORY_WRITE_WORKERS, thread_name_prefix="inventory-write")
+_DONE = object()
+
+
+def storage_collections(storage_type=None):
+    """
+    Returns the collection names to read: the given storage type, or all of them.
+    """
+    return [storage_type] if storage_type else list(STORAGE_COLLECTIONS)
+
+
+def paged_documents(query, page_size=EXPORT_PAGE_SIZE):
+    """
+    Yields the documents of a query one page at a time, resuming each page
+    after the last document of the previous one.
+    """
+    query = query.order_by("__name__")
+    last = None
+    while True:
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        docs = list(page.stream())
+        yield from docs
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def stream_collections(queries, page_size=None):
+    """
+    Streams `(name, document)` pairs from several Firestore queries read
+    concurrently, in arrival order.
+
+    `queries` maps a name to a collection reference or query. The first read
+    error is re-raised in the consumer once it reaches it; closing the
+    generator early stops the readers.
+
+    With a `page_size` the queries are instead read one after the other, page
+    by page, inside the generator. That is the export path, paced by how fast
+    the client reads, so it gains nothing from concurrency and must not tie
+    up the shared readers.
+    """
+    if page_size:
+        for name, query in queries.items():
+            for doc in paged_documents(query, page_size):
+                yield name, doc
+        return
+
+    arrivals = queue.Queue(maxsize=STREAM_BUFFER_SIZE)
+    closed = threading.Event()
+
+    def hand_over(entry):
+        while not closed.is_set():
+            try:
+                arrivals.put(entry, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(name, query):
+        try:
+            for doc in query.stream():
+                if not hand_over((name, doc)):
+                    return
+        except Exception as e:
+            hand_over((name, e))
+        finally:
+            hand_over((name, _DONE))
+
+    pending = 0
+    for name, query in queries.items():
+        _read_pool.submit(read, name, query)
+        pending += 1
+
+    try:
+        while pending:
+            name, doc = arrivals.get()
+            if doc is _DONE:
+                pending -= 1
+            elif isinstance(doc, Exception):
+                raise doc
+            else:
+                yield name, doc
+    finally:
+        closed.set()
+
+
+def read_collections(client, names, page_size=None):
+    """
+    Streams the documents of the named collections as dicts, read concurrently.
+    """
+    queries = {name: client.collection(name) for name in names}
+    for _, doc in stream_collections(queries, page_size):
+        yield doc.to_dict()
+
+
+FIRESTORE_IN_LIMIT = 30  # values allowed in one `in` filter
+
+
+class InventoryQueryPlan:
+    """
+    Execution plan for an inventory lookup over one or more collections.
+
+    Equality filters, and the multi-valued filter with the fewest values as an
+    `in` filter, are pushed down to Firestore; other multi-valued filters and
+    the `predicates` are checked locally on the returned documents. An `in`
+    list longer than Firestore allows is split into queries run concurrently.
+    With `fields` only those fields are fetched, so local predicates must only
+    read fields in that projection.
+    """
+
+    def __init__(self, collections, filters=None, predicates=(), fields=None):
+        self.collections = list(collections)
+        self.fields = fields
+        self.equals = {}
+        self.any_of = None  # (field, values) pushed down as `in`
+        self.residual = list(predicates)
+        self.empty = False
+
+        multi_valued = []
+        for field, value in (filters or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                values = list(dict.fromkeys(value))
+                if not values:
+                    self.empty = True
+                elif len(values) == 1:
+                    self.equals[field] = values[0]
+                else:
+                    multi_valued.append((field, values))
+            else:
+                self.equals[field] = value
+
+        multi_valued.sort(key=lambda entry: len(entry[1]))
+        for field, values in multi_valued:
+            if self.any_of is None:
+                self.any_of = (field, values)
+            else:
+                allowed = set(values)
+                self.residual.append(lambda item, field=field, allowed=allowed: item.get(field) in allowed)
+
+    def queries(self, client):
+        """
+        Returns the Firestore queries of the plan, keyed by a readable name.
+        """
+        if self.empty:
+            return {}
+        queries = {}
+        for collection in self.collections:
+            query = client.collection(collection)
+            for field, value in self.equals.items():
+                query = query.where(field, "==", value)
+            if self.fields:
+                query = query.select(self.fields)
+            if self.any_of is None:
+                queries[collection] = query
+                continue
+            field, values = self.any_of
+            for start in range(0, len(values), FIRESTORE_IN_LIMIT):
+                queries[f"{collection}:{field}[{start}:]"] = query.where(field, "in", values[start:start + FIRESTORE_IN_LIMIT])
+        return queries
+
+    def execute(self, client):
+        """
+        Streams the matching documents as dicts.
+        """
+        for _, doc in stream_collections(self.queries(client)):
+            item = doc.to_dict()
+            if all(predicate(item) for predicate in self.residual):
+                yield item
+
+
+def ndjson_lines(items):
+    """
+    Encodes dicts as newline-delimited JSON, one line per item.
+    """
+    for item in items:
+        yield json.dumps(item, default=str) + "\n"
+
+
+STOCK_STATUSES = ("in stock", "out of stock")
+
+
+def stock_status(current, quantity):
+    """
+    Returns the item_status for a new quantity. Only flips between the stock
+    states; any other status (sold, reserved, ...) is left as it is.
+    """
+    if current is not None and current not in STOCK_STATUSES:
+        return current
+    return "in stock" if quantity > 0 else "out of stock"
+
+
+def build_inventory_item(name, category, quantity, storage, description, price, item_status="in stock"):
+    """
+    Builds a new inventory document.
+    """
+    return {
+        "name": name,
+        "category": category,
+        "quantity": {
+            "value": quantity,
+            "unit": "kg"  # kg, gm, pound, etc options
+        },
+        "storage": storage,  # self_stored or externally_stored
+        "description": description,
+        "price": {
+            "value": price,
+            "unit": "kg"  # kg, gm, pound, etc options
+        },
+        "ratings": [],  # an empty list for ratings
+        "average_rating": 0.0,  # Initialize average rating to zero
+        "item_status": item_status,  # item status field (in stock, sold, etc)
+    }
+
+
+def commit_in_batches(client, writes, batch_size=FIRESTORE_BATCH_LIMIT):
+    """
+    Commits writes in WriteBatch chunks of at most `batch_size` operations,
+    committing the chunks concurrently.
+
+    Each entry of `writes` is an `(operation, document_ref, data)` tuple, or a
+    list of them that must land in the same batch; `operation` is "set",
+    "merge", "create" (fails if the document exists), "update" or "delete".
+    An "update" or "delete" tuple may carry a fourth element, a write option
+    such as a last-update-time precondition, which fails its chunk when not
+    met. Returns one result per entry, in order: None if it was committed, else
+    the exception that failed its chunk (a chunk is applied atomically, all or
+    nothing).
+    """
+    def commit(chunk):
+        batch = client.batch()
+        for entry in chunk:
+            for operation, doc_ref, data, *option in (entry if isinstance(entry, list) else [entry]):
+                if operation == "delete":
+                    batch.delete(doc_ref, *option)
+                elif operation == "update":
+                    batch.update(doc_ref, data, *option)
+                elif operation == "create":
+                    batch.create(doc_ref, data)
+                else:
+                    batch.set(doc_ref, data, merge=operation == "merge")
+        batch.commit()
+
+    chunks = []
+    chunk, operations = [], 0
+    for position, entry in enumerate(writes):
+        size = len(entry) if isinstance(entry, list) else 1
+        if chunk and operations + size > batch_size:
+            chunks.append(chunk)
+            chunk, operations = [], 0
+        chunk.append(position)
+        operations += size
+    if chunk:
+        chunks.append(chunk)
+
+    errors = [None] * len(writes)
+    futures = {_write_pool.submit(commit, [writes[position] for position in chunk]): chunk for chunk in chunks}
+    for future in as_completed(futures):
+        error = future.exception()
+        if error is not None:
+            for position in futures[future]:
+                errors[position] = error
+    return errors
+
+
+def _category_totals(item):
+    category = str(item.get("category") or "").strip() or "uncategorized"
+    quantity = field_value(item, "quantity")
+    return category, {"items": 1, "quantity": quantity, "value": quantity * field_value(item, "price")}
+
+
+def stats_delta(old_item, new_item):
+    """
+    Returns the per-category change of the counters when `old_item` is replaced
+    by `new_item`; either may be None for a create or a delete.
+    """
+    delta = {}
+    for item, sign in ((old_item, -1), (new_item, 1)):
+        if not item:
+            continue
+        category, amounts = _category_totals(item)
+        totals = delta.setdefault(category, dict.fromkeys(STATS_FIELDS, 0))
+        for field, amount in amounts.items():
+            totals[field] += sign * amount
+    return {category: totals for category, totals in delta.items() if any(totals.values())}
+
+
+def stats_write(client, storage, old_item, new_item):
+    """
+    Returns the counter write to commit along with replacing `old_item` by
+    `new_item` in `storage`, or None if the counters do not change.
+
+    Counters are spread over STATS_SHARDS documents per storage so that busy
+    write paths do not contend on a single document.
+    """
+    delta = stats_delta(old_item, new_item)
+    if not delta:
+        return None
+    shard = client.collection(STATS_COLLECTION).document(f"{storage}-{random.randrange(STATS_SHARDS)}")
+    increments = {
+        category: {field: firestore.Increment(amount) for field, amount in totals.items() if amount}
+        for category, totals in delta.items()
+    }
+    return ("merge", shard, {"storage": storage, "categories": increments})
+
+
+def read_stats(client, storages):
+    """
+    Sums the counter shards into per-category item, quantity and value totals
+    for each storage. Costs STATS_SHARDS reads per storage, whatever its size.
+    """
+    stats = {storage: {} for storage in storages}
+    shards = [
+        client.collection(STATS_COLLECTION).document(f"{storage}-{shard}")
+        for storage in storages for shard in range(STATS_SHARDS)
+    ]
+    for snapshot in client.get_all(shards):
+        if not snapshot.exists:
+            continue
+        data = snapshot.to_dict()
+        categories = stats.get(data.get("storage"))
+        if categories is None:
+            continue
+        for category, amounts in (data.get("categories") or {}).items():
+            totals = categories.setdefault(category, dict.fromkeys(STATS_FIELDS, 0))
+            for field in STATS_FIELDS:
+                totals[field] += amounts.get(field, 0)
+    # Categories whose items all moved away or were deleted net out to zero
+    return {
+        storage: {category: totals for category, totals in categories.items() if any(totals.values())}
+        for storage, categories in stats.items()
+    }
+
+
+def rebuild_stats(client, storage):
+    """
+    Recomputes the counters of `storage` from its documents, replacing the
+    shards. Used to seed the counters and to repair drift.
+    """
+    categories = {}
+    for item in read_collections(client, [storage], page_size=EXPORT_PAGE_SIZE):
+        for category, totals in stats_delta(None, item).items():
+            merged = categories.setdefault(category, dict.fromkeys(STATS_FIELDS, 0))
+            for field, amount in totals.items():
+                merged[field] += amount
+    shards = client.collection(STATS_COLLECTION)
+    batch = client.batch()
+    batch.set(shards.document(f"{storage}-0"), {"storage": storage, "categories": categories})
+    for shard in range(1, STATS_SHARDS):
+        batch.delete(shards.document(f"{storage}-{shard}"))
+    batch.commit()
+    return categories
+
+
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+
+def collection_counts(client, names):
+    """
+    Returns document counts from server-side count() aggregations, run
+    concurrently and cached for ANALYTICS_CACHE_TTL seconds.
+    """
+    now = time.monotonic()
+    counts = {}
+    with _count_cache_lock:
+        for name in names:
+            cached = _count_cache.get(name)
+            if cached is not None and cached[0] > now:
+                counts[name] = cached[1]
+
+    def count(name):
+        return client.collection(name).count(alias="count").get()[0][0].value
+
+    futures = {_read_pool.submit(count, name): name for name in names if name not in counts}
+    for future in as_completed(futures):
+        name = futures[future]
+        counts[name] = future.result()
+        with _count_cache_lock:
+            _count_cache[name] = (time.monotonic() + ANALYTICS_CACHE_TTL, counts[name])
+    return {name: counts[name] for name in names}
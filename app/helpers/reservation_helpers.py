@@ -0,0 +1,350 @@
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore
+from app.helpers.history_helpers import history_write
+from app.helpers.inventory_helpers import STORAGE_COLLECTIONS, stats_write, stock_status
+from app.helpers.search_helpers import field_value, patch_inventory_item
+
+"""
+Stock reservations on inventory items.
+
+An item's `quantity` is the stock on hand and `reserved` the part of it held
+for carts and pending orders, so only `quantity - reserved` can be sold.
+Buyers first take a short-lived hold, which an order later commits (stock
+leaves) or which is released (stock returns) explicitly or when it expires.
+
+Every change to an item's stock is an optimistic, version-checked write: the
+item is read, and the update only applies if the document's update time is
+still the one that was read. On conflict the operation re-reads and retries
+with capped, fully jittered exponential backoff, so concurrent buyers never
+oversell and do not retry in lock step. Within one process, writers of the
+same item also queue on a striped lock, leaving conflicts to cross-process
+races only.
+
+Holds live in `reservations/{hold_id}`. Expired holds are released in batches:
+one stock update per item covers all of its expired holds.
+"""
+
+RESERVATIONS_COLLECTION = "reservations"
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "900"))
+RESERVATION_MAX_ATTEMPTS = int(os.getenv("RESERVATION_MAX_ATTEMPTS", "10"))
+_BACKOFF_BASE_S = 0.02
+_BACKOFF_CAP_S = 1.0
+_RELEASE_CHUNK = 450  # holds per release batch, leaving room for the item update
+
+_CONFLICTS = (google_exceptions.FailedPrecondition, google_exceptions.Aborted, google_exceptions.Conflict)
+
+_item_locks = [threading.Lock() for _ in range(64)]
+_stats_lock = threading.Lock()
+conflict_stats = {"retries": 0, "exhausted": 0}  # this process's version conflicts
+_client = None
+_client_lock = threading.Lock()
+
+
+class ReservationError(Exception):
+    pass
+
+
+class InsufficientStock(ReservationError):
+    pass
+
+
+class HoldNotActive(ReservationError):
+    pass
+
+
+class ReservationConflict(ReservationError):
+    pass
+
+
+class HoldMismatch(ReservationError):
+    pass
+
+
+def default_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = firestore.Client()
+    return _client
+
+
+def available_quantity(item):
+    """
+    Stock that can still be reserved or sold.
+    """
+    return field_value(item, "quantity") - (item.get("reserved") or 0)
+
+
+def _quantity_update(item, quantity):
+    # Keeps the stored shape of `quantity` ({"value", "unit"} or a bare number).
+    if float(quantity).is_integer():
+        quantity = int(quantity)
+    stored = item.get("quantity")
+    value = {**stored, "value": quantity} if isinstance(stored, dict) else quantity
+    return {"quantity": value, "item_status": stock_status(item.get("item_status"), quantity)}
+
+
+def retry_on_conflict(storage, item_id, attempt_once):
+    """
+    Runs `attempt_once()` until its version-checked write goes through.
+    """
+    with _item_locks[hash((storage, item_id)) % len(_item_locks)]:
+        for attempt in range(RESERVATION_MAX_ATTEMPTS):
+            try:
+                return attempt_once()
+            except _CONFLICTS:
+                with _stats_lock:
+                    conflict_stats["retries"] += 1
+                time.sleep(random.uniform(0, min(_BACKOFF_CAP_S, _BACKOFF_BASE_S * 2 ** attempt)))
+    with _stats_lock:
+        conflict_stats["exhausted"] += 1
+    raise ReservationConflict(f"Item {item_id} is too contended, try again")
+
+
+def locate_item(client, item_id):
+    """
+    Returns the storage collection holding `item_id`, or None.
+    """
+    refs = [client.collection(storage).document(item_id) for storage in STORAGE_COLLECTIONS]
+    for snapshot in client.get_all(refs):
+        if snapshot.exists:
+            return snapshot.reference.parent.id
+    return None
+
+
+def reserve(client, storage, item_id, quantity, holder=None, ttl_seconds=RESERVATION_TTL_SECONDS):
+    """
+    Holds `quantity` units of an item for `ttl_seconds` and returns the hold.
+
+    Raises InsufficientStock if fewer units are available, after releasing the
+    item's expired holds once.
+    """
+    if quantity <= 0:
+        raise ValueError("quantity must be positive")
+    item_ref = client.collection(storage).document(item_id)
+    holds = client.collection(RESERVATIONS_COLLECTION)
+
+    def attempt():
+        snapshot = item_ref.get()
+        if not snapshot.exists:
+            raise ReservationError(f"Item {item_id} not found")
+        item = snapshot.to_dict()
+        if available_quantity(item) < quantity:
+            return None
+        now = datetime.now(timezone.utc)
+        hold = {
+            "hold_id": uuid.uuid4().hex,
+            "storage": storage,
+            "item_id": item_id,
+            "quantity": quantity,
+            "holder": holder,
+            "status": "held",
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=ttl_seconds),
+        }
+        reserved = (item.get("reserved") or 0) + quantity
+        batch = client.batch()
+        batch.update(item_ref, {"reserved": reserved}, option=client.write_option(last_update_time=snapshot.update_time))
+        batch.create(holds.document(hold["hold_id"]), hold)
+        batch.commit()
+        patch_inventory_item(storage, item_id, {"reserved": reserved})
+        return hold
+
+    hold = retry_on_conflict(storage, item_id, attempt)
+    if hold is None and release_expired(client, storage, item_id)["released"]:
+        hold = retry_on_conflict(storage, item_id, attempt)
+    if hold is None:
+        raise InsufficientStock(f"Not enough stock of {item_id} for {quantity}")
+    return hold
+
+
+def resize_hold(client, hold_id, quantity):
+    """
+    Changes the quantity of an active hold, reserving or returning only the
+    difference, and returns the hold.
+
+    Raises HoldNotActive if the hold is no longer held, and InsufficientStock
+    if the extra units are not available.
+    """
+    if quantity <= 0:
+        raise ValueError("quantity must be positive")
+    hold_ref = client.collection(RESERVATIONS_COLLECTION).document(hold_id)
+    hold_snapshot = hold_ref.get()
+    if not hold_snapshot.exists:
+        raise HoldNotActive(f"Hold {hold_id} not found")
+    hold = hold_snapshot.to_dict()
+    item_ref = client.collection(hold["storage"]).document(hold["item_id"])
+
+    def attempt():
+        current = hold_ref.get()
+        state = current.to_dict() if current.exists else {}
+        if state.get("status") != "held":
+            raise HoldNotActive(f"Hold {hold_id} is {state.get('status', 'gone')}")
+        if state["expires_at"] <= datetime.now(timezone.utc):
+            raise HoldNotActive(f"Hold {hold_id} has expired")
+        snapshot = item_ref.get()
+        if not snapshot.exists:
+            raise ReservationError(f"Item {hold['item_id']} not found")
+        item = snapshot.to_dict()
+        delta = quantity - state["quantity"]
+        if delta > 0 and available_quantity(item) < delta:
+            return None
+        reserved = max((item.get("reserved") or 0) + delta, 0)
+        batch = client.batch()
+        batch.update(item_ref, {"reserved": reserved}, option=client.write_option(last_update_time=snapshot.update_time))
+        batch.update(hold_ref, {"quantity": quantity}, option=client.write_option(last_update_time=current.update_time))
+        batch.commit()
+        patch_inventory_item(hold["storage"], hold["item_id"], {"reserved": reserved})
+        return {**state, "quantity": quantity}
+
+    resized = retry_on_conflict(hold["storage"], hold["item_id"], attempt)
+    if resized is None and release_expired(client, hold["storage"], hold["item_id"])["released"]:
+        resized = retry_on_conflict(hold["storage"], hold["item_id"], attempt)
+    if resized is None:
+        raise InsufficientStock(f"Not enough stock of {hold['item_id']} for {quantity}")
+    return resized
+
+
+def _settle(client, hold_id, outcome, expect=None):
+    """
+    Commits ("committed") or releases ("released") an active hold. Raises
+    HoldMismatch if the hold does not carry the `expect` field values.
+    """
+    hold_ref = client.collection(RESERVATIONS_COLLECTION).document(hold_id)
+    hold_snapshot = hold_ref.get()
+    if not hold_snapshot.exists:
+        raise HoldNotActive(f"Hold {hold_id} not found")
+    hold = hold_snapshot.to_dict()
+    item_ref = client.collection(hold["storage"]).document(hold["item_id"])
+
+    def attempt():
+        current = hold_ref.get()
+        state = current.to_dict() if current.exists else {}
+        if state.get("status") != "held":
+            raise HoldNotActive(f"Hold {hold_id} is {state.get('status', 'gone')}")
+        if outcome == "committed" and state["expires_at"] <= datetime.now(timezone.utc):
+            raise HoldNotActive(f"Hold {hold_id} has expired")
+        mismatched = [field for field, value in (expect or {}).items() if state.get(field) != value]
+        if mismatched:
+            raise HoldMismatch(f"Hold {hold_id} does not match the {', '.join(mismatched)} given")
+        snapshot = item_ref.get()
+        item = snapshot.to_dict() if snapshot.exists else {}
+        data = {"reserved": max((item.get("reserved") or 0) - state["quantity"], 0)}
+        if outcome == "committed":
+            data.update(_quantity_update(item, field_value(item, "quantity") - state["quantity"]))
+        batch = client.batch()
+        if snapshot.exists:
+            batch.update(item_ref, data, option=client.write_option(last_update_time=snapshot.update_time))
+            if outcome == "committed":
+                # A sale changes the stock on hand: count it and log it like any other update.
+                new_item = {**item, **data}
+                for extra in (stats_write(client, hold["storage"], item, new_item), history_write(client, hold["storage"], hold["item_id"], item, new_item)):
+                    if extra is not None:
+                        operation, doc_ref, extra_data = extra
+                        batch.set(doc_ref, extra_data, merge=operation == "merge")
+        batch.update(hold_ref, {"status": outcome, "settled_at": datetime.now(timezone.utc)}, option=client.write_option(last_update_time=current.update_time))
+        batch.commit()
+        if snapshot.exists:
+            patch_inventory_item(hold["storage"], hold["item_id"], data)
+        return {**state, "status": outcome}
+
+    return retry_on_conflict(hold["storage"], hold["item_id"], attempt)
+
+
+def commit_hold(client, hold_id, expect=None):
+    """
+    Turns an active hold into a sale: the held units leave the stock.
+    `expect` maps hold fields (item_id, quantity, holder...) to the values
+    the sale is for; the hold is only committed if they all match.
+    """
+    return _settle(client, hold_id, "committed", expect)
+
+
+def release_hold(client, hold_id):
+    """
+    Returns the units of an active hold to the stock.
+    """
+    return _settle(client, hold_id, "released")
+
+
+def purchase(client, storage, item_id, quantity, holder=None):
+    """
+    Reserves and immediately commits `quantity` units.
+    """
+    hold = reserve(client, storage, item_id, quantity, holder, ttl_seconds=60)
+    return commit_hold(client, hold["hold_id"])
+
+
+def _release_item_holds(client, storage, item_id, hold_refs, status, expired_only=False):
+    item_ref = client.collection(storage).document(item_id)
+    released = 0
+    for start in range(0, len(hold_refs), _RELEASE_CHUNK):
+        chunk = hold_refs[start:start + _RELEASE_CHUNK]
+
+        def attempt():
+            # Holds are re-read on every attempt: some may have been settled meanwhile.
+            now = datetime.now(timezone.utc)
+            holds = [
+                hold for hold in client.get_all(chunk)
+                if hold.exists and hold.to_dict().get("status") == "held"
+                and (not expired_only or hold.to_dict()["expires_at"] <= now)
+            ]
+            if not holds:
+                return 0
+            snapshot = item_ref.get()
+            item = snapshot.to_dict() if snapshot.exists else {}
+            total = sum(hold.to_dict()["quantity"] for hold in holds)
+            data = {"reserved": max((item.get("reserved") or 0) - total, 0)}
+            batch = client.batch()
+            if snapshot.exists:
+                batch.update(item_ref, data, option=client.write_option(last_update_time=snapshot.update_time))
+            for hold in holds:
+                batch.update(hold.reference, {"status": status, "settled_at": now}, option=client.write_option(last_update_time=hold.update_time))
+            batch.commit()
+            if snapshot.exists:
+                patch_inventory_item(storage, item_id, data)
+            return len(holds)
+
+        released += retry_on_conflict(storage, item_id, attempt)
+    return released
+
+
+def release_holds(client, hold_ids, status="released"):
+    """
+    Releases many active holds, with one stock update per item.
+    """
+    refs = [client.collection(RESERVATIONS_COLLECTION).document(hold_id) for hold_id in hold_ids]
+    by_item = defaultdict(list)
+    for snapshot in (client.get_all(refs) if refs else []):
+        if snapshot.exists and snapshot.to_dict().get("status") == "held":
+            hold = snapshot.to_dict()
+            by_item[(hold["storage"], hold["item_id"])].append(snapshot.reference)
+    released = sum(_release_item_holds(client, storage, item_id, holds, status) for (storage, item_id), holds in by_item.items())
+    return {"released": released}
+
+
+def release_expired(client, storage=None, item_id=None):
+    """
+    Releases every expired hold (optionally of one item), in batches per item.
+
+    Needs a composite index on reservations (status, item_id, expires_at).
+    """
+    query = client.collection(RESERVATIONS_COLLECTION).where("status", "==", "held")
+    if item_id:
+        query = query.where("item_id", "==", item_id)
+    query = query.where("expires_at", "<=", datetime.now(timezone.utc))
+    by_item = defaultdict(list)
+    for snapshot in query.stream():
+        hold = snapshot.to_dict()
+        if storage and hold["storage"] != storage:
+            continue
+        by_item[(hold["storage"], hold["item_id"])].append(snapshot.reference)
+    released = sum(_release_item_holds(client, hold_storage, hold_item, holds, "expired", expired_only=True) for (hold_storage, hold_item), holds in by_item.items())
+    return {"released": released}
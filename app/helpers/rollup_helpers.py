@@ -0,0 +1,202 @@
+import os
+from collections import defaultdict
+from itertools import islice
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+from app.helpers.inventory_helpers import commit_in_batches, paged_documents
+from app.helpers.sensor_helpers import SENSOR_METRICS, SENSORS_COLLECTION, add_ingest_stage, reading_id
+
+"""
+Downsampled sensor history.
+
+Each sensor keeps min/max/sum/count rollups of its readings at three
+resolutions, one document per bucket:
+
+    sensors_data/{sensor_id}/rollups_{tier}/{bucket_id}
+
+where tier is "1m", "1h" or "1d" and the bucket id is the zero-padded epoch
+second the bucket starts at, so a time range is a document-id range. Ingest
+folds each batch into per-bucket partials first and merges those with
+Increment/Minimum/Maximum transforms, so a batch costs one write per touched
+bucket, not per reading.
+
+Range queries read the coarsest tier that still meets the requested
+resolution. A reading replayed after its first batch was stored would be
+counted twice; `rebuild_rollups` recomputes a range from the raw readings.
+"""
+
+# tier -> bucket width in seconds, finest first
+ROLLUP_TIERS = {"1m": 60, "1h": 3600, "1d": 86400}
+RAW_TIER = "raw"
+MAX_POINTS = int(os.getenv("SENSOR_MAX_POINTS", "1500"))
+# Raw readings are only served for ranges up to this long and this many readings;
+# beyond either, the finest rollup tier answers instead.
+MAX_RAW_RANGE = timedelta(seconds=float(os.getenv("SENSOR_MAX_RAW_RANGE_SECONDS", "21600")))
+MAX_RAW_POINTS = int(os.getenv("SENSOR_MAX_RAW_POINTS", "10000"))
+DEFAULT_RANGE = timedelta(hours=24)
+
+
+def rollup_collection(client, sensor_id, tier):
+    return client.collection(SENSORS_COLLECTION).document(sensor_id).collection(f"rollups_{tier}")
+
+
+def bucket_start(at, tier):
+    width = ROLLUP_TIERS[tier]
+    return int(at.timestamp()) // width * width
+
+
+def bucket_id(epoch_seconds):
+    return f"{epoch_seconds:010d}"
+
+
+def _fold(readings):
+    """
+    Returns {(sensor_id, tier, bucket): partial} for a batch of readings.
+    """
+    partials = {}
+    for reading in readings:
+        epoch = int(reading["recorded_at"].timestamp())
+        for tier, width in ROLLUP_TIERS.items():
+            key = (reading["sensor_id"], tier, epoch // width * width)
+            partial = partials.get(key)
+            if partial is None:
+                partials[key] = partial = {"count": 0, **{metric: [reading[metric], reading[metric], 0.0] for metric in SENSOR_METRICS}}
+            partial["count"] += 1
+            for metric in SENSOR_METRICS:
+                value = reading[metric]
+                stats = partial[metric]
+                if value < stats[0]:
+                    stats[0] = value
+                if value > stats[1]:
+                    stats[1] = value
+                stats[2] += value
+    return partials
+
+
+def rollup_writes(client, user_id, readings):
+    """
+    Ingest stage: one merge per touched bucket and tier.
+    """
+    writes = []
+    for (sensor_id, tier, start), partial in _fold(readings).items():
+        data = {
+            "tier": tier,
+            "bucket_start": datetime.fromtimestamp(start, timezone.utc),
+            "count": firestore.Increment(partial["count"]),
+        }
+        for metric in SENSOR_METRICS:
+            low, high, total = partial[metric]
+            data[metric] = {"min": firestore.Minimum(low), "max": firestore.Maximum(high), "sum": firestore.Increment(total)}
+        writes.append(("merge", rollup_collection(client, sensor_id, tier).document(bucket_id(start)), data))
+    return writes
+
+
+add_ingest_stage(rollup_writes)
+
+
+def choose_tier(start, end, resolution=None):
+    """
+    Picks the tier for [start, end). With a `resolution` (seconds between
+    points, at most), the coarsest tier at least that fine, or raw readings
+    if none is and the range is at most MAX_RAW_RANGE (else the finest
+    tier); without one, the finest tier returning at most MAX_POINTS.
+    """
+    if resolution is not None:
+        fitting = [tier for tier, width in ROLLUP_TIERS.items() if width <= resolution]
+        if fitting:
+            return fitting[-1]
+        return RAW_TIER if end - start <= MAX_RAW_RANGE else list(ROLLUP_TIERS)[0]
+    span = (end - start).total_seconds()
+    for tier, width in ROLLUP_TIERS.items():
+        if span / width <= MAX_POINTS:
+            return tier
+    return list(ROLLUP_TIERS)[-1]
+
+
+def _point(doc):
+    data = doc.to_dict()
+    count = data.get("count") or 0
+    point = {"bucket_start": data.get("bucket_start"), "count": count}
+    for metric in SENSOR_METRICS:
+        stats = data.get(metric) or {}
+        point[metric] = {
+            "min": stats.get("min"),
+            "max": stats.get("max"),
+            "avg": stats.get("sum", 0) / count if count else None,
+        }
+    return point
+
+
+def read_range(client, sensor_id, start, end, tier):
+    """
+    Yields the points of one tier in [start, end): rollup buckets (those
+    starting in the range) or, for RAW_TIER, the stored readings.
+    """
+    if tier == RAW_TIER:
+        readings = client.collection(SENSORS_COLLECTION).document(sensor_id).collection("readings")
+        query = readings.where("__name__", ">=", readings.document(reading_id(start))).where("__name__", "<", readings.document(reading_id(end)))
+        for doc in paged_documents(query):
+            yield doc.to_dict()
+        return
+    rollups = rollup_collection(client, sensor_id, tier)
+    first = bucket_start(start, tier)
+    if first < int(start.timestamp()):
+        first += ROLLUP_TIERS[tier]
+    query = rollups.where("__name__", ">=", rollups.document(bucket_id(first))).where("__name__", "<", rollups.document(bucket_id(int(end.timestamp()))))
+    for doc in paged_documents(query):
+        yield _point(doc)
+
+
+def query_sensor_history(client, sensor_id, start=None, end=None, resolution=None):
+    """
+    Returns {"tier", "start", "end", "data"} for a sensor over [start, end)
+    (default: the last DEFAULT_RANGE), read from the coarsest sufficient tier.
+    A range holding more than MAX_RAW_POINTS raw readings is answered from
+    the finest rollup tier instead.
+    """
+    end = end or datetime.now(timezone.utc)
+    start = start or end - DEFAULT_RANGE
+    if start >= end:
+        raise ValueError("start must be before end")
+    tier = choose_tier(start, end, resolution)
+    if tier == RAW_TIER:
+        # Stops paging one reading past the cap.
+        data = list(islice(read_range(client, sensor_id, start, end, tier), MAX_RAW_POINTS + 1))
+        if len(data) <= MAX_RAW_POINTS:
+            return {"tier": tier, "start": start, "end": end, "data": data}
+        tier = list(ROLLUP_TIERS)[0]
+    return {"tier": tier, "start": start, "end": end, "data": list(read_range(client, sensor_id, start, end, tier))}
+
+
+def rebuild_rollups(client, sensor_id, start, end):
+    """
+    Recomputes every tier of a sensor from its raw readings, for the whole
+    days overlapping [start, end). Returns the number of readings folded.
+    """
+    day = ROLLUP_TIERS["1d"]
+    first = bucket_start(start, "1d")
+    last = -(-int(end.timestamp()) // day) * day
+    readings = []
+    for document in read_range(client, sensor_id, datetime.fromtimestamp(first, timezone.utc), datetime.fromtimestamp(last, timezone.utc), RAW_TIER):
+        if "recorded_at" in document:
+            readings.append({"sensor_id": sensor_id, "recorded_at": document["recorded_at"], **{metric: document[metric] for metric in SENSOR_METRICS}})
+    partials = _fold(readings)
+
+    writes = []
+    for tier, width in ROLLUP_TIERS.items():
+        rollups = rollup_collection(client, sensor_id, tier)
+        existing = rollups.where("__name__", ">=", rollups.document(bucket_id(first))).where("__name__", "<", rollups.document(bucket_id(last)))
+        # Buckets that no longer have readings are deleted, the rest overwritten.
+        for doc in paged_documents(existing):
+            if (sensor_id, tier, int(doc.id)) not in partials:
+                writes.append(("delete", doc.reference, None))
+    for (_, tier, bucket), partial in partials.items():
+        data = {"tier": tier, "bucket_start": datetime.fromtimestamp(bucket, timezone.utc), "count": partial["count"]}
+        for metric in SENSOR_METRICS:
+            low, high, total = partial[metric]
+            data[metric] = {"min": low, "max": high, "sum": total}
+        writes.append(("set", rollup_collection(client, sensor_id, tier).document(bucket_id(bucket)), data))
+    errors = [error for error in commit_in_batches(client, writes) if error]
+    if errors:
+        raise errors[0]
+    return len(readings)
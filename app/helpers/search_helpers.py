@@ -0,0 +1,963 @@
+import base64
+import heapq
+import json
+import math
+import operator
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict
+import numpy as np
+from firebase_admin import db
+from app.helpers.geo_helpers import locate_pincodes
+from app.helpers.text_helpers import TrigramIndex, normalize_terms, query_terms
+
+"""
+In-process search structures for the marketplace.
+
+The marketplace used to download the whole `inventory` node on every request and
+filter it in Python. Instead we keep one copy of the catalog in memory, bootstrap
+it once from the Realtime Database `inventory` node and keep it fresh through a
+listener on that node, so a lookup only touches the postings it needs. The
+Firestore inventory write paths publish their listings to the same node, keyed
+by `{storage}:{item_id}`, which keeps every process's index (and a restarted
+one) in step with them; writes RTDB refuses are retried in the background.
+"""
+
+INDEXED_TEXT_FIELDS = ("name", "description")
+INDEXED_EXACT_FIELDS = ("category", "farm", "pincode")
+
+
+def normalize_value(value):
+    """
+    Normalizes an exact-match field (category, farm, pincode) for lookups.
+    """
+    if value is None:
+        return None
+    return str(value).strip().lower()
+
+
+def field_value(item, field):
+    """
+    Returns a numeric listing field. Price and quantity are stored either as
+    `{"value": x, "unit": ...}` or as a bare number, depending on the writer.
+    """
+    value = item.get(field)
+    if isinstance(value, dict):
+        value = value.get("value")
+    try:
+        return float(value) if value is not None else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def is_in_stock(item):
+    return item.get("item_status") == "in stock"
+
+
+# Upper bounds (exclusive) of the price bands shown as facets; the last band is open.
+PRICE_BANDS = (20, 50, 100, 500)
+FACET_FIELDS = ("category", "farm", "pincode", "price_band")
+
+
+def price_band(item):
+    """
+    Returns the price band label of a listing, e.g. "20-50" or "500+".
+    """
+    price = field_value(item, "price")
+    low = 0
+    for high in PRICE_BANDS:
+        if price < high:
+            return f"{low}-{high}"
+        low = high
+    return f"{low}+"
+
+
+class FacetCounts:
+    """
+    Per-facet value counters (category, farm, pincode, price band).
+    """
+
+    def __init__(self):
+        self.counts = {facet: Counter() for facet in FACET_FIELDS}
+
+    def add(self, item, delta=1):
+        for facet in FACET_FIELDS:
+            value = price_band(item) if facet == "price_band" else normalize_value(item.get(facet))
+            if not value:
+                continue
+            counter = self.counts[facet]
+            counter[value] += delta
+            if counter[value] <= 0:
+                del counter[value]
+
+    def as_dict(self):
+        return {facet: dict(counter.most_common()) for facet, counter in self.counts.items()}
+
+
+NUMERIC_COLUMNS = ("price", "quantity", "average_rating")
+
+
+class ColumnStore:
+    """
+    Columnar copy of the numeric listing fields, one NumPy row per listing.
+
+    Lets large candidate sets be filtered with vectorized comparisons instead
+    of per-listing dict lookups. Rows of removed listings are recycled. The
+    same fields are also kept as a plain tuple per listing
+    (`NUMERIC_COLUMNS` values followed by the in-stock flag) for the row path.
+    """
+
+    def __init__(self, capacity=1024):
+        self.values = {}
+        self.rows = {}
+        self.free = []
+        self.size = 0
+        self.columns = {name: np.zeros(capacity) for name in NUMERIC_COLUMNS}
+        self.in_stock = np.zeros(capacity, dtype=bool)
+
+    def _grow(self):
+        capacity = len(self.in_stock) * 2
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity)
+            grown[:len(column)] = column
+            self.columns[name] = grown
+        grown = np.zeros(capacity, dtype=bool)
+        grown[:len(self.in_stock)] = self.in_stock
+        self.in_stock = grown
+
+    def set(self, item_id, item):
+        row = self.rows.get(item_id)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                if self.size == len(self.in_stock):
+                    self._grow()
+                row = self.size
+                self.size += 1
+            self.rows[item_id] = row
+        values = tuple(field_value(item, name) for name in NUMERIC_COLUMNS) + (is_in_stock(item),)
+        self.values[item_id] = values
+        for position, name in enumerate(NUMERIC_COLUMNS):
+            self.columns[name][row] = values[position]
+        self.in_stock[row] = values[-1]
+
+    def discard(self, item_id):
+        self.values.pop(item_id, None)
+        row = self.rows.pop(item_id, None)
+        if row is not None:
+            self.in_stock[row] = False
+            self.free.append(row)
+
+    def rows_for(self, item_ids):
+        return np.fromiter(map(self.rows.__getitem__, item_ids), dtype=np.intp, count=len(item_ids))
+
+
+class InventoryIndex:
+    """
+    Inverted index over inventory listings.
+
+    - `terms` maps a term from name/description to the ids containing it, and
+      `vocabulary` indexes those terms by trigram for typo-tolerant lookups.
+    - `fields` maps category, farm and pincode values to the ids having them.
+    - `facets` counts the in-stock listings per facet value, maintained on
+      every write so unfiltered facet counts never need a scan.
+    - `columns` holds price, quantity, rating and stock status column-wise.
+    - `in_stock` is a materialized view of the in-stock listings keyed by
+      category ("" for uncategorized), with `in_stock_all` as its union, so
+      marketplace reads can start from in-stock ids and never visit sold-out
+      listings.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.items = {}
+        self.terms = defaultdict(set)
+        self.vocabulary = TrigramIndex()
+        self.fields = {field: defaultdict(set) for field in INDEXED_EXACT_FIELDS}
+        self.facets = FacetCounts()
+        self.columns = ColumnStore()
+        self.in_stock = defaultdict(set)
+        self.in_stock_all = set()
+        self.listeners = []
+        self._sorted_terms = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def load(self, items):
+        """
+        Replaces the whole index with a `{item_id: item}` snapshot.
+        """
+        with self._lock:
+            self.items = {}
+            self.terms = defaultdict(set)
+            self.vocabulary = TrigramIndex()
+            self.fields = {field: defaultdict(set) for field in INDEXED_EXACT_FIELDS}
+            self.facets = FacetCounts()
+            self.columns = ColumnStore()
+            self.in_stock = defaultdict(set)
+            self.in_stock_all = set()
+            self._sorted_terms = None
+            for item_id, item in (items or {}).items():
+                if isinstance(item, dict):
+                    self._add(item_id, item)
+            self._notify(None, None)
+
+    def add_listener(self, listener):
+        """
+        Registers `listener(old_item, new_item)`, called after every change.
+        Both are None when the whole index was reloaded.
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, old_item, new_item):
+        for listener in self.listeners:
+            listener(old_item, new_item)
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def upsert(self, item_id, item):
+        """
+        Adds a listing or replaces an existing one.
+        """
+        with self._lock:
+            old_item = self._discard(item_id)
+            if isinstance(item, dict):
+                self._add(item_id, item)
+            else:
+                item = None
+            self._notify(old_item, item)
+
+    def patch(self, item_id, data):
+        """
+        Merges a partial update into an indexed listing. Unknown ids are
+        ignored: a partial update alone is not a listing.
+        """
+        with self._lock:
+            item = self.items.get(item_id)
+            if item is None:
+                return
+            self.upsert(item_id, {**item, **data})
+
+    def remove(self, item_id):
+        with self._lock:
+            old_item = self._discard(item_id)
+            if old_item is not None:
+                self._notify(old_item, None)
+
+    def _add(self, item_id, item):
+        self.items[item_id] = item
+        self.columns.set(item_id, item)
+        for token in self._item_tokens(item):
+            if token not in self.terms:
+                self._sorted_terms = None
+                self.vocabulary.add(token)
+            self.terms[token].add(item_id)
+        for field in INDEXED_EXACT_FIELDS:
+            value = normalize_value(item.get(field))
+            if value:
+                self.fields[field][value].add(item_id)
+        if is_in_stock(item):
+            self.facets.add(item)
+            self.in_stock[normalize_value(item.get("category")) or ""].add(item_id)
+            self.in_stock_all.add(item_id)
+
+    def _discard(self, item_id):
+        item = self.items.pop(item_id, None)
+        if item is None:
+            return None
+        self.columns.discard(item_id)
+        for token in self._item_tokens(item):
+            postings = self.terms.get(token)
+            if postings is not None:
+                postings.discard(item_id)
+                if not postings:
+                    del self.terms[token]
+                    self.vocabulary.remove(token)
+                    self._sorted_terms = None
+        for field in INDEXED_EXACT_FIELDS:
+            value = normalize_value(item.get(field))
+            postings = self.fields[field].get(value)
+            if postings is not None:
+                postings.discard(item_id)
+                if not postings:
+                    del self.fields[field][value]
+        if is_in_stock(item):
+            self.facets.add(item, -1)
+            category = normalize_value(item.get("category")) or ""
+            listed = self.in_stock.get(category)
+            if listed is not None:
+                listed.discard(item_id)
+                if not listed:
+                    del self.in_stock[category]
+            self.in_stock_all.discard(item_id)
+        return item
+
+    @staticmethod
+    def _item_tokens(item):
+        tokens = set()
+        for field in INDEXED_TEXT_FIELDS:
+            tokens.update(normalize_terms(item.get(field)))
+        return tokens
+
+    def _prefix_postings(self, prefix):
+        """
+        Returns the ids of every listing with a token starting with `prefix`.
+        """
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.terms)
+        terms = self._sorted_terms
+        matches = set()
+        position = bisect_left(terms, prefix)
+        while position < len(terms) and terms[position].startswith(prefix):
+            matches |= self.terms[terms[position]]
+            position += 1
+        return matches
+
+    def _term_postings(self, alternatives):
+        """
+        Returns the ids matching any alternative of one query word, either as a
+        prefix of an indexed term or within the word's typo budget of one.
+        """
+        matches = set()
+        for term in alternatives:
+            matches |= self._prefix_postings(term)
+            for similar in self.vocabulary.similar(term):
+                matches |= self.terms[similar]
+        return matches
+
+    def pincodes(self):
+        """
+        Returns every distinct (normalized) pincode that has a listing.
+        """
+        with self._lock:
+            return list(self.fields["pincode"])
+
+    def in_stock_ids(self, category=None):
+        """
+        Reads the in-stock view, optionally for one category.
+        """
+        with self._lock:
+            if category:
+                return set(self.in_stock.get(normalize_value(category), ()))
+            return set(self.in_stock_all)
+
+    def search(self, query=None, category=None, farm=None, pincode=None, pincodes=None, in_stock=False):
+        """
+        Returns the ids matching every given constraint.
+
+        Each query word is normalized like the indexed text (see text_helpers)
+        and matched as a prefix of a name/description term, which keeps the
+        behaviour of the old `start_at(query)` lookups, or as a close misspelling
+        of one. `pincodes` limits
+        the result to listings in any of the given pincodes. With `in_stock` the
+        search starts from the in-stock view, so sold-out listings are never
+        considered. Constraints left as None are ignored; with no constraints
+        every (in-stock) listing matches.
+        """
+        with self._lock:
+            postings = []
+            if in_stock:
+                if category:
+                    postings.append(self.in_stock.get(normalize_value(category), set()))
+                else:
+                    postings.append(self.in_stock_all)
+            elif category:
+                postings.append(self.fields["category"].get(normalize_value(category), set()))
+            for field, value in (("farm", farm), ("pincode", pincode)):
+                if value:
+                    postings.append(self.fields[field].get(normalize_value(value), set()))
+            if pincodes is not None:
+                nearby = set()
+                for value in pincodes:
+                    nearby |= self.fields["pincode"].get(normalize_value(value), set())
+                postings.append(nearby)
+            for alternatives in query_terms(query):
+                postings.append(self._term_postings(alternatives))
+
+            if not postings:
+                return set(self.items)
+            # Intersect smallest first so the working set only shrinks.
+            postings.sort(key=len)
+            result = set(postings[0])
+            for other in postings[1:]:
+                if not result:
+                    break
+                result &= other
+            return result
+
+    def lookup(self, item_ids):
+        """
+        Resolves ids to listings, skipping ids removed in the meantime.
+        """
+        with self._lock:
+            return [self.items[item_id] for item_id in item_ids if item_id in self.items]
+
+    def facet_counts(self):
+        """
+        Returns the facet counts over every in-stock listing.
+        """
+        with self._lock:
+            return self.facets.as_dict()
+
+    def entries(self, item_ids):
+        """
+        Like `lookup`, but returns `(item_id, item)` pairs.
+        """
+        with self._lock:
+            return [(item_id, self.items[item_id]) for item_id in item_ids if item_id in self.items]
+
+
+inventory_index = InventoryIndex()
+
+_index_ready = threading.Event()
+_index_wait_expired = threading.Event()
+_index_lock = threading.Lock()
+_index_listener = None
+
+
+class IndexUnavailable(Exception):
+    """
+    The listener has not delivered the catalog snapshot yet.
+    """
+
+
+def _apply_inventory_put(path, data):
+    # Returns the ids of the listings the event touched.
+    parts = [part for part in path.split("/") if part]
+    if not parts:
+        inventory_index.load(data or {})
+        return list(data or {})
+    item_id = parts[0]
+    if len(parts) == 1:
+        if data is None:
+            inventory_index.remove(item_id)
+        else:
+            inventory_index.upsert(item_id, data)
+        return [item_id]
+
+    # A nested field of a listing changed: rebuild the listing locally.
+    item = dict(inventory_index.get(item_id) or {})
+    node = item
+    for key in parts[1:-1]:
+        child = node.get(key)
+        child = dict(child) if isinstance(child, dict) else {}
+        node[key] = child
+        node = child
+    if data is None:
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = data
+    inventory_index.upsert(item_id, item)
+    return [item_id]
+
+
+def _on_inventory_event(event):
+    """
+    Realtime Database listener keeping the index in sync with `inventory`.
+    """
+    touched = []
+    if event.event_type == "put":
+        touched = _apply_inventory_put(event.path, event.data)
+    elif event.event_type == "patch":
+        base = event.path.rstrip("/")
+        for key, value in (event.data or {}).items():
+            touched.extend(_apply_inventory_put(f"{base}/{key}", value))
+    _index_ready.set()
+    # Geocode new pincodes now, so radius searches never have to.
+    locate_pincodes(normalize_value(item.get("pincode")) for item in inventory_index.lookup(touched))
+
+
+def start_inventory_index():
+    """
+    Starts the listener that bootstraps and then follows the index, once.
+    Does not wait for the catalog snapshot.
+    """
+    global _index_listener
+    with _index_lock:
+        if _index_listener is None:
+            _index_listener = db.reference("inventory").listen(_on_inventory_event)
+
+
+def ensure_inventory_index(timeout=30):
+    """
+    Returns the index once the listener delivered the catalog snapshot.
+
+    The listener's first event carries the full `inventory` snapshot, so the
+    catalog is downloaded exactly once per process; later events are deltas.
+    Blocks for up to `timeout` seconds the first time only: once a wait has
+    run out, callers get IndexUnavailable at once until the snapshot arrives.
+    """
+    if _index_ready.is_set():
+        return inventory_index
+    start_inventory_index()
+    if _index_wait_expired.is_set() or not _index_ready.wait(timeout):
+        _index_wait_expired.set()
+        raise IndexUnavailable("The marketplace index is still loading.")
+    return inventory_index
+
+
+PUBLISH_RETRY_SECONDS = float(os.getenv("MARKETPLACE_PUBLISH_RETRY_SECONDS", "5"))
+
+# Listing writes RTDB refused, per listing key, oldest first, until a retry lands.
+_publish_backlog = OrderedDict()
+_publish_lock = threading.Lock()
+_publish_retry = None
+
+
+def listing_key(storage, item_id):
+    """
+    Key of a listing under `inventory`: item ids are only unique within their
+    storage collection.
+    """
+    return f"{storage}:{item_id}"
+
+
+def pending_listing_publishes():
+    """
+    Returns how many listings have writes waiting to reach the index.
+    """
+    with _publish_lock:
+        return len(_publish_backlog)
+
+
+def _defer_publishes(key, writes):
+    global _publish_retry
+    with _publish_lock:
+        _publish_backlog[key] = writes + _publish_backlog.get(key, [])
+        if _publish_retry is None:
+            _publish_retry = threading.Thread(target=_retry_publishes, name="listing-publish-retry", daemon=True)
+            _publish_retry.start()
+
+
+def _retry_publishes():
+    while True:
+        time.sleep(PUBLISH_RETRY_SECONDS)
+        with _publish_lock:
+            keys = list(_publish_backlog)
+        for key in keys:
+            while True:
+                with _publish_lock:
+                    writes = _publish_backlog.get(key)
+                    if not writes:
+                        _publish_backlog.pop(key, None)
+                        break
+                    write = writes[0]
+                try:
+                    write(db.reference("inventory").child(key))
+                except Exception as e:
+                    print(f"Could not publish listing {key}, retrying in {PUBLISH_RETRY_SECONDS}s: {e}")
+                    break
+                with _publish_lock:
+                    writes.pop(0)
+
+
+def _publish_listing(key, write):
+    # The index of every process follows `inventory` through its listener, so
+    # write paths publish there instead of touching this process's index.
+    # A listing with writes still waiting queues behind them, keeping its order.
+    with _publish_lock:
+        if key in _publish_backlog:
+            _publish_backlog[key].append(write)
+            return
+    try:
+        write(db.reference("inventory").child(key))
+    except Exception as e:
+        print(f"Could not publish listing {key}, retrying in {PUBLISH_RETRY_SECONDS}s: {e}")
+        _defer_publishes(key, [write])
+
+
+def _set_listing(item):
+    return lambda ref: ref.set(item)
+
+
+def index_inventory_item(storage, item_id, item):
+    """
+    Hook for inventory write paths: publishes a created or replaced listing.
+    """
+    _publish_listing(listing_key(storage, item_id), _set_listing(item))
+
+
+def index_inventory_items(items):
+    """
+    Hook for bulk write paths: publishes `{(storage, item_id): item}` listings
+    in one update.
+    """
+    listings = {listing_key(storage, item_id): item for (storage, item_id), item in items.items()}
+    with _publish_lock:
+        queued = [key for key in listings if key in _publish_backlog]
+        for key in queued:
+            _publish_backlog[key].append(_set_listing(listings.pop(key)))
+    if not listings:
+        return
+    try:
+        db.reference("inventory").update(listings)
+    except Exception as e:
+        print(f"Could not publish {len(listings)} listings, retrying in {PUBLISH_RETRY_SECONDS}s: {e}")
+        for key, item in listings.items():
+            _defer_publishes(key, [_set_listing(item)])
+
+
+def patch_inventory_item(storage, item_id, data):
+    """
+    Hook for inventory write paths: publishes a partial listing update.
+    Listings that were never published are left alone.
+    """
+    def merge(current):
+        return {**current, **data} if isinstance(current, dict) else current
+
+    _publish_listing(listing_key(storage, item_id), lambda ref: ref.transaction(merge))
+
+
+def unindex_inventory_item(storage, item_id):
+    """
+    Hook for inventory write paths: withdraws a deleted listing.
+    """
+    _publish_listing(listing_key(storage, item_id), lambda ref: ref.delete())
+
+
+MARKETPLACE_CACHE_SIZE = int(os.getenv("MARKETPLACE_CACHE_SIZE", "2048"))
+MARKETPLACE_CACHE_TTL = float(os.getenv("MARKETPLACE_CACHE_TTL", "60"))
+
+
+class QueryCache:
+    """
+    LRU + TTL cache of marketplace query results.
+
+    Every entry is filed under the (category, pincode) constraint of its query,
+    None standing for "any". A write to a listing in category C and pincode P
+    can only change queries filed under (C, P), (C, None), (None, P) or
+    (None, None), so only those entries are dropped. Radius queries are filed
+    with pincode None, as any pincode may fall inside the circle.
+    """
+
+    def __init__(self, max_entries=MARKETPLACE_CACHE_SIZE, ttl=MARKETPLACE_CACHE_TTL):
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, scope, value)
+        self._scopes = defaultdict(set)  # (category, pincode) -> keys
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self):
+        """
+        Returns a token to pass to `put`; results computed while an
+        invalidation happened are then not cached.
+        """
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                self._drop(key)
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value, category=None, pincode=None, generation=None):
+        scope = (normalize_value(category) or None, normalize_value(pincode) or None)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, scope, value)
+            self._scopes[scope].add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._scopes.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._scopes[entry[1]]
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._scopes.clear()
+            self._generation += 1
+
+    def invalidate_item(self, old_item, new_item):
+        """
+        Index listener: drops the entries a listing change can affect.
+        """
+        if old_item is None and new_item is None:
+            self.clear()
+            return
+        categories = {None}
+        pincodes = {None}
+        for item in (old_item, new_item):
+            if item is not None:
+                categories.add(normalize_value(item.get("category")) or None)
+                pincodes.add(normalize_value(item.get("pincode")) or None)
+        with self._lock:
+            self._generation += 1
+            for category in categories:
+                for pincode in pincodes:
+                    for key in list(self._scopes.get((category, pincode), ())):
+                        self._drop(key)
+                        self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+query_cache = QueryCache()
+inventory_index.add_listener(query_cache.invalidate_item)
+
+
+def query_cache_key(request):
+    """
+    Normalizes a MarketplaceQueryRequest into a cache key, so requests that
+    differ only in case, word order or filter order share an entry.
+    """
+    words = sorted(" ".join(sorted(alternatives)) for alternatives in query_terms(request.query))
+    normalized = {
+        "query": words,
+        "category": normalize_value(request.category),
+        "farm": normalize_value(request.farm),
+        "pincode": normalize_value(request.pincode),
+        "radius": request.radius,
+        "filters": sorted((request.filters or {}).items()),
+        "sorted_by": request.sorted_by,
+        "limit": request.limit,
+        "cursor": request.cursor,
+    }
+    return json.dumps(normalized, sort_keys=True, default=str)
+
+# sorted_by -> (listing field, descending)
+SORT_FIELDS = {
+    "ratings": ("average_rating", True),
+    "price": ("price", False),
+    "quantity": ("quantity", False),
+}
+
+DEFAULT_PAGE_SIZE = 20
+
+
+def encode_cursor(sorted_by, value, item_id):
+    """
+    Packs the position after the last returned listing into an opaque token.
+    """
+    payload = json.dumps([sorted_by, value, item_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sorted_by):
+    """
+    Unpacks a cursor token. Raises ValueError if it is malformed or was issued
+    for a different sort order.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, value, item_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sorted_by or not isinstance(item_id, str):
+        raise ValueError("Cursor does not match the requested sort order")
+    # Sorted pages carry the last sort value, unsorted ones none.
+    if sorted_by in SORT_FIELDS:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError("Invalid cursor")
+    elif value is not None:
+        raise ValueError("Invalid cursor")
+    return value, item_id
+
+
+def paginate(entries, sorted_by=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+    """
+    Returns one page of `(item_id, item)` entries and the cursor for the next one.
+
+    Pages are ordered by (sort key, item id). The first page is a heap-based
+    top-k selection; later pages apply the keyset condition "strictly after the
+    cursor" before selecting, so no page ever sorts the full result set.
+    Unknown or missing `sorted_by` orders by item id only.
+    """
+    field, descending = SORT_FIELDS.get(sorted_by, (None, False))
+
+    if field is None:
+        def sort_key(entry):
+            return ("", entry[0])
+    elif descending:
+        def sort_key(entry):
+            return (-field_value(entry[1], field), entry[0])
+    else:
+        def sort_key(entry):
+            return (field_value(entry[1], field), entry[0])
+
+    if cursor:
+        value, after_id = decode_cursor(cursor, sorted_by)
+        after = ("", after_id) if field is None else (-value if descending else value, after_id)
+        entries = (entry for entry in entries if sort_key(entry) > after)
+
+    page = heapq.nsmallest(limit + 1, entries, key=sort_key)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last_id, last_item = page[-1]
+        last_value = field_value(last_item, field) if field else None
+        next_cursor = encode_cursor(sorted_by, last_value, last_id)
+    return page, next_cursor
+
+
+# MarketplaceQueryRequest.filters key -> (listing field, comparison)
+RANGE_FILTERS = {
+    "min_price": ("price", ">="),
+    "max_price": ("price", "<="),
+    "min_quantity": ("quantity", ">="),
+    "max_quantity": ("quantity", "<="),
+    "rating_threshold": ("average_rating", ">="),
+}
+
+# Candidate sets at least this large are filtered on the NumPy columns.
+COLUMNAR_THRESHOLD = 1000
+
+# Number of candidates sampled to estimate each clause's selectivity.
+_SELECTIVITY_SAMPLE = 64
+
+
+_COMPARISONS = {">=": operator.ge, "<=": operator.le}
+
+
+def _clause(position, op, bound, rest):
+    # One clause of a fused predicate over a value tuple, followed by `rest`.
+    # The comparisons are spelled out: an operator call per clause would cost more.
+    if rest is None:
+        if op is None:
+            return lambda v: bool(v[position])
+        if op == ">=":
+            return lambda v: v[position] >= bound
+        return lambda v: v[position] <= bound
+    if op is None:
+        return lambda v: bool(v[position]) and rest(v)
+    if op == ">=":
+        return lambda v: v[position] >= bound and rest(v)
+    return lambda v: v[position] <= bound and rest(v)
+
+
+class CompiledFilter:
+    """
+    A marketplace request's filters fused into a single predicate.
+
+    The range filters plus the in-stock check are turned into one chain of
+    closures over the index's per-listing value tuples, so each candidate is
+    tested in one pass with short-circuiting. Clauses are ordered
+    by selectivity, estimated on a sample of the candidates, so the clause
+    rejecting the most listings runs first. Large candidate sets take the
+    columnar path instead.
+    """
+
+    _IN_STOCK = len(NUMERIC_COLUMNS)
+
+    def __init__(self, filters=None):
+        self.clauses = []
+        for key, bound in (filters or {}).items():
+            if key not in RANGE_FILTERS:
+                continue
+            if isinstance(bound, bool) or not isinstance(bound, (int, float)):
+                raise ValueError(f"Filter '{key}' must be a number")
+            field, op = RANGE_FILTERS[key]
+            self.clauses.append((field, op, float(bound)))
+
+    def _terms(self):
+        # (position in the value tuple, comparison, bound); the stock flag has no bound
+        terms = [(self._IN_STOCK, None, None)]
+        for field, op, bound in self.clauses:
+            terms.append((NUMERIC_COLUMNS.index(field), op, bound))
+        return terms
+
+    @staticmethod
+    def _term_test(term, v):
+        position, op, bound = term
+        if op is None:
+            return bool(v[position])
+        return _COMPARISONS[op](v[position], bound)
+
+    def predicate(self, sample_values=()):
+        """
+        Builds the fused predicate `value tuple -> bool`, most selective clause first.
+        """
+        terms = self._terms()
+        sample = list(sample_values)
+        if len(terms) > 1 and sample:
+            pass_rate = {term: sum(1 for v in sample if self._term_test(term, v)) for term in terms}
+            terms.sort(key=lambda term: pass_rate[term])
+
+        # A chain of closures, each testing one clause and calling the next:
+        # the first failing clause ends the test.
+        test = None
+        for position, op, bound in reversed(terms):
+            test = _clause(position, op, bound, test)
+        return test
+
+    def apply_rows(self, index, item_ids, facet_counts=None):
+        """
+        Row path: evaluates the fused predicate over the candidates' value tuples.
+        """
+        values = index.columns.values
+        items = index.items
+        step = max(len(item_ids) // _SELECTIVITY_SAMPLE, 1)
+        test = self.predicate(values[item_id] for item_id in item_ids[::step][:_SELECTIVITY_SAMPLE])
+        matched = [(item_id, items[item_id]) for item_id in item_ids if test(values[item_id])]
+        if facet_counts is not None:
+            for _, item in matched:
+                facet_counts.add(item)
+        return matched
+
+    def apply_columns(self, index, item_ids):
+        """
+        Columnar path: evaluates every clause as a vectorized mask.
+        """
+        ids = list(item_ids)
+        columns = index.columns
+        rows = columns.rows_for(ids)
+        mask = columns.in_stock[rows]
+        for field, op, bound in self.clauses:
+            values = columns.columns[field][rows]
+            mask &= _COMPARISONS[op](values, bound)
+        return [ids[position] for position in np.flatnonzero(mask).tolist()]
+
+    def select(self, index, item_ids, facet_counts=None):
+        """
+        Returns the in-stock `(item_id, item)` entries among `item_ids` that pass
+        every filter, picking the row or columnar path by candidate count.
+        Matches are also added to `facet_counts`.
+        """
+        with index._lock:
+            item_ids = [item_id for item_id in item_ids if item_id in index.items]
+            if len(item_ids) < COLUMNAR_THRESHOLD:
+                return self.apply_rows(index, item_ids, facet_counts)
+            matched = index.entries(self.apply_columns(index, item_ids))
+            if facet_counts is not None:
+                for _, item in matched:
+                    facet_counts.add(item)
+            return matched
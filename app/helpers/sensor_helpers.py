@@ -0,0 +1,186 @@
+import json
+import math
+import os
+from datetime import datetime, timezone
+import msgpack
+from app.helpers.inventory_helpers import commit_in_batches
+
+"""
+Sensor reading ingestion.
+
+Field gateways buffer readings while offline and replay them in bulk, so the
+ingest path takes whole arrays of readings, as JSON or as a msgpack frame, and
+writes them in WriteBatch chunks instead of one request and one `.add()` each.
+
+A reading is stored at `sensors_data/{sensor_id}/readings/{reading_id}`, where
+the id is the zero-padded microsecond timestamp of the reading. Ids therefore
+sort by time, and a gateway replaying a batch it is unsure about overwrites the
+same documents instead of duplicating them.
+
+Derived state (rollups, diagnostics, alerts, ...) is kept up to date by ingest
+stages: functions registered with `add_ingest_stage` that see every batch of
+readings once it is stored and return the extra writes it calls for. Those
+writes are not idempotent: the rollups and diagnostics add a replayed reading
+to their counters again. A stage failure is therefore reported alongside the
+stored readings rather than failing the batch, which would invite a replay;
+the rebuild helpers of the affected stage repair its counters.
+"""
+
+SENSORS_COLLECTION = "sensors_data"
+SENSOR_METRICS = ("temperature", "humidity", "soil_moisture")
+# Field order of a reading sent as an array instead of an object.
+PACKED_READING_FIELDS = ("sensor_id", "timestamp") + SENSOR_METRICS
+MAX_BATCH_READINGS = int(os.getenv("SENSOR_MAX_BATCH_READINGS", "10000"))
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+_ingest_stages = []
+
+
+class BatchTooLarge(ValueError):
+    pass
+
+
+def parse_timestamp(value):
+    """
+    Returns a reading timestamp (ISO 8601 string, epoch seconds or datetime)
+    as an aware UTC datetime.
+    """
+    if isinstance(value, datetime):
+        at = value
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            at = datetime.fromtimestamp(value, timezone.utc)
+        except (OverflowError, OSError):
+            raise ValueError(f"timestamp {value!r} is out of range")
+    elif isinstance(value, str):
+        at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    else:
+        raise ValueError(f"timestamp must be an ISO string or epoch seconds, got {value!r}")
+    return at.replace(tzinfo=timezone.utc) if at.tzinfo is None else at.astimezone(timezone.utc)
+
+
+def parse_reading(raw):
+    """
+    Validates one reading, given as an object or as an array in
+    PACKED_READING_FIELDS order. Raises ValueError if it is malformed.
+    """
+    if isinstance(raw, (list, tuple)):
+        if len(raw) != len(PACKED_READING_FIELDS):
+            raise ValueError(f"packed reading needs {len(PACKED_READING_FIELDS)} fields: {', '.join(PACKED_READING_FIELDS)}")
+        raw = dict(zip(PACKED_READING_FIELDS, raw))
+    elif not isinstance(raw, dict):
+        raise ValueError("reading must be an object or an array")
+    sensor_id = raw.get("sensor_id")
+    if not isinstance(sensor_id, str) or not sensor_id or "/" in sensor_id:
+        raise ValueError("sensor_id must be a non-empty string without '/'")
+    reading = {"sensor_id": sensor_id}
+    for metric in SENSOR_METRICS:
+        value = raw.get(metric)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{metric} must be a finite number")
+        try:
+            value = float(value)  # integers past the float range overflow here
+        except OverflowError:
+            raise ValueError(f"{metric} must be a finite number")
+        if not math.isfinite(value):
+            raise ValueError(f"{metric} must be a finite number")
+        reading[metric] = value
+    reading["recorded_at"] = parse_timestamp(raw.get("timestamp"))
+    return reading
+
+
+def decode_readings(body, content_type=None):
+    """
+    Decodes a batch body: a list of readings, or {"readings": [...]}, as JSON
+    or, for a msgpack content type, as msgpack.
+    """
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in MSGPACK_CONTENT_TYPES:
+        payload = msgpack.unpackb(body, raw=False, timestamp=3, strict_map_key=False)
+    else:
+        payload = json.loads(body)
+    if isinstance(payload, dict):
+        payload = payload.get("readings")
+    if not isinstance(payload, list):
+        raise ValueError("Expected a list of readings or an object with a `readings` list")
+    if len(payload) > MAX_BATCH_READINGS:
+        raise BatchTooLarge(f"At most {MAX_BATCH_READINGS} readings per batch")
+    return payload
+
+
+def reading_id(recorded_at):
+    return f"{round(recorded_at.timestamp() * 1_000_000):016d}"
+
+
+def reading_document(user_id, reading):
+    """
+    Returns the stored form of a parsed reading.
+    """
+    document = {"user_id": user_id}
+    document.update({metric: reading[metric] for metric in SENSOR_METRICS})
+    document["timestamp"] = reading["recorded_at"].isoformat()
+    document["recorded_at"] = reading["recorded_at"]
+    return document
+
+
+def add_ingest_stage(stage):
+    """
+    Registers `stage(client, user_id, readings)`, called with every batch of
+    stored readings (parsed, in arrival order). It returns a list of writes
+    for commit_in_batches, or None.
+    """
+    _ingest_stages.append(stage)
+
+
+def ingest_readings(client, user_id, raw_readings):
+    """
+    Validates and stores a batch of readings. Malformed readings are rejected
+    individually; the rest are written in WriteBatch chunks and then passed to
+    the ingest stages.
+
+    Returns {"accepted", "rejected": [{"index", "error"}], "failed": [{"index", "error"}],
+    "stage_errors": [error]} where "failed" lists valid readings whose chunk
+    did not commit, and "stage_errors" the stages or stage writes that failed
+    after the readings were stored.
+    """
+    rejected = []
+    readings = {}
+    for index, raw in enumerate(raw_readings):
+        try:
+            reading = parse_reading(raw)
+        except ValueError as e:
+            rejected.append({"index": index, "error": str(e)})
+            continue
+        # A repeated (sensor, timestamp) is the same reading sent twice: keep the last.
+        readings[(reading["sensor_id"], reading_id(reading["recorded_at"]))] = (index, reading)
+
+    sensors = client.collection(SENSORS_COLLECTION)
+    entries = list(readings.items())
+    writes = [
+        ("set", sensors.document(sensor_id).collection("readings").document(doc_id), reading_document(user_id, reading))
+        for (sensor_id, doc_id), (_, reading) in entries
+    ]
+    errors = commit_in_batches(client, writes)
+    failed = [{"index": index, "error": str(error)} for (_, (index, _)), error in zip(entries, errors) if error]
+
+    # Stages only see readings that were stored, so a retried batch is not
+    # counted twice for the chunks that failed.
+    stored = [reading for (_, (_, reading)), error in zip(entries, errors) if not error]
+    stage_errors = []
+    if stored:
+        writes = []
+        for stage in _ingest_stages:
+            try:
+                writes.extend(stage(client, user_id, stored) or [])
+            except Exception as e:
+                stage_errors.append(f"{stage.__name__}: {e}")
+        if writes:
+            stage_errors.extend(dict.fromkeys(str(error) for error in commit_in_batches(client, writes) if error))
+        for error in stage_errors:
+            print(f"Sensor ingest stage failed: {error}")
+    return {
+        "accepted": len(raw_readings) - len(rejected) - len(failed),
+        "rejected": rejected,
+        "failed": failed,
+        "stage_errors": stage_errors,
+    }
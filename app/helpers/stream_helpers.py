@@ -0,0 +1,187 @@
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict
+from app.helpers.sensor_helpers import SENSOR_METRICS, add_ingest_stage
+
+"""
+Live sensor updates over WebSocket and SSE.
+
+An in-process hub fans updates out to subscribers of topics such as
+`sensor:{sensor_id}` or `farm:{user_id}`. Ingest publishes from worker
+threads. Each subscriber drains its own queue on the event loop, at its own
+pace.
+
+The queues are keyed by (update type, sensor), which is what gives slow
+clients backpressure. A new update for a key that is still queued is merged
+into the queued one, so a client that falls behind receives the latest state
+of each sensor, not a growing backlog:
+
+- readings are appended, keeping the last STREAM_MAX_POINTS;
+- any other update replaces the queued one.
+
+At most STREAM_MAX_PENDING keys are queued per client; beyond that the oldest
+is dropped. Merged and dropped updates are counted in `skipped`.
+
+The hub only sees what this process ingests.
+"""
+
+STREAM_MAX_PENDING = int(os.getenv("SENSOR_STREAM_MAX_PENDING", "256"))
+STREAM_MAX_POINTS = int(os.getenv("SENSOR_STREAM_MAX_POINTS", "100"))
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("SENSOR_STREAM_KEEPALIVE", "15"))
+
+
+def sensor_topic(sensor_id):
+    return f"sensor:{sensor_id}"
+
+
+def farm_topic(farm_id):
+    return f"farm:{farm_id}"
+
+
+class Subscription:
+    """
+    One client's coalescing queue, filled from any thread and drained on its event loop.
+    """
+
+    def __init__(self, loop, topics, max_pending=STREAM_MAX_PENDING, max_points=STREAM_MAX_POINTS):
+        self.loop = loop
+        self.topics = list(topics)
+        self.max_pending = max_pending
+        self.max_points = max_points
+        self.skipped = 0
+        self._pending = OrderedDict()  # (type, sensor_id) -> update
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+        self._signalled = False
+
+    def offer(self, update):
+        key = (update["type"], update.get("sensor_id"))
+        with self._lock:
+            queued = self._pending.get(key)
+            if queued is None:
+                self._pending[key] = update
+                if len(self._pending) > self.max_pending:
+                    _, dropped = self._pending.popitem(last=False)
+                    self.skipped += 1 + dropped.get("skipped", 0)
+            else:
+                self.skipped += 1
+                if update["type"] == "readings":
+                    readings = queued["readings"] + update["readings"]
+                    self._pending[key] = {**update, "readings": readings[-self.max_points:]}
+                else:
+                    self._pending[key] = update
+            if self._signalled:
+                return
+            self._signalled = True
+        try:
+            self.loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            pass  # the loop is gone with its client
+
+    async def next_batch(self, timeout=None):
+        """
+        Waits for updates and returns them (oldest key first), or [] on timeout.
+        """
+        deadline = None if timeout is None else self.loop.time() + timeout
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), None if deadline is None else max(deadline - self.loop.time(), 0))
+            except asyncio.TimeoutError:
+                return []
+            with self._lock:
+                self._ready.clear()
+                self._signalled = False
+                updates = list(self._pending.values())
+                self._pending.clear()
+                skipped, self.skipped = self.skipped, 0
+            if updates:  # else a wake-up that a previous drain already served
+                if skipped:
+                    updates[-1] = {**updates[-1], "skipped": skipped}
+                return updates
+
+
+class SensorHub:
+    """
+    Topic -> subscriptions registry.
+    """
+
+    def __init__(self):
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics, loop=None):
+        subscription = Subscription(loop or asyncio.get_running_loop(), topics)
+        with self._lock:
+            for topic in subscription.topics:
+                self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._topics[topic]
+
+    def has_subscribers(self):
+        return bool(self._topics)
+
+    def publish(self, topics, update):
+        with self._lock:
+            subscriptions = set()
+            for topic in topics:
+                subscriptions.update(self._topics.get(topic, ()))
+        for subscription in subscriptions:
+            subscription.offer(update)
+
+
+hub = SensorHub()
+
+
+def publish_readings(client, user_id, readings):
+    """
+    Ingest stage: one readings update per sensor in the batch.
+    """
+    if not hub.has_subscribers():
+        return None
+    by_sensor = {}
+    for reading in readings:
+        point = {"timestamp": reading["recorded_at"].isoformat(), **{metric: reading[metric] for metric in SENSOR_METRICS}}
+        by_sensor.setdefault(reading["sensor_id"], []).append(point)
+    for sensor_id, points in by_sensor.items():
+        hub.publish(
+            [sensor_topic(sensor_id), farm_topic(user_id)],
+            {"type": "readings", "sensor_id": sensor_id, "farm_id": user_id, "readings": points},
+        )
+    return None
+
+
+add_ingest_stage(publish_readings)
+
+
+def publish_update(sensor_id, farm_id, update_type, data):
+    """
+    Publishes a non-reading update (e.g. a status change) for a sensor.
+    """
+    if hub.has_subscribers():
+        hub.publish([sensor_topic(sensor_id), farm_topic(farm_id)], {"type": update_type, "sensor_id": sensor_id, "farm_id": farm_id, **data})
+
+
+async def sse_events(subscription, is_disconnected):
+    """
+    Yields a subscription as Server-Sent Events, with keep-alive comments
+    while idle, until `is_disconnected()` is true.
+    """
+    try:
+        while not await is_disconnected():
+            updates = await subscription.next_batch(STREAM_KEEPALIVE_SECONDS)
+            if not updates:
+                yield ": keep-alive\n\n"
+            for update in updates:
+                yield f"event: {update['type']}\ndata: {json.dumps(update, default=str)}\n\n"
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,251 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+"""
+Text normalization for product search.
+
+Farmers type crop names in English, in romanized Hindi ("tamatar", "pyaaz") and
+in Devanagari, often misspelled. Every token, on the indexing side and on the
+query side alike, goes through the same pipeline:
+
+1. Devanagari is transliterated to Latin.
+2. The Latin form is folded so common romanization variants collapse
+   ("aa"/"a", "ee"/"i", "oo"/"u", "z"/"j", doubled letters, ...).
+3. Known Hindi crop names get their English name as an extra search term, so
+   "tamatar", "टमाटर" and "tomato" all reach the same listings.
+
+What is left after that is absorbed by bounded edit-distance matching against
+the vocabulary, found through a character trigram index.
+"""
+
+_VOWELS = {
+    "अ": "a", "आ": "aa", "इ": "i", "ई": "ee", "उ": "u", "ऊ": "oo", "ऋ": "ri",
+    "ए": "e", "ऐ": "ai", "ओ": "o", "औ": "au", "ऑ": "o",
+}
+_MATRAS = {
+    "ा": "aa", "ि": "i", "ी": "ee", "ु": "u", "ू": "oo", "ृ": "ri",
+    "े": "e", "ै": "ai", "ो": "o", "ौ": "au", "ॉ": "o",
+}
+_CONSONANTS = {
+    "क": "k", "ख": "kh", "ग": "g", "घ": "gh", "ङ": "n",
+    "च": "ch", "छ": "chh", "ज": "j", "झ": "jh", "ञ": "n",
+    "ट": "t", "ठ": "th", "ड": "d", "ढ": "dh", "ण": "n",
+    "त": "t", "थ": "th", "द": "d", "ध": "dh", "न": "n",
+    "प": "p", "फ": "ph", "ब": "b", "भ": "bh", "म": "m",
+    "य": "y", "र": "r", "ल": "l", "व": "v",
+    "श": "sh", "ष": "sh", "स": "s", "ह": "h",
+    "क़": "q", "ख़": "kh", "ग़": "g", "ज़": "z", "ड़": "r", "ढ़": "rh", "फ़": "f", "य़": "y",
+}
+# Consonant + nukta written as two code points
+_NUKTA_FORMS = {"क": "q", "ज": "z", "ड": "r", "ढ": "rh", "फ": "f"}
+_SIGNS = {"ं": "n", "ँ": "n", "ः": "h"}
+_VIRAMA = "्"
+_NUKTA = "़"
+_DIGITS = {chr(0x0966 + digit): str(digit) for digit in range(10)}
+
+
+def transliterate(text):
+    """
+    Transliterates Devanagari to Latin (Hunterian-style, with word-final schwa
+    deletion); other characters pass through unchanged.
+    """
+    out = []
+    chars = unicodedata.normalize("NFC", text)
+    i = 0
+    while i < len(chars):
+        char = chars[i]
+        if char in _CONSONANTS:
+            latin = _CONSONANTS[char]
+            nxt = chars[i + 1] if i + 1 < len(chars) else ""
+            if nxt == _NUKTA:
+                latin = _NUKTA_FORMS.get(char, latin)
+                i += 1
+                nxt = chars[i + 1] if i + 1 < len(chars) else ""
+            out.append(latin)
+            if nxt in _MATRAS:
+                out.append(_MATRAS[nxt])
+                i += 1
+            elif nxt == _VIRAMA:
+                i += 1
+            elif nxt and (nxt in _CONSONANTS or nxt in _SIGNS):
+                out.append("a")
+            # Otherwise the consonant ends the word: Hindi drops the final schwa.
+        elif char in _VOWELS:
+            out.append(_VOWELS[char])
+        elif char in _MATRAS:
+            out.append(_MATRAS[char])
+        elif char in _SIGNS:
+            out.append(_SIGNS[char])
+        elif char in _DIGITS:
+            out.append(_DIGITS[char])
+        elif char in (_VIRAMA, _NUKTA):
+            pass
+        else:
+            out.append(char)
+        i += 1
+    return "".join(out)
+
+
+_FOLDS = (
+    ("ee", "i"), ("oo", "u"), ("ph", "f"), ("w", "v"), ("z", "j"), ("q", "k"),
+)
+_REPEATS_RE = re.compile(r"(.)\1+")
+
+
+def fold(token):
+    """
+    Folds a Latin token so common spelling variants compare equal.
+    """
+    token = unicodedata.normalize("NFKD", token.lower())
+    token = "".join(char for char in token if not unicodedata.combining(char))
+    for source, target in _FOLDS:
+        token = token.replace(source, target)
+    return _REPEATS_RE.sub(r"\1", token)
+
+
+# Romanized Hindi crop and produce names -> English listing vocabulary.
+_HINDI_NAMES = {
+    "tamatar": "tomato", "aloo": "potato", "alu": "potato", "pyaz": "onion", "pyaaz": "onion",
+    "kanda": "onion", "gehun": "wheat", "gehu": "wheat", "chawal": "rice", "dhan": "paddy",
+    "makka": "maize", "makki": "maize", "bhutta": "corn", "bajra": "millet", "jowar": "sorghum",
+    "bhindi": "okra", "gobhi": "cauliflower", "baingan": "brinjal", "mirch": "chilli",
+    "mirchi": "chilli", "adrak": "ginger", "lahsun": "garlic", "lahasun": "garlic",
+    "lehsun": "garlic",
+    "haldi": "turmeric", "dhaniya": "coriander", "jeera": "cumin", "kela": "banana",
+    "aam": "mango", "seb": "apple", "santra": "orange", "angoor": "grapes", "anar": "pomegranate",
+    "ganna": "sugarcane", "kapas": "cotton", "sarson": "mustard", "chana": "chickpea",
+    "matar": "peas", "gajar": "carrot", "mooli": "radish", "palak": "spinach",
+    "kaddu": "pumpkin", "kheera": "cucumber", "nimbu": "lemon", "doodh": "milk",
+    "dahi": "curd", "shahad": "honey", "moongphali": "groundnut", "masoor": "lentil",
+    "soyabean": "soybean", "nariyal": "coconut", "papita": "papaya", "amrood": "guava",
+}
+SYNONYMS = {fold(hindi): fold(english) for hindi, english in _HINDI_NAMES.items()}
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _words(text):
+    if not text:
+        return []
+    folded = (fold(word) for word in _WORD_RE.findall(transliterate(str(text)).lower()))
+    return [word for word in folded if word]
+
+
+def normalize_terms(text):
+    """
+    Splits listing text into normalized index terms, including English
+    synonyms of Hindi produce names.
+    """
+    terms = []
+    for term in _words(text):
+        terms.append(term)
+        synonym = SYNONYMS.get(term)
+        if synonym and synonym != term:
+            terms.append(synonym)
+    return terms
+
+
+def max_edits(term):
+    """
+    Typo budget for a query term: none for short terms, then one, then two.
+    """
+    if len(term) <= 3:
+        return 0
+    if len(term) <= 7:
+        return 1
+    return 2
+
+
+def bounded_edit_distance(a, b, limit):
+    """
+    Optimal string alignment distance (insert, delete, substitute, swap
+    neighbours) between `a` and `b`, or `limit + 1` once it is known to exceed
+    `limit`.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous_previous is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                value = min(value, previous_previous[j - 2] + 1)
+            current[j] = value
+            row_min = min(row_min, value)
+        if row_min > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1] if previous[-1] <= limit else limit + 1
+
+
+def trigrams(term):
+    padded = f"^{term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Character trigram index over the search vocabulary, used to find the few
+    terms worth an edit-distance check.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(set)
+
+    def add(self, term):
+        for gram in trigrams(term):
+            self.postings[gram].add(term)
+
+    def remove(self, term):
+        for gram in trigrams(term):
+            terms = self.postings.get(gram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self.postings[gram]
+
+    def similar(self, term, limit=None):
+        """
+        Returns the vocabulary terms within the typo budget of `term`.
+        """
+        limit = max_edits(term) if limit is None else limit
+        if limit == 0:
+            return set()
+        grams = trigrams(term)
+        # An edit destroys at most three trigrams (q-gram lemma); a swap of
+        # neighbours, counted as one edit here, at most four.
+        needed = max(len(grams) - 4 * limit, 1)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        return {
+            candidate for candidate, count in shared.items()
+            if count >= needed and bounded_edit_distance(term, candidate, limit) <= limit
+        }
+
+
+_synonym_index = TrigramIndex()
+for _name in SYNONYMS:
+    _synonym_index.add(_name)
+
+
+def query_terms(text):
+    """
+    Splits a search query into one set of alternative terms per word: the
+    normalized word plus the English name of any (possibly misspelled) Hindi
+    produce name it matches.
+    """
+    groups = []
+    for term in _words(text):
+        alternatives = {term}
+        for name in {term} | _synonym_index.similar(term):
+            if name in SYNONYMS:
+                alternatives.add(SYNONYMS[name])
+        groups.append(alternatives)
+    return groups
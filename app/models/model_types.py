@@ -27,6 +27,10 @@ class InventoryItem(BaseModel):
     description: Optional[str] = None
     price: Optional[float] = None
 
+class BulkInventoryRequest(BaseModel):
+    storage: str = "self_stored"  # default storage for items that do not name one
+    items: List[Dict[str, Any]] = Field(..., min_length=1, max_length=5000)  # InventoryItem fields, plus optional item_id, storage, item_status
+
 class LoginRequest(BaseModel):
     email: str
     password: str
@@ -77,6 +81,9 @@ class Order(BaseModel):
     quantity: int
     price: float
     status: str = "Pending"
+    item_id: Optional[str] = None  # inventory item the order draws stock from
+    storage: Optional[str] = None  # its storage collection, looked up if omitted
+    hold_id: Optional[str] = None  # reservation taken at cart time, committed by the order
 
 # Order status update model
 class OrderStatusUpdate(BaseModel):
@@ -246,8 +253,9 @@ class ModerateThreadRequest(BaseModel):
     reason: Optional[str] = None
 
 class LocationAlertSubscription(BaseModel):
-    latitude: float
-    longitude: float
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    pincode: Optional[str] = None  # used instead of latitude/longitude when given
     radius: int  # in meters
     alert_type: str  # Weather, Market, etc.
 
@@ -326,6 +334,8 @@ class MarketplaceQueryRequest(BaseModel):
     sorted_by: Optional[str] = None  # ratings, price, quantity
     radius: Optional[int] = None  # in km
     filters: Optional[dict] = None  # multiple filters
+    limit: int = Field(20, ge=1, le=100)  # page size
+    cursor: Optional[str] = None  # next_cursor from the previous page
 
 
 class NotificationRequest(BaseModel):
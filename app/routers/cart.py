@@ -10,6 +10,8 @@ import uuid
 import os
 import dotenv
 from app.controllers.auth import UserAuth
+from app.helpers.reservation_helpers import HoldNotActive, InsufficientStock, ReservationError, default_client, locate_item, release_holds, reserve, resize_hold
+from starlette.concurrency import run_in_threadpool
 
 """
 User Cart (in Database):
@@ -17,6 +19,7 @@ user_id (reference to the user document)
 items (array of objects):
 item_id (reference to the in ventory item document)
 quantity (number)
+hold_id (stock reservation held while the item is in the cart, committed by the order)
 farm_id (reference to the seller's document) - Required to ensure items are bought from the same farm
 
 API Endpoints:
@@ -49,6 +52,46 @@ router = APIRouter()
 # Google Cloud Services
 speech_client = speech.SpeechClient()
 
+async def hold_stock(item_id, quantity, holder):
+    """
+    Reserves cart stock of an inventory item. Returns the hold, or None for
+    listings that have no inventory document to reserve against.
+    """
+    client = default_client()
+    try:
+        storage = await run_in_threadpool(locate_item, client, item_id)
+        if not storage:
+            return None
+        return await run_in_threadpool(reserve, client, storage, item_id, quantity, holder)
+    except InsufficientStock as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ReservationError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+async def resize_stock(item_id, hold_id, quantity, holder):
+    """
+    Moves a cart item's hold to a new quantity, reserving or returning only
+    the difference. Takes a fresh hold when the old one is no longer active.
+    """
+    if not hold_id:
+        return await hold_stock(item_id, quantity, holder)
+    try:
+        return await run_in_threadpool(resize_hold, default_client(), hold_id, quantity)
+    except HoldNotActive:
+        return await hold_stock(item_id, quantity, holder)
+    except InsufficientStock as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ReservationError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+async def release_stock(hold_ids):
+    """
+    Returns the stock of cart holds in one batched release.
+    """
+    hold_ids = [hold_id for hold_id in hold_ids if hold_id]
+    if hold_ids:
+        await run_in_threadpool(release_holds, default_client(), hold_ids)
+
 @router.post("/cart/add")
 async def add_to_cart(request: CartItemRequest, user=Depends(UserAuth.get_current_user)):
     """
@@ -66,10 +109,15 @@ async def add_to_cart(request: CartItemRequest, user=Depends(UserAuth.get_curren
         if cart_data["items"] and cart_data["items"][0]["farm_id"] != farm_id:
             raise HTTPException(status_code=400, detail="Cart can only have items from the same farm")
 
-        cart_data["items"].append({"item_id": request.item_id, "quantity": request.quantity, "farm_id": farm_id})
+        # Holds the stock while it sits in the cart, so checkout cannot oversell
+        hold = await hold_stock(request.item_id, request.quantity, user.uid)
+
+        cart_data["items"].append({"item_id": request.item_id, "quantity": request.quantity, "farm_id": farm_id, "hold_id": hold and hold["hold_id"]})
         cart_ref.set(cart_data)
 
-        return {"message": "Item added to cart successfully"}
+        return {"message": "Item added to cart successfully", "hold": hold}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -102,10 +150,15 @@ async def update_cart_quantity(item_id: str, quantity: int, user=Depends(UserAut
         cart_data = cart_ref.get() or {"items": []}
         for item in cart_data["items"]:
             if item["item_id"] == item_id:
+                # Only the difference is reserved; on failure the old hold stays as it was
+                hold = await resize_stock(item_id, item.get("hold_id"), quantity, user.uid)
                 item["quantity"] = quantity
+                item["hold_id"] = hold and hold["hold_id"]
                 cart_ref.set(cart_data)
                 return {"message": "Cart updated successfully"}
         raise HTTPException(status_code=404, detail="Item not found in cart")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -117,6 +170,7 @@ async def remove_from_cart(item_id: str, user=Depends(UserAuth.get_current_user)
     try:
         cart_ref = db.reference("carts").child(user.uid)
         cart_data = cart_ref.get() or {"items": []}
+        await release_stock([item.get("hold_id") for item in cart_data["items"] if item["item_id"] == item_id])
         cart_data["items"] = [item for item in cart_data["items"] if item["item_id"] != item_id]
         cart_ref.set(cart_data)
         return {"message": "Item removed from cart successfully"}
@@ -130,6 +184,8 @@ async def empty_cart(user=Depends(UserAuth.get_current_user)):
     """
     try:
         cart_ref = db.reference("carts").child(user.uid)
+        cart_data = cart_ref.get() or {"items": []}
+        await release_stock([item.get("hold_id") for item in cart_data.get("items", [])])
         cart_ref.set({"items": []})
         return {"message": "Cart emptied successfully"}
     except Exception as e:
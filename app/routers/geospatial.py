@@ -1,8 +1,10 @@
 from fastapi import APIRouter, HTTPException, Depends
 from google.cloud import firestore
+from typing import Optional
 import requests
 import os
 from firebase_admin import messaging
+from app.helpers.geo_helpers import resolve_pincode
 from app.models.model_types import Location, LocationAlertSubscription, MovementTracking
 from app.controllers.auth import UserAuth
 
@@ -24,6 +26,27 @@ def search_nearby_places(location: Location, place_type: str):
     response = requests.get(url)
     return response.json()
 
+def resolve_location(location: Optional[Location] = None, pincode: Optional[str] = None):
+    """
+    Returns the given location, or geocodes the pincode with the bundled offline table.
+    """
+    if pincode:
+        coords = resolve_pincode(pincode)
+        if coords is None:
+            raise HTTPException(status_code=404, detail="Unknown pincode.")
+        return Location(latitude=coords[0], longitude=coords[1])
+    if location is None:
+        raise HTTPException(status_code=400, detail="Either a location or a pincode is required.")
+    return location
+
+@router.get("/api/geospatial/pincode/{pincode}")
+async def geocode_pincode(pincode: str):
+    """
+    Geocode a pincode to latitude/longitude without any network call.
+    """
+    location = resolve_location(pincode=pincode)
+    return {"pincode": pincode, "latitude": location.latitude, "longitude": location.longitude}
+
 @router.get("/api/geospatial/maps")
 async def get_geospatial_maps():
     """
@@ -43,11 +66,14 @@ async def get_geospatial_maps():
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/api/geospatial/search")
-async def search_geospatial(location: Location, place_type: str):
+async def search_geospatial(place_type: str, location: Optional[Location] = None, pincode: Optional[str] = None):
     """
     Search for nearby places (e.g., farms, cold storage, transport providers) based on user's location.
+    The location can be given directly or as a pincode.
     """
     try:
+        location = resolve_location(location, pincode)
+
         # Validate place_type (ensure it is a valid type such as 'farm', 'cold_storage', etc.)
         valid_place_types = ['farm', 'cold_storage', 'transport', 'restaurant', 'hospital']
         if place_type not in valid_place_types:
@@ -57,15 +83,19 @@ async def search_geospatial(location: Location, place_type: str):
         search_results = search_nearby_places(location, place_type)
 
         return {"results": search_results["results"]}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/api/geospatial/alerts")
-async def get_geospatial_alerts(location: Location, user=Depends(UserAuth.get_current_user)):
+async def get_geospatial_alerts(location: Optional[Location] = None, pincode: Optional[str] = None, user=Depends(UserAuth.get_current_user)):
     """
     Retrieve location-based notifications or alerts for the user.
+    The location can be given directly or as a pincode.
     """
     try:
+        location = resolve_location(location, pincode)
         # Fetch alerts based on user preferences and location
         alerts_ref = db.collection("location_alerts").where("user_id", "==", user.uid)
         alerts = alerts_ref.stream()
@@ -78,6 +108,8 @@ async def get_geospatial_alerts(location: Location, user=Depends(UserAuth.get_cu
             alert_data.append(alert_info)
 
         return {"alerts": alert_data}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -88,16 +120,24 @@ async def subscribe_to_alerts(subscription: LocationAlertSubscription, user=Depe
     Subscribe users to location-based alerts (e.g., weather, market changes).
     """
     try:
+        location = None
+        if subscription.latitude is not None and subscription.longitude is not None:
+            location = Location(latitude=subscription.latitude, longitude=subscription.longitude)
+        location = resolve_location(location, subscription.pincode)
+
         # Save subscription preferences to Firestore
         user_alert_ref = db.collection("user_alerts").document(user.uid)
         user_alert_ref.set({
-            "latitude": subscription.latitude,
-            "longitude": subscription.longitude,
+            "latitude": location.latitude,
+            "longitude": location.longitude,
+            "pincode": subscription.pincode,
             "radius": subscription.radius,
             "alert_type": subscription.alert_type
         })
 
         return {"message": "Successfully subscribed to location-based alerts."}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2,91 +2,184 @@ from firebase_admin import credentials, initialize_app, auth, db
 from fastapi import UploadFile, File
 import app.models.model_types as modelType
 from app.helpers import ai_helpers
+from app.helpers.inventory_helpers import EXPORT_PAGE_SIZE, STORAGE_COLLECTIONS, InventoryQueryPlan, build_inventory_item, collection_counts, commit_in_batches, ndjson_lines, read_collections, read_stats, rebuild_stats, stats_write, stock_status, storage_collections
+from app.helpers.history_helpers import DEFAULT_HISTORY_WINDOW, as_utc, compact_history, compaction_horizon, history_write, read_history, read_snapshot
+from app.helpers.image_helpers import ImageTooLarge, upload_listing_image
+from app.helpers.reservation_helpers import RESERVATION_TTL_SECONDS, HoldNotActive, InsufficientStock, ReservationConflict, ReservationError, commit_hold, release_expired, release_hold, reserve, retry_on_conflict
+from app.helpers.search_helpers import field_value, index_inventory_item, index_inventory_items, patch_inventory_item, unindex_inventory_item
 from app.utils import utils
 from typing import *
+from collections import Counter
+from datetime import datetime, timezone
+from pydantic import ValidationError
 import os
 from google.cloud import firestore
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from app.controllers.auth import UserAuth
 
 db = firestore.Client()
 
 router = APIRouter()
 
+def export_ndjson(collections):
+    """
+    Streams the given collections as NDJSON, paging through Firestore so memory
+    stays flat regardless of collection size.
+    """
+    docs = read_collections(db, collections, page_size=EXPORT_PAGE_SIZE)
+    return StreamingResponse(ndjson_lines(docs), media_type="application/x-ndjson")
+
+def item_write_group(storage, write, old_item, new_item):
+    """
+    Returns an item write together with the analytics counter update and the
+    change-log append that must commit in the same batch.
+    """
+    group = [write]
+    for extra in (stats_write(db, storage, old_item, new_item), history_write(db, storage, write[1].id, old_item, new_item)):
+        if extra is not None:
+            group.append(extra)
+    return group
+
+def commit_item_write(storage, write, old_item, new_item):
+    """
+    Commits an item write in one batch with its counter update and change-log entry.
+    """
+    error = commit_in_batches(db, [item_write_group(storage, write, old_item, new_item)])[0]
+    if error is not None:
+        raise error
+
 @router.post("/api/inventory/items")
 def create_inventory_item(name, category, quantity, storage, description, price, item_id=None, rating=0.0, item_status="in stock"):
     try:
         storage_collection = db.collection(storage)  # Use storage as collection name
+        item = build_inventory_item(name, category, quantity, storage, description, price, item_status)
 
         # Generate a unique ID if item_id is not provided
         if not item_id:
-            item_id = storage_collection.document().id
+            doc_ref = storage_collection.document()
+            commit_item_write(storage, ("set", doc_ref, item), None, item)
+        else:
+            doc_ref = storage_collection.document(item_id)
 
-        doc_ref = storage_collection.document(item_id)
-        doc_ref.set({
-            "name": name,
-            "category": category,
-            "quantity": {
-                "value": quantity,
-                "unit": "kg"  # kg, gm, pound, etc options
-            },
-            "storage": storage,  # self_stored or externally_stored
-            "description": description,
-            "price": {
-                "value": price,
-                "unit": "kg"  # kg, gm, pound, etc options
-            },
-            "ratings": [],  # an empty list for ratings
-            "average_rating": 0.0,  # Initialize average rating to zero
-            "item_status": item_status,  # item status field (in stock, sold, etc)
-        })
+            def attempt():
+                # An existing item is replaced and its old totals leave the
+                # counters, so the write only applies to the version read here.
+                snapshot = doc_ref.get()
+                if not snapshot.exists:
+                    commit_item_write(storage, ("create", doc_ref, item), None, item)
+                    return
+                old_item = snapshot.to_dict()
+                new_item = dict(item)
+                # Holds taken on the old version stay in force
+                reserved = old_item.get("reserved") or 0
+                if reserved:
+                    if field_value(item, "quantity") < reserved:
+                        raise InsufficientStock(f"{reserved} units are reserved by buyers")
+                    new_item["reserved"] = reserved
+                data = {**new_item, **{field: firestore.DELETE_FIELD for field in old_item if field not in new_item}}
+                option = db.write_option(last_update_time=snapshot.update_time)
+                commit_item_write(storage, ("update", doc_ref, data, option), old_item, new_item)
+                return new_item
+
+            item = retry_on_conflict(storage, item_id, attempt) or item
+        item_id = doc_ref.id
+        index_inventory_item(storage, item_id, item)
         print("Inventory item created:", doc_ref)
 
         return {"status": "success", "message": "Inventory item created successfully"}
+    except ReservationError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# Function to retrieve all items from the inventory based on storage type.
-@router.get("/api/inventory/{storage}")
-def get_items1(storage):
-    try:
-        storage_collection = db.collection(storage)  # Use storage type as collection name
-        docs = storage_collection.get()
-        items = []
-        for doc in docs:
-            items.append(doc.to_dict())
-        return items
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+@router.post("/api/inventory/items/bulk")
+def bulk_upsert_inventory_items(request: modelType.BulkInventoryRequest):
+    """
+    Creates or updates many inventory items in batched writes.
 
-# Function to retrieve all items from the inventory.
-@router.get("/api/inventory")
-def get_items():
+    Items carrying an `item_id` are merged into that document; the others are
+    created. Every item gets its own result, so one bad row does not fail the lot.
+    """
     try:
-        self_stored_collection = db.collection("self_stored")
-        self_stored_docs = self_stored_collection.get()
+        results = [None] * len(request.items)
+        pending = []  # (position, storage, doc_ref, item, status)
+        seen = set()  # (storage, item_id) of the updates, each applied once
+
+        for position, raw in enumerate(request.items):
+            try:
+                fields = modelType.InventoryItem(**raw)
+            except ValidationError as e:
+                detail = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                results[position] = {"index": position, "status": "invalid", "detail": detail}
+                continue
+            storage = raw.get("storage") or request.storage
+            if storage not in STORAGE_COLLECTIONS:
+                results[position] = {"index": position, "status": "invalid", "detail": f"Unknown storage '{storage}'"}
+                continue
+
+            item_status = raw.get("item_status") or ("in stock" if fields.quantity > 0 else "out of stock")
+            item = build_inventory_item(fields.name, fields.category, fields.quantity, storage, fields.description, fields.price, item_status)
+            storage_collection = db.collection(storage)
+            item_id = raw.get("item_id")
+            if item_id:
+                if (storage, str(item_id)) in seen:
+                    # Its counter delta would be computed from the same old version twice
+                    results[position] = {"index": position, "item_id": item_id, "status": "invalid", "detail": "Duplicate item_id in request"}
+                    continue
+                seen.add((storage, str(item_id)))
+                # Existing ratings stay; optional fields are only written when given.
+                del item["ratings"], item["average_rating"]
+                for field in ("description", "price"):
+                    if field not in fields.model_fields_set:
+                        del item[field]
+                pending.append((position, storage, storage_collection.document(str(item_id)), item, "updated"))
+            else:
+                pending.append((position, storage, storage_collection.document(), item, "created"))
 
-        externally_stored_collection = db.collection("externally_stored")
-        externally_stored_docs = externally_stored_collection.get()
+        # Current versions of updated items, for the analytics counter deltas
+        updated_refs = [doc_ref for _, _, doc_ref, _, status in pending if status == "updated"]
+        old_items = {snapshot.reference.path: snapshot.to_dict() for snapshot in db.get_all(updated_refs) if snapshot.exists} if updated_refs else {}
 
-        all_items = []
-        all_items.extend(doc.to_dict() for doc in self_stored_docs)
-        all_items.extend(doc.to_dict() for doc in externally_stored_docs)
+        accepted = []
+        writes = []
+        new_items = []
+        for entry in pending:
+            position, storage, doc_ref, item, status = entry
+            old_item = old_items.get(doc_ref.path)
+            # Stock held for buyers cannot be taken away by an update
+            reserved = (old_item or {}).get("reserved") or 0
+            if field_value(item, "quantity") < reserved:
+                results[position] = {"index": position, "item_id": doc_ref.id, "status": "invalid", "detail": f"{reserved} units are reserved by buyers"}
+                continue
+            new_item = {**old_item, **item} if old_item else item
+            accepted.append(entry)
+            new_items.append(new_item)
+            writes.append(item_write_group(storage, ("merge" if status == "updated" else "set", doc_ref, item), old_item, new_item))
 
-        return all_items
+        errors = commit_in_batches(db, writes)
+        published = {}
+        for (position, storage, doc_ref, item, status), new_item, error in zip(accepted, new_items, errors):
+            item_id = doc_ref.id
+            if error is not None:
+                results[position] = {"index": position, "item_id": item_id, "status": "failed", "detail": str(error)}
+                continue
+            published[(storage, item_id)] = new_item
+            results[position] = {"index": position, "item_id": item_id, "status": status}
+        index_inventory_items(published)
+
+        return {"status": "success", "summary": Counter(result["status"] for result in results), "results": results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    
-@router.get("/api/inventory/{storage}/{itemId}")
-def get_item(storage: str, item_id: str):
+
+# Function to retrieve all items from the inventory.
+@router.get("/api/inventory")
+def get_items(format: str = Query("json", pattern="^(json|ndjson)$")):
     try:
-        storage_collection = db.collection(storage)
-        doc_ref = storage_collection.document(item_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            return doc.to_dict()
-        else:
-            raise HTTPException(status_code=404, detail="Item not found")
+        if format == "ndjson":
+            return export_ndjson(storage_collections())
+        # All storage collections are read concurrently and merged as they arrive
+        return list(read_collections(db, storage_collections()))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -98,7 +191,10 @@ def delete_item(storage: str, item_id: str):
     try:
         storage_collection = db.collection(storage)
         doc_ref = storage_collection.document(item_id)
-        doc_ref.delete()
+        snapshot = doc_ref.get()
+        old_item = snapshot.to_dict() if snapshot.exists else None
+        commit_item_write(storage, ("delete", doc_ref, None), old_item, None)
+        unindex_inventory_item(storage, item_id)
         return {"status": "success", "message": "Item deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -116,29 +212,45 @@ def update_item(storage, item_id, name: Optional[str] = None, category: Optional
             data["category"] = category
         if quantity is not None:
             data["quantity"] = quantity
-            if quantity == 0:
-                data["item_status"] = "out of stock"
         if description is not None:
             data["description"] = description
         if price is not None:
             data["price"] = price
 
-        doc_ref.update(data)
+        def attempt():
+            snapshot = doc_ref.get()
+            old_item = snapshot.to_dict() if snapshot.exists else None
+            if quantity is not None and old_item and quantity < (old_item.get("reserved") or 0):
+                raise InsufficientStock(f"{old_item['reserved']} units are reserved by buyers")
+            if quantity is not None:
+                # Keeps the marketplace's in-stock view in step with the quantity
+                data["item_status"] = stock_status((old_item or {}).get("item_status"), quantity)
+            new_item = {**old_item, **data} if old_item else None
+            # Version-checked, so a concurrent reservation is never overwritten
+            option = db.write_option(last_update_time=snapshot.update_time) if snapshot.exists else None
+            commit_item_write(storage, ("update", doc_ref, data, option) if option else ("update", doc_ref, data), old_item, new_item)
+
+        retry_on_conflict(storage, item_id, attempt)
+        patch_inventory_item(storage, item_id, data)
         return {"status": "success", "message": "Item updated successfully"}
+    except ReservationError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
     
-# GET /api/inventory/categories
-@router.get("/api/inventory/{storage}/{category}")
-def get_categories(storage, category, **kwargs):
+# GET /api/inventory/categories/{storage}/{category}
+# Formerly GET /api/inventory/{storage}/{category}: that path is get_item's
+# pattern too, which always answered it, so it cannot stay as an alias.
+@router.get("/api/inventory/categories/{storage}/{category}")
+def get_categories(storage, category):
+    """
+    Returns which of the comma-separated categories have items in `storage`.
+    """
     try:
-        categories = set()
-        for cat in category.split(','):  # Split the comma-separated values to handle multiple categories
-            docs = db.collection(storage).where('category', '==', cat).get()
-            for doc in docs:
-                categories.add(doc.to_dict().get("category"))
-        return list(categories)
+        # The comma-separated categories become one `in` query fetching only the category field
+        plan = InventoryQueryPlan([storage], {"category": category.split(',')}, fields=["category"])
+        return list({item.get("category") for item in plan.execute(db)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -151,34 +263,118 @@ def search_inventory(
     storage_type: Optional[str] = None
 ):
     try:
-        collections = ["self_stored", "externally_stored"] if not storage_type else [storage_type]
-        results = []
-        
-        for collection in collections:
-            docs = db.collection(collection).get()
-            for doc in docs:
-                item = doc.to_dict()
-                if (not category or item.get("category") == category) and \
-                   (not keyword or keyword.lower() in item.get("name", "").lower()) and \
-                   (not location or item.get("location") == location):
-                    results.append(item)
-        
-        return results
+        # Category and location are matched by Firestore; only the keyword is checked here
+        predicates = []
+        if keyword:
+            predicates.append(lambda item: keyword.lower() in item.get("name", "").lower())
+        plan = InventoryQueryPlan(
+            storage_collections(storage_type),
+            {"category": category or None, "location": location or None},
+            predicates,
+        )
+        return list(plan.execute(db))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # GET /api/inventory/history
 @router.get("/api/inventory/history")
-def get_inventory_history(storage_type: Optional[str] = None):
-    try:
-        collections = ["self_stored", "externally_stored"] if not storage_type else [storage_type]
-        history = []
-        
-        for collection in collections:
-            docs = db.collection(f"{collection}_history").get()
-            history.extend(doc.to_dict() for doc in docs)
-        
+def get_inventory_history(
+    storage_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    item_id: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """
+    Returns the inventory changes in [start, end), by default the last week.
+    Only the day partitions in range are read.
+    """
+    try:
+        end = as_utc(end) if end else datetime.now(timezone.utc)
+        start = as_utc(start) if start else end - DEFAULT_HISTORY_WINDOW
+        if start >= end:
+            raise HTTPException(status_code=400, detail="start must be before end")
+        storages = storage_collections(storage_type)
+
+        if format == "ndjson":
+            entries = read_history(db, storages, start, end, item_id, page_size=EXPORT_PAGE_SIZE)
+            return StreamingResponse(ndjson_lines(entries), media_type="application/x-ndjson")
+
+        history = sorted(read_history(db, storages, start, end, item_id), key=lambda entry: entry["change_id"])
+        # Changes older than the retention window live on only in the item's snapshot
+        if item_id and start < compaction_horizon():
+            for storage in storages:
+                snapshot = read_snapshot(db, storage, item_id)
+                if snapshot:
+                    history.insert(0, {"item_id": item_id, "storage": storage, "operation": "snapshot", **snapshot})
         return history
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST /api/inventory/history/compact
+@router.post("/api/inventory/history/compact")
+def compact_inventory_history(storage_type: Optional[str] = None, before: Optional[datetime] = None):
+    """
+    Folds day partitions older than the retention window (or `before`) into
+    per-item snapshots. Meant to be called periodically, e.g. by a scheduler.
+    """
+    try:
+        return {storage: compact_history(db, storage, before) for storage in storage_collections(storage_type)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST /api/inventory/{storage}/{item_id}/reserve
+@router.post("/api/inventory/{storage}/{item_id}/reserve")
+def reserve_item(storage: str, item_id: str, quantity: int = Query(..., gt=0), holder: Optional[str] = None, ttl_seconds: int = Query(RESERVATION_TTL_SECONDS, gt=0, le=86400)):
+    """
+    Holds stock of an item for a while; the hold is later committed or released.
+    """
+    try:
+        return reserve(db, storage, item_id, quantity, holder, ttl_seconds)
+    except InsufficientStock as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ReservationConflict as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ReservationError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST /api/inventory/reservations/{hold_id}/commit
+@router.post("/api/inventory/reservations/{hold_id}/commit")
+def commit_reservation(hold_id: str):
+    try:
+        return commit_hold(db, hold_id)
+    except HoldNotActive as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ReservationConflict as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST /api/inventory/reservations/{hold_id}/release
+@router.post("/api/inventory/reservations/{hold_id}/release")
+def release_reservation(hold_id: str):
+    try:
+        return release_hold(db, hold_id)
+    except HoldNotActive as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ReservationConflict as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# POST /api/inventory/reservations/release-expired
+@router.post("/api/inventory/reservations/release-expired")
+def release_expired_reservations(storage_type: Optional[str] = None):
+    """
+    Returns the stock of expired holds, one batched update per item. Meant to
+    be called periodically, e.g. by a scheduler.
+    """
+    try:
+        return release_expired(db, storage_type)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -186,15 +382,27 @@ def get_inventory_history(storage_type: Optional[str] = None):
 @router.post("/api/inventory/{storage}/{itemId}/upload-image")
 def upload_item_image(storage: str, itemId: str, file: UploadFile = File(...)):
     try:
-        file_location = f"uploaded_images/{itemId}_{file.filename}"
-        os.makedirs(os.path.dirname(file_location), exist_ok=True)
-        
-        with open(file_location, "wb") as buffer:
-            buffer.write(file.file.read())
-        
-        db.collection("storage").document(itemId).update({"image_url": file_location})
-        
-        return {"status": "success", "message": "Image uploaded successfully", "file_path": file_location}
+        doc_ref = db.collection(storage).document(itemId)
+        snapshot = doc_ref.get()
+        if not snapshot.exists:
+            raise HTTPException(status_code=404, detail="Item not found")
+
+        try:
+            images = upload_listing_image(file, f"inventory/{storage}/{itemId}")
+        except ImageTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # Listing grids use the thumbnail; `image_url` keeps pointing at the original
+        data = {"image_url": images["original"], "images": images}
+        old_item = snapshot.to_dict()
+        commit_item_write(storage, ("update", doc_ref, data), old_item, {**old_item, **data})
+        patch_inventory_item(storage, itemId, data)
+
+        return {"status": "success", "message": "Image uploaded successfully", "images": images}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -202,11 +410,52 @@ def upload_item_image(storage: str, itemId: str, file: UploadFile = File(...)):
 @router.get("/api/inventory/analytics")
 def get_inventory_analytics():
     try:
-        analytics = {}
-        for storage_type in ["self_stored", "externally_stored"]:
-            docs = db.collection(storage_type).get()
-            analytics[storage_type] = len(docs)
-            # implement logic for analytics aka charts to represent storage distribution
+        # Item counts come from cached count() aggregations and the storage
+        # distribution from the sharded counters, so no collection is scanned.
+        analytics = collection_counts(db, STORAGE_COLLECTIONS)
+        analytics["by_category"] = read_stats(db, STORAGE_COLLECTIONS)
         return analytics
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+# POST /api/inventory/analytics/rebuild
+@router.post("/api/inventory/analytics/rebuild")
+def rebuild_inventory_analytics():
+    """
+    Recomputes the per-category analytics counters from the stored items.
+    """
+    try:
+        return {storage: rebuild_stats(db, storage) for storage in STORAGE_COLLECTIONS}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# The catch-all routes come last: routes match in declaration order, and
+# these would otherwise take /search, /history, /analytics and /categories.
+
+# Function to retrieve all items from the inventory based on storage type.
+@router.get("/api/inventory/{storage}")
+def get_items1(storage, format: str = Query("json", pattern="^(json|ndjson)$")):
+    try:
+        if format == "ndjson":
+            return export_ndjson([storage])
+        storage_collection = db.collection(storage)  # Use storage type as collection name
+        docs = storage_collection.get()
+        items = []
+        for doc in docs:
+            items.append(doc.to_dict())
+        return items
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/api/inventory/{storage}/{itemId}")
+def get_item(storage: str, item_id: str):
+    try:
+        storage_collection = db.collection(storage)
+        doc_ref = storage_collection.document(item_id)
+        doc = doc_ref.get()
+        if doc.exists:
+            return doc.to_dict()
+        else:
+            raise HTTPException(status_code=404, detail="Item not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
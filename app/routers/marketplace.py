@@ -2,13 +2,15 @@ from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Query
 from firebase_admin import db
 from google.cloud import speech_v1p1beta1 as speech
 from app.helpers.ai_helpers import find_common_items
+from app.helpers.geo_helpers import pincodes_within
+from app.helpers.search_helpers import DEFAULT_PAGE_SIZE, CompiledFilter, FacetCounts, IndexUnavailable, ensure_inventory_index, paginate, pending_listing_publishes, query_cache, query_cache_key, start_inventory_index
 from app.models.model_types import MarketplaceQueryRequest
+from starlette.concurrency import run_in_threadpool
+from typing import Optional
 import io
 import uuid
 import os
 import dotenv
-from geopy.distance import distance as geopy_distance
-from geopy.geocoders import Nominatim
 
 # Google Cloud Services
 speech_client = speech.SpeechClient()
@@ -45,41 +47,40 @@ Multiple filters applied at the same time is also to be implemented.
 
 """
 
+@router.on_event("startup")
+def start_marketplace_index():
+    """
+    Starts loading the marketplace index before the first request needs it.
+    """
+    start_inventory_index()
+
+async def inventory_index():
+    """
+    Dependency returning the marketplace index; the first wait for its
+    snapshot runs off the event loop.
+    """
+    try:
+        return await run_in_threadpool(ensure_inventory_index)
+    except IndexUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
 @router.get("/marketplace")
-async def get_all_marketplace_items():
+async def get_all_marketplace_items(index=Depends(inventory_index)):
   """
   Retrieves all in-stock listings from the database.
   """
-  inventory_ref = db.reference("inventory")
-  # Query documents where item_status is "in stock"
-  query = inventory_ref.where("item_status", "==", "in stock")
-  documents = query.get()
-
-  items = []
-  for doc in documents:
-    # item_data = doc.to_dict()
-    item_data = dict(doc)
-    items.append(item_data)
-
-  return items
+  # Read straight from the materialized in-stock view
+  return index.lookup(index.in_stock_ids())
 
 @router.get("/marketplace/query={query}")
-async def get_marketplace_items_by_query(query):
+async def get_marketplace_items_by_query(query, index=Depends(inventory_index)):
     """
     Retrieves marketplace items based on a search query.
     """
-    inventory_ref = db.reference("inventory")
-    # Query documents where the name or description contains the query
-    query_results = inventory_ref.order_by_child("name").start_at(query).end_at(query + "\uf8ff").get()
-
-    items = []
-    for doc in query_results:
-        # item_data = dict(doc)
-        item_data = doc.to_dict()
-        if item_data["item_status"] == "in stock":  # Filter in-stock items
-            items.append(item_data)
+    # Query in-stock listings where the name or description contains the query
+    item_ids = index.search(query=query, in_stock=True)
 
-    return items
+    return index.lookup(item_ids)
 
 # @router.get("/marketplace/{item_category}/query={query}")
 # async def get_marketplace_items_by_category_and_query(item_category: str, query: str):
@@ -102,209 +103,152 @@ async def get_marketplace_items_by_query(query):
 #     return items
 
 @router.get("/marketplace/{item_category}/query={query}")
-async def get_marketplace_items_by_category_and_query(item_category, query):
+async def get_marketplace_items_by_category_and_query(item_category, query, index=Depends(inventory_index)):
     """
     Retrieves items based on category and a search query.
     """
-    inventory_ref = db.reference("inventory")
-    # Query documents by category and search query
-    query_results = inventory_ref.order_by_child("category").start_at(item_category).end_at(item_category + "\uf8ff")
-    query_results2 = inventory_ref.order_by_child("name").start_at(query).end_at(query + "\uf8ff")
+    # Intersect the category postings with the query postings
+    item_ids = index.search(query=query, category=item_category, in_stock=True)
 
-    # Find common items
-    common_items_Set = find_common_items(query_results, query_results2)
-    
-    items = []
-    for doc in common_items_Set:
-        # item_data = doc.to_dict()
-        item_data = dict(doc)
-        if item_data["item_status"] == "in stock":  # Filter in-stock items
-            items.append(item_data)
-
-    return items
+    return index.lookup(item_ids)
 
 @router.get("/marketplace/{farm}/query={query}")
-async def get_marketplace_items_by_farm_and_query(farm, query):
+async def get_marketplace_items_by_farm_and_query(farm, query, index=Depends(inventory_index)):
     """
     Retrieves items based on farm and a search query.
     """
-    inventory_ref = db.reference("inventory")
-    # Query documents by farm and search query
-    query_results = inventory_ref.order_by_child("farm").start_at(farm).end_at(farm + "\uf8ff")
-    query_results2 = inventory_ref.order_by_child("name").start_at(query).end_at(query + "\uf8ff")
-
-    # Find common items
-    common_items_set = find_common_items(query_results, query_results2)
+    # Intersect the farm postings with the query postings
+    item_ids = index.search(query=query, farm=farm, in_stock=True)
 
-    items = []
-    for doc in common_items_set:
-        item_data = dict(doc)
-        if item_data["item_status"] == "in stock":  # Filter in-stock items
-            items.append(item_data)
-
-    return items
+    return index.lookup(item_ids)
 
 @router.get("/marketplace/{item_category}")
-async def get_marketplace_items_by_category(item_category):
+async def get_marketplace_items_by_category(item_category, index=Depends(inventory_index)):
     """
     Retrieves items based on category.
     """
-    inventory_ref = db.reference("inventory")
-    # Query documents by category
-    query_results = inventory_ref.order_by_child("category").start_at(item_category).end_at(item_category + "\uf8ff")
+    item_ids = index.search(category=item_category, in_stock=True)
 
-    items = []
-    for doc in query_results:
-        item_data = dict(doc)
-        if item_data["item_status"] == "in stock":  # Filter in-stock items
-            items.append(item_data)
+    return index.lookup(item_ids)
 
-    return items
+def get_sorted_page(index, query, sorted_by, limit, cursor):
+    """
+    Returns one page of in-stock search results in `sorted_by` order.
+    """
+    # Query documents where name or description contains the query
+    entries = index.entries(index.search(query=query, in_stock=True))
+    try:
+        page, next_cursor = paginate(entries, sorted_by, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": [item_data for _, item_data in page], "next_cursor": next_cursor}
 
 @router.get("/marketplace/query={query}/sort_by_price")
-async def get_marketplace_items_by_query_and_sort_by_price(query):
+async def get_marketplace_items_by_query_and_sort_by_price(query, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=100), cursor: Optional[str] = None, index=Depends(inventory_index)):
     """
     Retrieves items based on a search query and sorts them by price.
+    Pass the returned `next_cursor` back as `cursor` to fetch the next page.
     """
-    inventory_ref = db.reference("inventory")
-
-    # Query documents where name or description contains the query
-    query_results = inventory_ref.order_by_child("name").start_at(query).end_at(query + "\uf8ff")
-    query_results2 = inventory_ref.order_by_child("description").start_at(query).end_at(query + "\uf8ff")
-
-    # Find common items
-    common_items_set = find_common_items(query_results, query_results2)
-
-    # Sort common items by price
-    sorted_items = sorted(common_items_set, key=lambda item: item["price"]["value"])
-
-    return sorted_items
+    return get_sorted_page(index, query, "price", limit, cursor)
 
 @router.get("/marketplace/query={query}/sort_by_quantity")
-async def get_marketplace_items_by_query_and_sort_by_quantity(query):
+async def get_marketplace_items_by_query_and_sort_by_quantity(query, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=100), cursor: Optional[str] = None, index=Depends(inventory_index)):
     """
     Retrieves items based on a search query and sorts them by quantity.
+    Pass the returned `next_cursor` back as `cursor` to fetch the next page.
     """
-    inventory_ref = db.reference("inventory")
-
-    # Query documents where name or description contains the query
-    query_results = inventory_ref.order_by_child("name").start_at(query).end_at(query + "\uf8ff")
-    query_results2 = inventory_ref.order_by_child("description").start_at(query).end_at(query + "\uf8ff")
-
-    # Find common items
-    common_items_set = find_common_items(query_results, query_results2)
-
-    # Sort common items by quantity
-    sorted_items = sorted(common_items_set, key=lambda item: item["quantity"]["value"])
-
-    return sorted_items
+    return get_sorted_page(index, query, "quantity", limit, cursor)
 
 @router.get("/marketplace/query={query}/sorted_by_ratings")
-async def get_marketplace_items_by_query_and_sort_by_ratings(query):
+async def get_marketplace_items_by_query_and_sort_by_ratings(query, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=100), cursor: Optional[str] = None, index=Depends(inventory_index)):
     """
     Retrieves items based on a search query and sorts them by average rating.
+    Pass the returned `next_cursor` back as `cursor` to fetch the next page.
     """
-    inventory_ref = db.reference("inventory")
-
-    # Query documents where name or description contains the query
-    query_results = inventory_ref.order_by_child("name").start_at(query).end_at(query + "\uf8ff")
-    query_results2 = inventory_ref.order_by_child("description").start_at(query).end_at(query + "\uf8ff")
-
-    # Find common items
-    common_items_set = find_common_items(query_results, query_results2)
-
-    # Sort common items by average rating
-    sorted_items = sorted(common_items_set, key=lambda item: item["average_rating"], reverse=True)
-
-    return sorted_items
+    return get_sorted_page(index, query, "ratings", limit, cursor)
 
 @router.get("/marketplace/{pincode}/query={query}")
-async def get_marketplace_items_by_pincode_and_query(pincode, query):
+async def get_marketplace_items_by_pincode_and_query(pincode, query, index=Depends(inventory_index)):
     """
     Retrieves items based on a pincode and a search query.
     """
-    inventory_ref = db.reference("inventory")
-
-    # Query documents by pincode and search query
-    query_results = inventory_ref.order_by_child("pincode").start_at(pincode).end_at(pincode + "\uf8ff")
-    query_results2 = inventory_ref.order_by_child("name").start_at(query).end_at(query + "\uf8ff")
-
-    # Find common items
-    common_items_set = find_common_items(query_results, query_results2)
+    # Intersect the pincode postings with the query postings
+    item_ids = index.search(query=query, pincode=pincode, in_stock=True)
 
-    items = []
-    for doc in common_items_set:
-        item_data = dict(doc)
-        if item_data["item_status"] == "in stock":  # Filter in-stock items
-            items.append(item_data)
+    return index.lookup(item_ids)
 
-    return items
+@router.get("/marketplace/cache/stats")
+async def get_marketplace_cache_stats():
+    """
+    Returns hit/miss statistics of the marketplace query result cache, and
+    how many listings have writes waiting to reach the index.
+    """
+    return {**query_cache.stats(), "pending_publishes": pending_listing_publishes()}
 
 @router.post("/marketplace/query")
-async def query_marketplace(request: MarketplaceQueryRequest):
+async def query_marketplace(request: MarketplaceQueryRequest, index=Depends(inventory_index)):
     """
     Retrieves marketplace items based on a complex query with multiple filters, sorting options, and location radius filtering.
     """
     try:
-        inventory_ref = db.reference("inventory")
-        query_results = inventory_ref.get() or []
-        items = list(query_results.values())
-
-        # Step 1: Apply Location Radius Filter First
+        # Popular queries repeat; serve them from the result cache, which
+        # inventory writes invalidate by category and pincode.
+        cache_key = query_cache_key(request)
+        cached = query_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        cache_generation = query_cache.generation()
+
+        # Step 1: Apply Location Radius Filter through the spatial index.
+        # With a radius the pincode is the search centre, not an exact match.
+        nearby_pincodes = None
         if request.radius and request.pincode:
-
-            geolocator = Nominatim(user_agent="marketplace_locator")
-            location_ref = db.reference("locations").child(request.pincode).get()
-            if location_ref:
-                user_lat, user_lon = location_ref["lat"], location_ref["lon"]
-                filtered_items = []
-                for item in items:
-                    item_location = db.reference("locations").child(item["pincode"]).get()
-                    if item_location:
-                        item_lat, item_lon = item_location["lat"], item_location["lon"]
-                        user_coords = (user_lat, user_lon)
-                        item_coords = (item_lat, item_lon)
-                        distance = geopy_distance(user_coords, item_coords).km
-                        if distance <= request.radius:
-                            filtered_items.append(item)
-                items = filtered_items
-
-        # Step 2: Apply Category, Farm, and Pincode Filters
-        if request.category or request.farm or request.pincode:
-            items = [item for item in items if
-                     (not request.category or item.get("category") == request.category) and
-                     (not request.farm or item.get("farm") == request.farm) and
-                     (not request.pincode or item.get("pincode") == request.pincode)]
-
-        # Step 3: Apply Custom and Additional Filters
-        if request.filters:
-            for filter_key, filter_value in request.filters.items():
-                if filter_key == "min_price":
-                    items = [item for item in items if item["price"]["value"] >= filter_value]
-                elif filter_key == "max_price":
-                    items = [item for item in items if item["price"]["value"] <= filter_value]
-                elif filter_key == "min_quantity":
-                    items = [item for item in items if item["quantity"]["value"] >= filter_value]
-                elif filter_key == "max_quantity":
-                    items = [item for item in items if item["quantity"]["value"] <= filter_value]
-                elif filter_key == "rating_threshold":
-                    items = [item for item in items if item.get("average_rating", 0) >= filter_value]
-
-        # Step 4: Filter by Item Status
-        items = [item for item in items if item.get("item_status") == "in stock"]
-
-        # Step 5: Sorting
-        if request.sorted_by:
-            sort_key = {
-                "ratings": lambda x: x.get("average_rating", 0),
-                "price": lambda x: x.get("price", {}).get("value", 0),
-                "quantity": lambda x: x.get("quantity", {}).get("value", 0),
-            }.get(request.sorted_by)
-
-            if sort_key:
-                reverse = request.sorted_by == "ratings"
-                items.sort(key=sort_key, reverse=reverse)
-
-        return {"items": items}
+            nearby_pincodes = pincodes_within(request.pincode, request.radius, index.pincodes())
+            if nearby_pincodes is None:
+                # Without a centre there is no circle; never widen to everywhere
+                raise HTTPException(status_code=404, detail="Unknown pincode.")
+
+        # Step 2: Resolve text, category, farm and pincode through the index.
+        item_ids = index.search(
+            query=request.query,
+            category=request.category,
+            farm=request.farm,
+            pincode=None if request.radius else request.pincode,
+            pincodes=nearby_pincodes,
+            in_stock=True,
+        )
+
+        # Step 3: Apply the custom filters and the stock check as one compiled,
+        # selectivity-ordered predicate (vectorized for large candidate sets),
+        # counting facets over the matches in the same pass. An unconstrained
+        # query matches every in-stock listing, whose facet counts the index
+        # already maintains.
+        try:
+            compiled_filter = CompiledFilter(request.filters)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        unconstrained = not (request.query.strip() or request.category or request.farm
+                             or request.pincode or request.filters)
+        facet_counts = None if unconstrained else FacetCounts()
+        entries = compiled_filter.select(index, item_ids, facet_counts)
+        facets = index.facet_counts() if unconstrained else facet_counts.as_dict()
+
+        # Step 4: Sorting and pagination (top-k for the first page, keyset after)
+        try:
+            page, next_cursor = paginate(entries, request.sorted_by, request.limit, request.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        response = {"items": [item for _, item in page], "next_cursor": next_cursor, "facets": facets}
+        query_cache.put(
+            cache_key,
+            response,
+            category=request.category,
+            pincode=None if request.radius else request.pincode,
+            generation=cache_generation,
+        )
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -7,6 +7,8 @@ import datetime
 import dotenv
 import os
 from app.controllers.auth import UserAuth
+from app.helpers.reservation_helpers import HoldMismatch, HoldNotActive, InsufficientStock, ReservationError, commit_hold, default_client, locate_item, purchase
+from starlette.concurrency import run_in_threadpool
 from ..models.model_types import OrderCancellation, OrderFeedback, Order, OrderStatusUpdate
 
 router = APIRouter()
@@ -24,10 +26,36 @@ async def create_order(order: Order, user=Depends(UserAuth.get_current_user)):
     if user["uid"] != order.farmerId:
         raise HTTPException(status_code=403, detail="Unauthorized to create order")
 
+    # Stock leaves the inventory through a reservation, so orders cannot oversell
+    client = default_client()
+    try:
+        if order.hold_id:
+            # The hold must be the buyer's, for this item and quantity
+            expect = {"holder": order.buyerId, "quantity": order.quantity}
+            for field in ("item_id", "storage"):
+                if getattr(order, field):
+                    expect[field] = getattr(order, field)
+            hold = await run_in_threadpool(commit_hold, client, order.hold_id, expect)
+        elif order.item_id:
+            storage = order.storage or await run_in_threadpool(locate_item, client, order.item_id)
+            if not storage:
+                raise HTTPException(status_code=404, detail="Item not found")
+            hold = await run_in_threadpool(purchase, client, storage, order.item_id, order.quantity, order.buyerId)
+        else:
+            hold = None
+    except HoldMismatch as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except (InsufficientStock, HoldNotActive) as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ReservationError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
     order_id = str(uuid4())
     order_data = order.dict()
     order_data["orderId"] = order_id
     order_data["createdAt"] = datetime.datetime.utcnow().isoformat()
+    if hold:
+        order_data["hold_id"] = hold["hold_id"]
     
     db.collection("orders").document(order_id).set(order_data)
     return {"message": "Order created successfully", "orderId": order_id}
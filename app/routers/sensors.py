@@ -1,7 +1,21 @@
-from fastapi import APIRouter, HTTPException, Depends
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from google.cloud import firestore
+from starlette.concurrency import run_in_threadpool
 from app.models.model_types import AcknowledgeAlert, SensorConfig, SensorData, SensorThresholds
 from app.controllers.auth import UserAuth
+from app.helpers.alert_helpers import invalidate_thresholds
+from app.helpers.anomaly_helpers import backfill
+from app.helpers.buffer_helpers import recent_readings
+from app.helpers.diagnostics_helpers import read_diagnostics, rebuild_diagnostics
+from app.helpers.heartbeat_helpers import ensure_heartbeat_tracker, tracker
+from app.helpers.history_helpers import as_utc
+from app.helpers.rollup_helpers import query_sensor_history, rebuild_rollups
+from app.helpers.sensor_helpers import BatchTooLarge, decode_readings, ingest_readings
+from app.helpers.stream_helpers import STREAM_KEEPALIVE_SECONDS, farm_topic, hub, sensor_topic, sse_events
 
 router = APIRouter()
 
@@ -9,46 +23,190 @@ router = APIRouter()
 db = firestore.Client()
 sensors_ref = db.collection("sensors_data")
 
+@router.on_event("startup")
+def start_heartbeat_tracker():
+    """
+    Starts flipping silent sensors offline without waiting for the first ingest.
+    """
+    ensure_heartbeat_tracker(db)
+
 @router.post("/api/sensors/data")
 async def ingest_sensor_data(data: SensorData, user=Depends(UserAuth.get_current_user)):
     """
     Ingest sensor readings (e.g., temperature, humidity, soil moisture) into the system.
     """
     try:
-        sensor_id = data.sensor_id
-        sensor_data = {
-            "user_id": user.uid,
-            "temperature": data.temperature,
-            "humidity": data.humidity,
-            "soil_moisture": data.soil_moisture,
-            "timestamp": data.timestamp
-        }
-        
-        # Save data to Firestore
-        sensors_ref.document(sensor_id).collection("readings").add(sensor_data)
-        
-        return {"message": "Sensor data ingested successfully", "sensor_id": sensor_id}
+        result = await run_in_threadpool(ingest_readings, db, user.uid, [data.model_dump()])
+        if result["rejected"]:
+            raise HTTPException(status_code=422, detail=result["rejected"][0]["error"])
+        if result["failed"]:
+            raise HTTPException(status_code=500, detail=result["failed"][0]["error"])
+
+        return {"message": "Sensor data ingested successfully", "sensor_id": data.sensor_id}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/api/sensors/data/batch")
+async def ingest_sensor_data_batch(request: Request, user=Depends(UserAuth.get_current_user)):
+    """
+    Ingest many readings at once, e.g. a gateway replaying its offline buffer.
+    The body is a list of readings (objects, or arrays of sensor_id, timestamp,
+    temperature, humidity, soil_moisture), or {"readings": [...]}, sent as JSON
+    or as msgpack (Content-Type: application/msgpack). Timestamps may be ISO
+    strings or epoch seconds. Stored readings are idempotent per sensor and
+    timestamp, but the rollups and diagnostics count a resent reading again:
+    only resend the readings listed under "failed". "stage_errors" reports
+    derived state that could not be updated; the readings themselves are
+    stored, and the rebuild endpoints repair it.
+    """
+    try:
+        body = await request.body()
+        try:
+            readings = decode_readings(body, request.headers.get("content-type"))
+        except BatchTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except ValueError as e:  # includes JSON and msgpack decoding errors
+            raise HTTPException(status_code=400, detail=f"Malformed batch: {str(e) or type(e).__name__}")
+
+        result = await run_in_threadpool(ingest_readings, db, user.uid, readings)
+        if readings and not result["accepted"] and result["failed"]:
+            raise HTTPException(status_code=500, detail=result["failed"][0]["error"])
+        return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/api/sensors/data/{sensorId}")
-async def get_sensor_data(sensorId: str, user=Depends(UserAuth.get_current_user)):
+async def get_sensor_data(
+    sensorId: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: Optional[int] = Query(None, ge=1, description="Maximum seconds between points"),
+    user=Depends(UserAuth.get_current_user),
+):
     """
-    Retrieve sensor readings for a specific sensor by its ID.
+    Retrieve sensor readings for a specific sensor by its ID, over [start, end)
+    (by default the last 24 hours). Readings come downsampled from the coarsest
+    rollup tier (1m, 1h, 1d) that meets `resolution`; raw readings only when it
+    is finer than a minute and the range is short enough, else the 1m tier.
     """
     try:
-        # Fetch sensor data from Firestore
-        readings_ref = sensors_ref.document(sensorId).collection("readings")
-        readings = readings_ref.stream()
-        
-        sensor_data = []
-        for reading in readings:
-            sensor_data.append(reading.to_dict())
-        
-        if not sensor_data:
+        start = as_utc(start) if start else None
+        end = as_utc(end) if end else None
+        if start and end and start >= end:
+            raise HTTPException(status_code=400, detail="start must be before end")
+        history = await run_in_threadpool(query_sensor_history, db, sensorId, start, end, resolution)
+
+        if not history["data"]:
             raise HTTPException(status_code=404, detail="No data found for the sensor.")
-        
-        return {"sensor_id": sensorId, "data": sensor_data}
+
+        return {"sensor_id": sensorId, **history}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/api/sensors/data/{sensorId}/recent")
+async def get_recent_sensor_data(
+    sensorId: str,
+    minutes: int = Query(15, ge=1, le=24 * 60),
+    user=Depends(UserAuth.get_current_user),
+):
+    """
+    Retrieve a sensor's readings of the last `minutes`, served from its
+    in-memory ring buffer when that covers the window.
+    """
+    try:
+        since = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+        source, readings = await run_in_threadpool(recent_readings, db, sensorId, since)
+        return {"sensor_id": sensorId, "since": since, "source": source, "data": readings}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/api/sensors/{sensorId}/rollups/rebuild")
+async def rebuild_sensor_rollups(sensorId: str, start: datetime, end: datetime, user=Depends(UserAuth.get_current_user)):
+    """
+    Recompute a sensor's rollups from its raw readings for the days overlapping [start, end).
+    """
+    try:
+        folded = await run_in_threadpool(rebuild_rollups, db, sensorId, as_utc(start), as_utc(end))
+        return {"sensor_id": sensorId, "readings": folded}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def stream_topics(sensor_id, user):
+    # One sensor, or every sensor the caller ingests for (their farm).
+    return [sensor_topic(sensor_id)] if sensor_id else [farm_topic(user.uid)]
+
+@router.websocket("/api/sensors/stream/ws")
+async def stream_sensor_updates_ws(websocket: WebSocket, sensor_id: Optional[str] = None, user=Depends(UserAuth.get_current_user)):
+    """
+    Push live readings of one sensor (sensor_id) or of the caller's farm over a WebSocket.
+    """
+    await websocket.accept()
+    subscription = hub.subscribe(stream_topics(sensor_id, user))
+    try:
+        while True:
+            updates = await subscription.next_batch(STREAM_KEEPALIVE_SECONDS)
+            for update in updates or [{"type": "keepalive"}]:
+                await websocket.send_text(json.dumps(update, default=str))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.unsubscribe(subscription)
+
+@router.get("/api/sensors/stream/sse")
+async def stream_sensor_updates_sse(request: Request, sensor_id: Optional[str] = None, user=Depends(UserAuth.get_current_user)):
+    """
+    Push live readings of one sensor (sensor_id) or of the caller's farm as Server-Sent Events.
+    """
+    try:
+        subscription = hub.subscribe(stream_topics(sensor_id, user))
+        return StreamingResponse(
+            sse_events(subscription, request.is_disconnected),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/api/sensors/{sensorId}/anomalies/backfill")
+async def backfill_sensor_anomalies(
+    sensorId: str,
+    start: datetime,
+    end: datetime,
+    write_alerts: bool = False,
+    user=Depends(UserAuth.get_current_user),
+):
+    """
+    Run anomaly detection over a sensor's stored readings in [start, end),
+    optionally recording the anomalies as alerts. When the range reaches the
+    newest reading (or live detection has no state yet), live detection
+    resumes from where it ends.
+    """
+    try:
+        start, end = as_utc(start), as_utc(end)
+        if start >= end:
+            raise HTTPException(status_code=400, detail="start must be before end")
+        anomalies = await run_in_threadpool(backfill, db, sensorId, start, end, write_alerts, True)
+        return {
+            "sensor_id": sensorId,
+            "anomalies": [
+                {
+                    "metric": anomaly["metric"],
+                    "timestamp": anomaly["reading"]["recorded_at"].isoformat(),
+                    "value": anomaly["reading"][anomaly["metric"]],
+                    "expected": anomaly["expected"],
+                    "z_score": anomaly["z"],
+                }
+                for anomaly in anomalies
+            ],
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -84,6 +242,7 @@ async def update_sensor_config(sensorId: str, config: SensorConfig, user=Depends
             "threshold_soil_moisture": config.threshold_soil_moisture,
             "user_id": user.uid
         })
+        invalidate_thresholds(sensorId)
 
         return {"message": "Sensor configuration updated successfully", "sensor_id": sensorId}
     except Exception as e:
@@ -93,8 +252,13 @@ async def update_sensor_config(sensorId: str, config: SensorConfig, user=Depends
 async def get_sensor_status(sensorId: str, user=Depends(UserAuth.get_current_user)):
     """
     Retrieve the status of a specific sensor (e.g., online/offline, last connected).
+    Sensors this instance hears from are answered from memory.
     """
     try:
+        status = tracker.status(sensorId)
+        if status is not None:
+            return {"sensor_id": sensorId, "status": status}
+
         # Fetch sensor status from Firestore
         status_ref = sensors_ref.document(sensorId).collection("status").document("current_status")
         status_data = status_ref.get()
@@ -103,6 +267,8 @@ async def get_sensor_status(sensorId: str, user=Depends(UserAuth.get_current_use
             raise HTTPException(status_code=404, detail="Sensor status not found")
         
         return {"sensor_id": sensorId, "status": status_data.to_dict()}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -123,6 +289,7 @@ async def set_sensor_thresholds(thresholds: SensorThresholds, user=Depends(UserA
                 "soil_moisture_threshold": thresholds.soil_moisture_threshold,
                 "user_id": user.uid
             })
+            invalidate_thresholds(thresholds.sensor_id)
             return {"message": "Per-sensor thresholds set successfully", "sensor_id": thresholds.sensor_id}
 
         else:
@@ -134,6 +301,7 @@ async def set_sensor_thresholds(thresholds: SensorThresholds, user=Depends(UserA
                 "soil_moisture_threshold": thresholds.soil_moisture_threshold,
                 "user_id": user.uid
             })
+            invalidate_thresholds()
             return {"message": "Global thresholds set successfully"}
     
     except Exception as e:
@@ -143,47 +311,28 @@ async def set_sensor_thresholds(thresholds: SensorThresholds, user=Depends(UserA
 async def get_sensors_diagnostics(user=Depends(UserAuth.get_current_user)):
     """
     Retrieve aggregated diagnostics for multiple sensors (e.g., average temperature, overall sensor status).
+    Served from the running aggregates kept at ingest, not from the readings.
     """
     try:
-        # Retrieve sensor data from Firestore
-        all_sensors_ref = sensors_ref.stream()
-
-        total_temperature = 0
-        total_humidity = 0
-        total_soil_moisture = 0
-        active_sensors = 0
-        sensor_count = 0
-
-        for sensor in all_sensors_ref:
-            sensor_data = sensor.to_dict()
-            readings_ref = sensors_ref.document(sensor.id).collection("readings").stream()
-
-            for reading in readings_ref:
-                data = reading.to_dict()
-                total_temperature += data.get("temperature", 0)
-                total_humidity += data.get("humidity", 0)
-                total_soil_moisture += data.get("soil_moisture", 0)
-                sensor_count += 1
-
-                # Check if the sensor is active
-                if data.get("status", "inactive") == "active":
-                    active_sensors += 1
-
-        if sensor_count == 0:
+        diagnostics = await run_in_threadpool(read_diagnostics, db)
+
+        if not diagnostics["total_readings"]:
             raise HTTPException(status_code=404, detail="No sensor data found.")
 
-        avg_temperature = total_temperature / sensor_count
-        avg_humidity = total_humidity / sensor_count
-        avg_soil_moisture = total_soil_moisture / sensor_count
+        return diagnostics
 
-        return {
-            "average_temperature": avg_temperature,
-            "average_humidity": avg_humidity,
-            "average_soil_moisture": avg_soil_moisture,
-            "active_sensors": active_sensors,
-            "total_sensors": sensor_count
-        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/api/sensors/diagnostics/rebuild")
+async def rebuild_sensors_diagnostics(user=Depends(UserAuth.get_current_user)):
+    """
+    Recompute the diagnostics aggregates from the stored readings.
+    """
+    try:
+        return await run_in_threadpool(rebuild_diagnostics, db)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
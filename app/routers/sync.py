@@ -3,6 +3,8 @@ from google.cloud import firestore
 from typing import List
 from app.models.model_types import SyncAsset, SyncChatRequest, SyncConflictResolution, SyncInventoryRequest, SyncOrderRequest, UserSettingsSync
 from app.controllers.auth import UserAuth
+from app.helpers.inventory_helpers import stock_status
+from app.helpers.search_helpers import index_inventory_item, patch_inventory_item, unindex_inventory_item
 import time
 import random
 
@@ -21,24 +23,34 @@ async def sync_inventory(sync_request: SyncInventoryRequest, user=Depends(UserAu
             item_ref = db.collection("inventory").document(item.item_id)
 
             if item.action == 'add':
-                item_ref.set({
+                item_data = {
                     "name": item.name,
                     "category": item.category,
                     "quantity": item.quantity,
                     "price": item.price,
                     "image_url": item.image_url,
+                    "item_status": stock_status(None, item.quantity),
                     "user_id": user.uid
-                })
+                }
+                item_ref.set(item_data)
+                index_inventory_item("inventory", item.item_id, item_data)
             elif item.action == 'edit':
-                item_ref.update({
+                # Statuses other than in/out of stock (sold, reserved, ...) are kept
+                snapshot = item_ref.get()
+                current_status = snapshot.to_dict().get("item_status") if snapshot.exists else None
+                item_data = {
                     "name": item.name,
                     "category": item.category,
                     "quantity": item.quantity,
                     "price": item.price,
-                    "image_url": item.image_url
-                })
+                    "image_url": item.image_url,
+                    "item_status": stock_status(current_status, item.quantity)
+                }
+                item_ref.update(item_data)
+                patch_inventory_item("inventory", item.item_id, item_data)
             elif item.action == 'remove':
                 item_ref.delete()
+                unindex_inventory_item("inventory", item.item_id)
 
         return {"message": "Inventory sync successful."}
     except Exception as e:
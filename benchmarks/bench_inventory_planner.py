@@ -0,0 +1,179 @@
+"""
+Benchmark: inventory search and category lookups with and without pushdown.
+
+Runs against an in-memory stand-in for Firestore that charges a round trip per
+query and a transfer cost per returned document, which is what dominates these
+endpoints in production. Compares:
+
+- search_inventory: full collection scans filtered in Python vs. the query plan
+  (category and location pushed down, keyword checked locally);
+- get_categories: one equality query per category vs. a single projected `in`
+  query.
+
+Run from the repository root:
+    python -m benchmarks.bench_inventory_planner
+"""
+import random
+import threading
+import time
+from app.helpers.inventory_helpers import InventoryQueryPlan, read_collections
+
+ROUND_TRIP_S = 0.025  # per query
+PER_DOCUMENT_S = 0.00004  # transfer and decode, per returned document
+PER_FIELD_FRACTION = 0.15  # cost of a projected document relative to a full one
+
+COLLECTIONS = ["self_stored", "externally_stored"]
+CATEGORIES = ["vegetables", "fruits", "grains", "pulses", "spices", "dairy", "oilseeds", "flowers", "herbs", "nuts", "tubers", "greens"]
+LOCATIONS = [f"district-{i}" for i in range(40)]
+
+
+class SimulatedSnapshot:
+    def __init__(self, data):
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class SimulatedQuery:
+    def __init__(self, store, documents, conditions=(), fields=None, order=None, limit=None, after=None):
+        self.store = store
+        self.documents = documents
+        self.conditions = list(conditions)
+        self.fields = fields
+        self.order, self.limit_to, self.after = order, limit, after
+
+    def _copy(self, **changes):
+        state = dict(conditions=self.conditions, fields=self.fields, order=self.order, limit=self.limit_to, after=self.after)
+        state.update(changes)
+        return SimulatedQuery(self.store, self.documents, **state)
+
+    def where(self, field, op, value):
+        return self._copy(conditions=self.conditions + [(field, op, value)])
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def order_by(self, field):
+        return self._copy(order=field)
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(after=snapshot)
+
+    def _matches(self, doc):
+        for field, op, value in self.conditions:
+            if op == "==" and doc.get(field) != value:
+                return False
+            if op == "in" and doc.get(field) not in value:
+                return False
+        return True
+
+    def stream(self):
+        results = [doc for doc in self.documents if self._matches(doc)]
+        if self.fields:
+            results = [{field: doc.get(field) for field in self.fields} for doc in results]
+        per_document = PER_DOCUMENT_S * (PER_FIELD_FRACTION if self.fields else 1.0)
+        self.store.charge(len(results))
+        time.sleep(ROUND_TRIP_S + per_document * len(results))
+        return iter([SimulatedSnapshot(doc) for doc in results])
+
+
+class SimulatedFirestore:
+    def __init__(self, collections):
+        self.collections = collections
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.documents_read = 0
+
+    def charge(self, documents):
+        with self._lock:
+            self.queries += 1
+            self.documents_read += documents
+
+    def collection(self, name):
+        return SimulatedQuery(self, self.collections.get(name, []))
+
+
+def build_store(size, seed=11):
+    rng = random.Random(seed)
+    collections = {}
+    for collection in COLLECTIONS:
+        collections[collection] = [
+            {
+                "name": f"{rng.choice(['organic', 'fresh', 'dried', 'graded'])} {rng.choice(CATEGORIES)} lot {i}",
+                "category": rng.choice(CATEGORIES),
+                "location": rng.choice(LOCATIONS),
+                "quantity": {"value": rng.randint(1, 500), "unit": "kg"},
+                "price": {"value": round(rng.uniform(5, 300), 2), "unit": "kg"},
+                "storage": collection,
+            }
+            for i in range(size)
+        ]
+    return SimulatedFirestore(collections)
+
+
+def legacy_search(client, category, keyword, location):
+    # search_inventory before the planner: scan every collection, filter here.
+    results = []
+    for item in read_collections(client, COLLECTIONS):
+        if (not category or item.get("category") == category) and \
+           (not keyword or keyword.lower() in item.get("name", "").lower()) and \
+           (not location or item.get("location") == location):
+            results.append(item)
+    return results
+
+
+def planned_search(client, category, keyword, location):
+    predicates = [lambda item: keyword.lower() in item.get("name", "").lower()] if keyword else []
+    plan = InventoryQueryPlan(COLLECTIONS, {"category": category, "location": location}, predicates)
+    return list(plan.execute(client))
+
+
+def legacy_categories(client, storage, categories):
+    # get_categories before the planner: one equality query per category.
+    found = set()
+    for category in categories:
+        for doc in client.collection(storage).where("category", "==", category).stream():
+            found.add(doc.to_dict().get("category"))
+    return found
+
+
+def planned_categories(client, storage, categories):
+    plan = InventoryQueryPlan([storage], {"category": categories}, fields=["category"])
+    return {item.get("category") for item in plan.execute(client)}
+
+
+def measure(client, fn, *args):
+    client.queries = client.documents_read = 0
+    start = time.perf_counter()
+    result = fn(client, *args)
+    return (time.perf_counter() - start) * 1000, client.queries, client.documents_read, result
+
+
+def main():
+    print(f"{'case':<28} {'docs/coll':>9} {'path':>8} {'ms':>9} {'queries':>8} {'docs read':>10} {'matches':>8}")
+    for size in (2_000, 20_000):
+        client = build_store(size)
+        cases = [
+            ("search category+location", legacy_search, planned_search, ("grains", None, "district-7")),
+            ("search category+keyword", legacy_search, planned_search, ("fruits", "organic", None)),
+            ("categories x4", legacy_categories, planned_categories, ("self_stored", CATEGORIES[:4])),
+        ]
+        for label, legacy, planned, args in cases:
+            rows = []
+            for path, fn in (("legacy", legacy), ("planned", planned)):
+                rows.append((path,) + measure(client, fn, *args))
+            legacy_result, planned_result = rows[0][4], rows[1][4]
+            if isinstance(legacy_result, set):
+                assert legacy_result == planned_result
+            else:
+                assert len(legacy_result) == len(planned_result)
+            for path, ms, queries, documents, result in rows:
+                print(f"{label:<28} {size:>9} {path:>8} {ms:>9.1f} {queries:>8} {documents:>10} {len(result):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark: MarketplaceQueryRequest.filters evaluation.
+
+Compares the original per-key list comprehensions with the compiled,
+selectivity-ordered predicate (row path) and the NumPy columnar path.
+
+Run from the repository root:
+    python -m benchmarks.bench_marketplace_filters
+"""
+import random
+import time
+from app.helpers.search_helpers import CompiledFilter, InventoryIndex
+
+FILTERS = {"min_price": 10, "max_price": 60, "min_quantity": 50, "rating_threshold": 4.0}
+CATEGORIES = ["vegetables", "fruits", "grains", "pulses", "spices", "dairy"]
+
+
+def build_catalog(size, seed=7):
+    rng = random.Random(seed)
+    return {
+        f"item{i:07d}": {
+            "name": f"item {i}",
+            "category": rng.choice(CATEGORIES),
+            "price": {"value": round(rng.uniform(1, 200), 2), "unit": "kg"},
+            "quantity": {"value": rng.randint(0, 1000), "unit": "kg"},
+            "average_rating": round(rng.uniform(0, 5), 1),
+            "item_status": "in stock" if rng.random() < 0.8 else "out of stock",
+        }
+        for i in range(size)
+    }
+
+
+def legacy_filter(items, filters):
+    # The pre-compilation implementation of query_marketplace steps 3 and 4.
+    for filter_key, filter_value in filters.items():
+        if filter_key == "min_price":
+            items = [item for item in items if item["price"]["value"] >= filter_value]
+        elif filter_key == "max_price":
+            items = [item for item in items if item["price"]["value"] <= filter_value]
+        elif filter_key == "min_quantity":
+            items = [item for item in items if item["quantity"]["value"] >= filter_value]
+        elif filter_key == "max_quantity":
+            items = [item for item in items if item["quantity"]["value"] <= filter_value]
+        elif filter_key == "rating_threshold":
+            items = [item for item in items if item.get("average_rating", 0) >= filter_value]
+    return [item for item in items if item.get("item_status") == "in stock"]
+
+
+def best_of(fn, repeat=5):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000, result
+
+
+def main():
+    print(f"{'listings':>10} {'legacy ms':>10} {'fused ms':>10} {'columnar ms':>12} {'matches':>8}")
+    for size in (1_000, 10_000, 100_000):
+        catalog = build_catalog(size)
+        index = InventoryIndex()
+        index.load(catalog)
+        item_ids = list(catalog)
+        compiled = CompiledFilter(FILTERS)
+
+        legacy_ms, legacy = best_of(lambda: legacy_filter(index.lookup(item_ids), FILTERS))
+        fused_ms, fused = best_of(lambda: compiled.apply_rows(index, item_ids))
+        columnar_ms, columnar = best_of(lambda: index.entries(compiled.apply_columns(index, item_ids)))
+
+        assert len(legacy) == len(fused) == len(columnar)
+        print(f"{size:>10} {legacy_ms:>10.2f} {fused_ms:>10.2f} {columnar_ms:>12.2f} {len(fused):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark: typo-tolerant, transliteration-aware marketplace text search.
+
+Builds a synthetic 100k-listing catalog and reports latency percentiles of
+InventoryIndex.search for exact, misspelled, romanized-Hindi and Devanagari
+queries.
+
+Run from the repository root:
+    python -m benchmarks.bench_marketplace_search
+"""
+import random
+import time
+from app.helpers.search_helpers import InventoryIndex
+
+PRODUCE = [
+    "tomato", "potato", "onion", "wheat", "rice", "paddy", "maize", "okra", "cauliflower",
+    "brinjal", "chilli", "ginger", "garlic", "turmeric", "coriander", "banana", "mango",
+    "apple", "orange", "grapes", "carrot", "radish", "spinach", "pumpkin", "cucumber",
+]
+ADJECTIVES = ["fresh", "organic", "local", "premium", "desi", "hybrid", "red", "green", "bulk"]
+QUERIES = [
+    "tomato", "tomatoe", "tamatar", "टमाटर", "pyaaz", "प्याज़", "aloo", "potatoe",
+    "gralic", "organic chilli", "lehsun", "bhindi", "desi tamatr", "cauliflowr", "mirchi",
+]
+
+
+def build_catalog(size, seed=11):
+    rng = random.Random(seed)
+    return {
+        f"item{i:07d}": {
+            "name": f"{rng.choice(ADJECTIVES)} {rng.choice(PRODUCE)}",
+            "description": f"{rng.choice(ADJECTIVES)} produce from farm {rng.randint(1, 5000)}",
+            "category": "vegetables",
+            "item_status": "in stock",
+        }
+        for i in range(size)
+    }
+
+
+def main(size=100_000, rounds=20):
+    index = InventoryIndex()
+    start = time.perf_counter()
+    index.load(build_catalog(size))
+    print(f"indexed {size} listings in {time.perf_counter() - start:.1f}s")
+
+    timings = []
+    for _ in range(rounds):
+        for query in QUERIES:
+            start = time.perf_counter()
+            index.search(query=query, in_stock=True)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    pick = lambda q: timings[min(int(len(timings) * q), len(timings) - 1)]
+    print(f"queries: {len(timings)}  p50: {pick(0.50):.2f} ms  p95: {pick(0.95):.2f} ms  p99: {pick(0.99):.2f} ms")
+    for query in QUERIES:
+        print(f"  {query!r:>18}: {len(index.search(query=query, in_stock=True))} matches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark: cost and output of the inline threshold alert evaluator.
+
+Feeds a day of readings from a fleet of sensors, a share of them noisy and
+hovering around their temperature threshold, through the evaluator with
+thresholds already cached, and reports the time per reading and the alerts
+raised. The naive count is what one alert per breaching reading would write.
+
+Run from the repository root:
+    python -m benchmarks.bench_sensor_alerts
+"""
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from app.helpers.alert_helpers import AlertEvaluator
+
+SENSORS = 1000
+READINGS_PER_SENSOR = 288  # a day at one reading every 5 minutes
+NOISY_SHARE = 0.1
+THRESHOLDS = (35.0, 90.0, 45.0)  # temperature, humidity, soil_moisture
+
+
+def fleet_readings(seed=3):
+    rng = random.Random(seed)
+    start = datetime(2026, 6, 1, tzinfo=timezone.utc)
+    noisy = set(rng.sample(range(SENSORS), int(SENSORS * NOISY_SHARE)))
+    readings = []
+    for step in range(READINGS_PER_SENSOR):
+        at = start + timedelta(minutes=5 * step)
+        for sensor in range(SENSORS):
+            # Noisy sensors jitter across the threshold; the rest stay well below.
+            temperature = rng.gauss(35.0, 1.5) if sensor in noisy else rng.gauss(26.0, 2.0)
+            readings.append({
+                "sensor_id": f"field-{sensor}",
+                "temperature": temperature,
+                "humidity": rng.uniform(40, 80),
+                "soil_moisture": rng.uniform(15, 40),
+                "recorded_at": at,
+            })
+    return readings
+
+
+def main():
+    readings = fleet_readings()
+    thresholds = {f"field-{sensor}": THRESHOLDS for sensor in range(SENSORS)}
+    naive = sum(1 for reading in readings for metric, limit in zip(("temperature", "humidity", "soil_moisture"), THRESHOLDS) if reading[metric] > limit)
+
+    print(f"{'evaluator':<26} {'readings':>9} {'us/reading':>11} {'alerts':>8} {'cleared':>8} {'naive alerts':>13}")
+    for label, evaluator in (
+        ("debounce 1, no hysteresis", AlertEvaluator(thresholds={}, debounce=1, cooldown=0, hysteresis={})),
+        ("defaults", AlertEvaluator(thresholds={})),
+    ):
+        start = time.perf_counter()
+        events = []
+        for offset in range(0, len(readings), 5000):  # batches as the ingest stage sees them
+            events += evaluator.evaluate(thresholds, readings[offset:offset + 5000])
+        elapsed = time.perf_counter() - start
+        raised = sum(1 for event in events if event[0] == "raised")
+        print(f"{label:<26} {len(readings):>9} {elapsed / len(readings) * 1e6:>11.2f} {raised:>8} {len(events) - raised:>8} {naive:>13}")
+
+
+if __name__ == "__main__":
+    main()
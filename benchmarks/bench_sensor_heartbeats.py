@@ -0,0 +1,69 @@
+"""
+Benchmark: heartbeat tracking for a large fleet.
+
+Drives a HeartbeatTracker on a simulated clock: 100k sensors report every
+minute for an hour while 5% of them stop reporting halfway through. Expiry
+runs every simulated second, as the scheduler would when deadlines are due.
+Reports the cost per heartbeat and per expiry tick. It checks that exactly
+the silent sensors went offline, each once, and that the heap holds one
+entry per online sensor.
+
+Run from the repository root:
+    python -m benchmarks.bench_sensor_heartbeats
+"""
+import random
+import time
+from app.helpers.heartbeat_helpers import HeartbeatTracker
+
+SENSORS = 100_000
+INTERVAL_S = 60
+DURATION_S = 3600
+SILENCE_S = 300
+SILENT_SHARE = 0.05
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 1_780_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def main():
+    rng = random.Random(9)
+    clock = SimulatedClock()
+    tracker = HeartbeatTracker(silence=SILENCE_S, clock=clock)
+    start = clock.now
+    phase = [rng.uniform(0, INTERVAL_S) for _ in range(SENSORS)]
+    silent = set(rng.sample(range(SENSORS), int(SENSORS * SILENT_SHARE)))
+
+    # Heartbeats due in each simulated second.
+    due = [[] for _ in range(DURATION_S)]
+    for sensor, offset in enumerate(phase):
+        stop = DURATION_S // 2 if sensor in silent else DURATION_S
+        for at in range(int(offset), stop, INTERVAL_S):
+            due[at].append(sensor)
+
+    beats, beat_time, expire_time = 0, 0.0, 0.0
+    offline = []
+    for second in range(DURATION_S):
+        clock.now = start + second
+        began = time.perf_counter()
+        for sensor in due[second]:
+            tracker.beat(f"sensor-{sensor}", "farm", clock.now)
+        beat_time += time.perf_counter() - began
+        beats += len(due[second])
+        began = time.perf_counter()
+        offline += tracker.expire()
+        expire_time += time.perf_counter() - began
+
+    flipped = [sensor_id for sensor_id, _ in offline]
+    assert sorted(flipped) == sorted(f"sensor-{sensor}" for sensor in silent), "wrong sensors went offline"
+    assert len(tracker._heap) == SENSORS - len(silent), "heap should hold one deadline per online sensor"
+    print(f"sensors {SENSORS}, heartbeats {beats}, went offline {len(flipped)} (all and only the silent ones)")
+    print(f"per heartbeat {beat_time / beats * 1e6:.2f} us; expiry {expire_time / DURATION_S * 1e3:.3f} ms per tick, heap {len(tracker._heap)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Benchmark: sensor ingest, one reading per request vs. batched.
+
+Runs against an in-memory stand-in for Firestore that charges a round trip per
+commit and a small cost per written document. Compares, for one gateway
+replaying its offline buffer:
+
+- single: the old path, one JSON request and one `.add()` per reading;
+- batch json / batch msgpack: the batch endpoint's decode and ingest path,
+  5000 readings per request, written in WriteBatch chunks of 500.
+
+Request decoding is measured for real; only Firestore is simulated.
+
+Run from the repository root:
+    python -m benchmarks.bench_sensor_ingest
+"""
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import msgpack
+from app.helpers.sensor_helpers import decode_readings, ingest_readings
+
+ROUND_TRIP_S = 0.02  # per commit
+PER_WRITE_S = 0.00002  # per written document
+SINGLE_READINGS = 300  # the single-request path is slow; its rate is measured on fewer readings
+BATCH_READINGS = 5000  # per batch request
+
+
+class SimulatedDocument:
+    def __init__(self, store, path):
+        self.store, self.path = store, path
+
+    def collection(self, name):
+        return SimulatedCollection(self.store, f"{self.path}/{name}")
+
+    def set(self, data, merge=False):
+        self.store.commit({self.path: data})
+
+
+class SimulatedCollection:
+    def __init__(self, store, path):
+        self.store, self.path = store, path
+
+    def document(self, doc_id=None):
+        return SimulatedDocument(self.store, f"{self.path}/{doc_id or format(random.getrandbits(64), 'x')}")
+
+    def add(self, data):
+        self.document().set(data)
+
+
+class SimulatedBatch:
+    def __init__(self, store):
+        self.store, self.writes = store, {}
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes[doc_ref.path] = data
+
+    def commit(self):
+        self.store.commit(self.writes)
+
+
+class SimulatedFirestore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents = {}
+        self.commits = 0
+
+    def commit(self, writes):
+        time.sleep(ROUND_TRIP_S + PER_WRITE_S * len(writes))
+        with self._lock:
+            self.commits += 1
+            self.documents.update(writes)
+
+    def collection(self, name):
+        return SimulatedCollection(self, name)
+
+    def batch(self):
+        return SimulatedBatch(self)
+
+
+def gateway_buffer(count, sensors=20, seed=5):
+    rng = random.Random(seed)
+    start = datetime(2026, 6, 1, tzinfo=timezone.utc)
+    return [
+        {
+            "sensor_id": f"field-{i % sensors}",
+            "temperature": round(rng.uniform(18, 38), 2),
+            "humidity": round(rng.uniform(30, 90), 2),
+            "soil_moisture": round(rng.uniform(10, 45), 2),
+            "timestamp": (start + timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(count)
+    ]
+
+
+def single(client, readings):
+    # ingest_sensor_data before batching: one request body and one add per reading.
+    for body in (json.dumps(reading).encode() for reading in readings):
+        data = json.loads(body)
+        client.collection("sensors_data").document(data["sensor_id"]).collection("readings").add(
+            {"user_id": "bench", **{key: data[key] for key in ("temperature", "humidity", "soil_moisture", "timestamp")}}
+        )
+    return len(readings)
+
+
+def batch_json(client, readings):
+    accepted = 0
+    for start in range(0, len(readings), BATCH_READINGS):
+        body = json.dumps({"readings": readings[start:start + BATCH_READINGS]}).encode()
+        accepted += ingest_readings(client, "bench", decode_readings(body, "application/json"))["accepted"]
+    return accepted
+
+
+def batch_msgpack(client, readings):
+    # The compact frame: positional arrays with epoch-second timestamps.
+    packed = [
+        [r["sensor_id"], datetime.fromisoformat(r["timestamp"]).timestamp(), r["temperature"], r["humidity"], r["soil_moisture"]]
+        for r in readings
+    ]
+    accepted = 0
+    for start in range(0, len(packed), BATCH_READINGS):
+        body = msgpack.packb(packed[start:start + BATCH_READINGS])
+        accepted += ingest_readings(client, "bench", decode_readings(body, "application/msgpack"))["accepted"]
+    return accepted
+
+
+def main():
+    print(f"{'path':<14} {'readings':>9} {'commits':>8} {'seconds':>8} {'readings/s':>11} {'speedup':>8}")
+    baseline = None
+    for label, fn, count in (("single", single, SINGLE_READINGS), ("batch json", batch_json, 20_000), ("batch msgpack", batch_msgpack, 20_000)):
+        client = SimulatedFirestore()
+        readings = gateway_buffer(count)
+        start = time.perf_counter()
+        accepted = fn(client, readings)
+        elapsed = time.perf_counter() - start
+        assert accepted == count == len(client.documents)
+        rate = count / elapsed
+        baseline = baseline or rate
+        print(f"{label:<14} {count:>9} {client.commits:>8} {elapsed:>8.2f} {rate:>11.0f} {rate / baseline:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
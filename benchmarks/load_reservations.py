@@ -0,0 +1,108 @@
+"""
+Load test: flash sale against the stock reservation engine.
+
+Many buyers, spread over several processes (each with its own threads, as API
+workers would be), race to reserve and then buy units of one item whose stock
+is far smaller than the demand. Some buyers abandon their hold instead of
+buying. The run fails unless:
+
+- units sold never exceed the initial stock (no oversell),
+- the stock left equals the initial stock minus the units sold,
+- no units remain reserved once every hold is settled.
+
+Needs the Firestore emulator, e.g.:
+    gcloud emulators firestore start --host-port=localhost:8080
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m benchmarks.load_reservations
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from google.cloud import firestore
+from app.helpers.reservation_helpers import (
+    RESERVATIONS_COLLECTION, InsufficientStock, ReservationConflict, available_quantity, commit_hold,
+    conflict_stats, release_hold, reserve,
+)
+
+STORAGE = "self_stored"
+
+
+def buyer(client, item_id, quantity, abandon_rate, rng):
+    try:
+        hold = reserve(client, STORAGE, item_id, quantity, holder=f"buyer-{rng.random():.6f}", ttl_seconds=300)
+    except InsufficientStock:
+        return "sold_out", 0
+    except ReservationConflict:
+        return "conflict", 0
+    time.sleep(rng.uniform(0, 0.01))  # checkout think time
+    if rng.random() < abandon_rate:
+        release_hold(client, hold["hold_id"])
+        return "abandoned", 0
+    commit_hold(client, hold["hold_id"])
+    return "bought", quantity
+
+
+def worker_process(item_id, buyers, threads, max_units, abandon_rate, seed):
+    client = firestore.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "demo-reservations"))
+    rng = random.Random(seed)
+    quantities = [rng.randint(1, max_units) for _ in range(buyers)]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        outcomes = list(pool.map(lambda quantity: buyer(client, item_id, quantity, abandon_rate, random.Random(rng.random())), quantities))
+    totals = {"bought": 0, "sold_out": 0, "abandoned": 0, "conflict": 0, "units": 0}
+    for outcome, units in outcomes:
+        totals[outcome] += 1
+        totals["units"] += units
+    totals.update(conflict_stats)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stock", type=int, default=500)
+    parser.add_argument("--buyers", type=int, default=4000)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--max-units", type=int, default=3)
+    parser.add_argument("--abandon-rate", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("Set FIRESTORE_EMULATOR_HOST; this load test must not run against a real project.")
+
+    client = firestore.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "demo-reservations"))
+    item_id = f"flash-sale-{uuid.uuid4().hex[:8]}"
+    item_ref = client.collection(STORAGE).document(item_id)
+    item_ref.set({"name": "flash sale onions", "category": "vegetables", "quantity": {"value": args.stock, "unit": "kg"}, "reserved": 0, "item_status": "in stock"})
+
+    per_process = args.buyers // args.processes
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        futures = [
+            pool.submit(worker_process, item_id, per_process, args.threads, args.max_units, args.abandon_rate, seed)
+            for seed in range(args.processes)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    totals = {key: sum(result[key] for result in results) for key in results[0]}
+    item = item_ref.get().to_dict()
+    holds = client.collection(RESERVATIONS_COLLECTION).where("item_id", "==", item_id).stream()
+    committed_units = sum(hold.to_dict()["quantity"] for hold in holds if hold.to_dict()["status"] == "committed")
+
+    print(f"buyers {per_process * args.processes} over {args.processes} processes x {args.threads} threads in {elapsed:.1f}s")
+    print(f"bought {totals['bought']}  sold out {totals['sold_out']}  abandoned {totals['abandoned']}  gave up on conflicts {totals['conflict']}")
+    print(f"version conflicts retried {totals['retries']}, retry budget exhausted {totals['exhausted']}")
+    print(f"stock {args.stock} -> sold {totals['units']} (committed holds {committed_units}), left {available_quantity(item):g}, reserved {item.get('reserved', 0)}")
+
+    assert totals["units"] == committed_units, "buyers and committed holds disagree"
+    assert totals["units"] <= args.stock, "OVERSOLD"
+    assert item["quantity"]["value"] == args.stock - totals["units"], "stock does not match units sold"
+    assert item.get("reserved", 0) == 0, "units left reserved"
+    print("OK: no oversell")
+
+
+if __name__ == "__main__":
+    main()
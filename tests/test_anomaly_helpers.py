@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pytest
+from app.helpers.anomaly_helpers import ANOMALY_METRICS, AnomalyDetector, EwmaState, ewma_series
+
+
+def series(n, spike_at=None):
+    rng = np.random.default_rng(7)
+    temperature = 20 + rng.normal(0, 1, n)
+    soil_moisture = 40 + rng.normal(0, 2, n)
+    if spike_at is not None:
+        temperature[spike_at] += 25
+    return temperature, soil_moisture
+
+
+def readings(temperature, soil_moisture, start=0):
+    at = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    return [
+        {"sensor_id": "s1", "recorded_at": at + timedelta(minutes=start + i), "temperature": float(t), "soil_moisture": float(m)}
+        for i, (t, m) in enumerate(zip(temperature, soil_moisture))
+    ]
+
+
+def test_batch_state_matches_live_state():
+    temperature, soil_moisture = series(700)
+    detector = AnomalyDetector(alpha=0.05)
+    detector.update(readings(temperature, soil_moisture))
+    for metric, values in zip(ANOMALY_METRICS, (temperature, soil_moisture)):
+        _, _, final = ewma_series(values, 0.05)
+        live = detector.state("s1", metric)
+        assert final.count == live.count
+        assert final.mean == pytest.approx(live.mean, rel=1e-9)
+        assert final.var == pytest.approx(live.var, rel=1e-9)
+
+
+def test_batch_flags_the_readings_live_flags():
+    temperature, soil_moisture = series(300, spike_at=200)
+    detector = AnomalyDetector(alpha=0.05, z_threshold=4, warmup=30, cooldown=0)
+    live = [a["reading"]["recorded_at"] for a in detector.update(readings(temperature, soil_moisture)) if a["metric"] == "temperature"]
+    means, variances, _ = ewma_series(temperature, 0.05)
+    stds = np.maximum(np.sqrt(np.nan_to_num(variances)), 0.3)
+    z = (temperature - means) / stds
+    flagged = np.flatnonzero((np.abs(np.nan_to_num(z)) > 4) & (np.arange(len(z)) >= 30))
+    assert 200 in flagged
+    assert live == [readings(temperature, soil_moisture)[i]["recorded_at"] for i in flagged]
+
+
+def test_batch_continues_from_a_state():
+    temperature, soil_moisture = series(400)
+    _, _, whole = ewma_series(temperature, 0.05)
+    _, _, head = ewma_series(temperature[:150], 0.05)
+    means, _, tail = ewma_series(temperature[150:], 0.05, head)
+    assert means[0] == head.mean
+    assert tail.count == whole.count
+    assert tail.mean == pytest.approx(whole.mean, rel=1e-9)
+    assert tail.var == pytest.approx(whole.var, rel=1e-9)
+
+
+def test_seeded_detector_picks_up_where_backfill_stopped():
+    temperature, soil_moisture = series(400)
+    continuous = AnomalyDetector(alpha=0.05)
+    continuous.update(readings(temperature, soil_moisture))
+    seeded = AnomalyDetector(alpha=0.05)
+    for metric, values in zip(ANOMALY_METRICS, (temperature, soil_moisture)):
+        _, _, final = ewma_series(values[:250], 0.05)
+        seeded.seed("s1", metric, final)
+    seeded.update(readings(temperature[250:], soil_moisture[250:], start=250))
+    for metric in ANOMALY_METRICS:
+        assert seeded.state("s1", metric).mean == pytest.approx(continuous.state("s1", metric).mean, rel=1e-9)
+        assert seeded.state("s1", metric).var == pytest.approx(continuous.state("s1", metric).var, rel=1e-9)
+
+
+def test_single_value_starts_the_state():
+    means, variances, final = ewma_series([21.5], 0.05, EwmaState())
+    assert np.isnan(means[0]) and np.isnan(variances[0])
+    assert (final.count, final.mean, final.var) == (1, 21.5, 0.0)
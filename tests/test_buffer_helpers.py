@@ -0,0 +1,52 @@
+import numpy as np
+from app.helpers.buffer_helpers import SensorRingBuffer
+from app.helpers.sensor_helpers import SENSOR_METRICS
+
+
+def readings(*times):
+    return list(times), {metric: [float(at) for at in times] for metric in SENSOR_METRICS}
+
+
+def test_window_returns_readings_in_time_order():
+    buffer = SensorRingBuffer(capacity=8)
+    buffer.extend(*readings(10, 30))
+    buffer.extend(*readings(20))
+    times, values = buffer.window(10)
+    assert times.tolist() == [10, 20, 30]
+    assert values["temperature"].tolist() == [10, 20, 30]
+    assert buffer.window(15, 30)[0].tolist() == [20]
+
+
+def test_extend_skips_readings_already_held():
+    buffer = SensorRingBuffer(capacity=4)
+    buffer.extend(*readings(10, 20))
+    buffer.extend(*readings(20, 30))
+    assert buffer.window(10)[0].tolist() == [10, 20, 30]
+
+
+def test_full_buffer_evicts_oldest_by_time_not_arrival():
+    buffer = SensorRingBuffer(capacity=3)
+    for at in (10, 20, 30, 15, 25):
+        buffer.extend(*readings(at))
+    times, values = buffer.window(buffer.covers_since)
+    assert times.tolist() == [20, 25, 30]
+    assert values["humidity"].tolist() == [20, 25, 30]
+    # 15 was dropped: no window reaching back to it is served from memory
+    assert buffer.window(15) is None
+    assert 15 < buffer.covers_since <= 20
+
+
+def test_late_reading_older_than_everything_held_moves_coverage():
+    buffer = SensorRingBuffer(capacity=2, covers_since=0)
+    buffer.extend(*readings(10, 20))
+    buffer.extend(*readings(5))
+    assert buffer.window(0) is None
+    assert buffer.window(10)[0].tolist() == [10, 20]
+
+
+def test_window_reports_missing_coverage():
+    buffer = SensorRingBuffer(capacity=4)
+    assert buffer.window(0) is None
+    buffer.extend(*readings(10, 20))
+    assert buffer.window(5) is None
+    assert np.array_equal(buffer.window(10)[0], [10, 20])
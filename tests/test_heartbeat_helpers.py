@@ -0,0 +1,89 @@
+from app.helpers.heartbeat_helpers import HeartbeatTracker
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def tracker(now=1000.0):
+    clock = Clock(now)
+    return HeartbeatTracker(silence=60, clock=clock), clock
+
+
+def test_beat_brings_a_sensor_online_once():
+    heartbeats, clock = tracker()
+    status = heartbeats.beat("s1", "farm", 1000)
+    assert status["status"] == "online" and status["user_id"] == "farm"
+    assert heartbeats.beat("s1", "farm", 1010) is None
+    assert len(heartbeats._heap) == 1
+
+
+def test_expire_flips_a_silent_sensor_offline():
+    heartbeats, clock = tracker()
+    heartbeats.beat("s1", "farm", 1000)
+    assert heartbeats.expire(1059) == []
+    transitions = heartbeats.expire(1060)
+    assert [(sensor_id, status["status"]) for sensor_id, status in transitions] == [("s1", "offline")]
+    assert heartbeats.status("s1")["status"] == "offline"
+    assert heartbeats._heap == []
+
+
+def test_expire_reschedules_a_sensor_heard_from_meanwhile():
+    heartbeats, clock = tracker()
+    heartbeats.beat("s1", "farm", 1000)
+    clock.now = 1030
+    heartbeats.beat("s1", "farm", 1030)
+    assert heartbeats.expire(1060) == []
+    assert heartbeats._heap == [(1090, "s1")]
+    assert [sensor_id for sensor_id, _ in heartbeats.expire(1090)] == ["s1"]
+
+
+def test_beat_ignores_replays_older_than_the_silence_window():
+    heartbeats, clock = tracker(now=2000.0)
+    assert heartbeats.beat("s1", "farm", 1000) is None
+    assert heartbeats.status("s1")["status"] == "offline"
+    assert heartbeats._heap == []
+
+
+def test_beat_clamps_readings_from_the_future():
+    heartbeats, clock = tracker()
+    heartbeats.beat("s1", "farm", 5000)
+    assert heartbeats._heap == [(1060, "s1")]
+
+
+def test_beat_of_an_offline_sensor_brings_it_back():
+    heartbeats, clock = tracker()
+    heartbeats.beat("s1", "farm", 1000)
+    heartbeats.expire(1060)
+    clock.now = 1100
+    assert heartbeats.beat("s1", "farm", 1100)["status"] == "online"
+    assert heartbeats._heap == [(1160, "s1")]
+
+
+def test_lapsed_beat_is_recorded_again():
+    heartbeats, clock = tracker()
+    heartbeats.beat("s1", "farm", 1000)
+    clock.now = 1070  # past the deadline, not yet expired here
+    assert heartbeats.beat("s1", "farm", 1070)["status"] == "online"
+
+
+def test_revive_only_within_the_silence_window():
+    heartbeats, clock = tracker()
+    heartbeats.beat("s1", "farm", 1000)
+    heartbeats.expire(1060)
+    clock.now = 1100
+    heartbeats.revive("s1", 1030)
+    assert heartbeats.status("s1")["status"] == "offline"
+    heartbeats.revive("s1", 1090)
+    assert heartbeats.status("s1")["status"] == "online"
+    assert heartbeats._heap == [(1150, "s1")]
+
+
+def test_restore_schedules_from_the_recorded_last_seen():
+    heartbeats, clock = tracker()
+    heartbeats.restore("s1", "farm", 950)
+    assert [sensor_id for sensor_id, _ in heartbeats.expire(1010)] == ["s1"]
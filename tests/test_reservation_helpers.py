@@ -0,0 +1,54 @@
+import pytest
+from google.api_core import exceptions as google_exceptions
+from app.helpers import reservation_helpers
+from app.helpers.inventory_helpers import stock_status
+from app.helpers.reservation_helpers import ReservationConflict, _quantity_update, available_quantity, retry_on_conflict
+
+
+def test_available_quantity_subtracts_holds():
+    assert available_quantity({"quantity": {"value": 10, "unit": "kg"}, "reserved": 4}) == 6
+    assert available_quantity({"quantity": 7}) == 7
+    assert available_quantity({"quantity": 7, "reserved": None}) == 7
+
+
+def test_quantity_update_keeps_the_stored_shape():
+    item = {"quantity": {"value": 10, "unit": "kg"}, "item_status": "in stock"}
+    assert _quantity_update(item, 4.0) == {"quantity": {"value": 4, "unit": "kg"}, "item_status": "in stock"}
+    assert _quantity_update({"quantity": 3}, 2.5) == {"quantity": 2.5, "item_status": "in stock"}
+    assert isinstance(_quantity_update({"quantity": 3}, 2.0)["quantity"], int)
+
+
+def test_quantity_update_flips_only_the_stock_states():
+    assert _quantity_update({"quantity": 1, "item_status": "in stock"}, 0)["item_status"] == "out of stock"
+    assert _quantity_update({"quantity": 0, "item_status": "out of stock"}, 5)["item_status"] == "in stock"
+    assert _quantity_update({"quantity": 1, "item_status": "sold"}, 0)["item_status"] == "sold"
+
+
+def test_stock_status():
+    assert stock_status(None, 3) == "in stock"
+    assert stock_status(None, 0) == "out of stock"
+    assert stock_status("reserved", 0) == "reserved"
+
+
+def test_retry_on_conflict_retries_until_the_write_lands(monkeypatch):
+    monkeypatch.setattr(reservation_helpers.time, "sleep", lambda seconds: None)
+    calls = []
+
+    def attempt():
+        calls.append(None)
+        if len(calls) < 3:
+            raise google_exceptions.FailedPrecondition("stale")
+        return "done"
+
+    assert retry_on_conflict("self_stored", "a", attempt) == "done"
+    assert len(calls) == 3
+
+
+def test_retry_on_conflict_gives_up(monkeypatch):
+    monkeypatch.setattr(reservation_helpers.time, "sleep", lambda seconds: None)
+
+    def attempt():
+        raise google_exceptions.Aborted("contended")
+
+    with pytest.raises(ReservationConflict):
+        retry_on_conflict("self_stored", "a", attempt)
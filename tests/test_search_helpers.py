@@ -0,0 +1,145 @@
+import pytest
+from app.helpers.search_helpers import CompiledFilter, FacetCounts, InventoryIndex, QueryCache, decode_cursor, encode_cursor, paginate
+
+
+def listing(name, category="vegetables", farm="green acres", pincode="110001", price=10, quantity=5, rating=4.0, status="in stock"):
+    return {
+        "name": name,
+        "description": f"fresh {name}",
+        "category": category,
+        "farm": farm,
+        "pincode": pincode,
+        "price": {"value": price, "unit": "kg"},
+        "quantity": {"value": quantity, "unit": "kg"},
+        "average_rating": rating,
+        "item_status": status,
+    }
+
+
+@pytest.fixture
+def index():
+    index = InventoryIndex()
+    index.load({
+        "a": listing("Tomato", price=30, quantity=50, rating=4.5),
+        "b": listing("Potato", price=15, quantity=0, status="out of stock"),
+        "c": listing("Mango", category="fruits", farm="sunny farm", pincode="560001", price=80, quantity=20, rating=3.5),
+        "d": listing("Tomatillo", category="fruits", price=45, quantity=100, rating=4.8),
+    })
+    return index
+
+
+def test_search_intersects_text_and_fields(index):
+    assert index.search(query="tom") == {"a", "d"}
+    assert index.search(query="tom", category="Fruits") == {"d"}
+    assert index.search(farm="Sunny Farm") == {"c"}
+    assert index.search(pincodes=["560001", "999999"]) == {"c"}
+
+
+def test_search_in_stock_skips_sold_out_listings(index):
+    assert index.search(query="potato") == {"b"}
+    assert index.search(query="potato", in_stock=True) == set()
+    assert index.in_stock_ids() == {"a", "c", "d"}
+
+
+def test_upsert_and_remove_move_postings(index):
+    index.upsert("b", listing("Potato", price=15, quantity=8))
+    assert index.search(query="potato", in_stock=True) == {"b"}
+    index.remove("a")
+    assert index.search(query="tom") == {"d"}
+    assert index.lookup(["a", "d"]) == [index.get("d")]
+
+
+def test_patch_ignores_unknown_listings(index):
+    index.patch("zzz", {"quantity": 3})
+    assert index.get("zzz") is None
+    index.patch("c", {"category": "vegetables"})
+    assert index.search(category="vegetables", in_stock=True) == {"a", "c"}
+
+
+def test_facet_counts_follow_in_stock_listings(index):
+    facets = index.facet_counts()
+    assert facets["category"] == {"vegetables": 1, "fruits": 2}
+    index.remove("c")
+    assert index.facet_counts()["category"] == {"vegetables": 1, "fruits": 1}
+
+
+def test_pages_cover_every_entry_once_in_order(index):
+    entries = index.entries(index.search(in_stock=True))
+    seen, cursor = [], None
+    while True:
+        page, cursor = paginate(entries, "price", 1, cursor)
+        seen.extend(item_id for item_id, _ in page)
+        if cursor is None:
+            break
+    assert seen == ["a", "d", "c"]
+
+
+def test_ratings_pages_sort_descending(index):
+    page, cursor = paginate(index.entries(index.search(in_stock=True)), "ratings", 2)
+    assert [item_id for item_id, _ in page] == ["d", "a"]
+    page, cursor = paginate(index.entries(index.search(in_stock=True)), "ratings", 2, cursor)
+    assert [item_id for item_id, _ in page] == ["c"] and cursor is None
+
+
+def test_cursor_round_trip_and_validation():
+    cursor = encode_cursor("price", 12.5, "a")
+    assert decode_cursor(cursor, "price") == (12.5, "a")
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, "quantity")
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor", "price")
+    for value in (None, True, "12"):
+        with pytest.raises(ValueError):
+            decode_cursor(encode_cursor("price", value, "a"), "price")
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(None, 3, "a"), None)
+
+
+def test_compiled_filter_rows_and_columns_agree(index):
+    compiled = CompiledFilter({"min_price": 20, "max_price": 60, "rating_threshold": 4.0})
+    ids = sorted(index.items)
+    rows = {item_id for item_id, _ in compiled.apply_rows(index, ids)}
+    assert rows == set(compiled.apply_columns(index, ids)) == {"a", "d"}
+
+
+def test_compiled_filter_counts_facets_of_matches(index):
+    facets = FacetCounts()
+    matched = CompiledFilter({"min_quantity": 30}).select(index, sorted(index.items), facets)
+    assert sorted(item_id for item_id, _ in matched) == ["a", "d"]
+    assert facets.as_dict()["category"] == {"vegetables": 1, "fruits": 1}
+
+
+def test_compiled_filter_rejects_non_numeric_bounds():
+    with pytest.raises(ValueError):
+        CompiledFilter({"min_price": "10"})
+    with pytest.raises(ValueError):
+        CompiledFilter({"max_price": True})
+
+
+def test_cache_invalidates_only_affected_scopes():
+    cache = QueryCache(max_entries=10, ttl=60)
+    cache.put("veg", 1, category="vegetables")
+    cache.put("fruit", 2, category="fruits")
+    cache.put("any", 3)
+    cache.invalidate_item(None, listing("Carrot", pincode="110001"))
+    assert cache.get("veg") is None
+    assert cache.get("any") is None
+    assert cache.get("fruit") == 2
+
+
+def test_cache_skips_results_computed_across_an_invalidation():
+    cache = QueryCache(max_entries=10, ttl=60)
+    generation = cache.generation()
+    cache.invalidate_item(listing("Carrot"), None)
+    cache.put("stale", 1, generation=generation)
+    assert cache.get("stale") is None
+
+
+def test_cache_evicts_least_recently_used():
+    cache = QueryCache(max_entries=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3